@@ -0,0 +1,761 @@
+"""
+Замеры производительности генератора листингов.
+
+    python bench.py rows [--rows 20000] [--repeat 3]
+    python bench.py sanitize [--chars 2000000] [--repeat 3]
+    python bench.py bigfile [--mb 64]
+    python bench.py readahead [--latency-ms 5] [параметры gen]
+    python bench.py deflate [--mb 32] [--threads 0]
+    python bench.py layout [--lines 30000] [--soffice]
+    python bench.py gen DIR [--files 200 --profile code --huge 1 ...]
+    python bench.py suite [--root DIR | параметры gen] [--json OUT] [--baseline BASE.json]
+    python bench.py compare BASE.json CUR.json [--threshold 0.1]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import docx
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import qn
+
+import ls
+
+
+# ===== Эталон: построение таблицы поэлементно (как было до шаблона строки) =====
+_LEGACY_PPR_XML = ls._make_pPr_gost().xml
+_LEGACY_RPR_XML = ls._make_rPr_gost().xml
+
+
+def _legacy_cell_paragraph(text: str) -> OxmlElement:
+    text = ls.xml_safe_text(text)
+
+    p = OxmlElement("w:p")
+    p.append(parse_xml(_LEGACY_PPR_XML))
+
+    r = OxmlElement("w:r")
+    r.append(parse_xml(_LEGACY_RPR_XML))
+
+    t = OxmlElement("w:t")
+    if text.startswith(" ") or "  " in text:
+        t.set(qn("xml:space"), "preserve")
+    t.text = text
+    r.append(t)
+
+    p.append(r)
+    return p
+
+
+def legacy_build_code_table_xml(lines: list[str], start_line_no: int = 1) -> OxmlElement:
+    tbl = ls._make_table_head()
+    for i, line in enumerate(lines):
+        safe_line = ls.xml_safe_text(line)
+
+        tr = OxmlElement("w:tr")
+
+        tc1 = OxmlElement("w:tc")
+        tc1.append(ls._make_tcPr(ls.NUM_COL_WIDTH_MM))
+        tc1.append(_legacy_cell_paragraph(str(start_line_no + i)))
+
+        tc2 = OxmlElement("w:tc")
+        tc2.append(ls._make_tcPr(ls.CODE_COL_WIDTH_MM))
+        tc2.append(_legacy_cell_paragraph(safe_line))
+
+        tr.append(tc1)
+        tr.append(tc2)
+        tbl.append(tr)
+
+    return tbl
+
+
+# ===== Эталон: посимвольная очистка для XML (как было до регулярки) =====
+def legacy_xml_safe_text(s: str) -> str:
+    out = []
+    for ch in s:
+        code = ord(ch)
+        if code in (0x9, 0xA, 0xD):
+            out.append(ch)
+        elif 0x20 <= code <= 0xD7FF:
+            out.append(ch)
+        elif 0xE000 <= code <= 0xFFFD:
+            out.append(ch)
+        elif 0x10000 <= code <= 0x10FFFF:
+            out.append(ch)
+        else:
+            continue
+    return "".join(out)
+
+
+def legacy_prepare_lines(data: bytes) -> tuple[int, list[str]]:
+    content = data.decode("utf-8", errors="ignore").replace("\r\n", "\n").replace("\r", "\n")
+    content = legacy_xml_safe_text(content)
+    content_len = len(content)
+    lines = ls.split_keep_all_lines(content)
+    return content_len, [legacy_xml_safe_text(line) for line in lines]
+
+
+# ===== Синтетические данные =====
+def synthetic_lines(n: int, seed: int = 1) -> list[str]:
+    rnd = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz_ ()[]{}<>&=+-*/.,:;\"'\tАБВжзи"
+    lines = []
+    for _ in range(n):
+        indent = " " * (4 * rnd.randint(0, 3))
+        body = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 80)))
+        lines.append(indent + body)
+    return lines
+
+
+def _best_of(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+# ===== rows: шаблон строки против поэлементной сборки =====
+def bench_rows(args: argparse.Namespace) -> int:
+    lines = synthetic_lines(args.rows)
+    safe_lines = [ls.xml_safe_text(line) for line in lines]
+
+    expected = ls._fragment_xml(legacy_build_code_table_xml(lines))
+    got = ls.render_code_table_xml(safe_lines)
+    if expected != got:
+        print("ОШИБКА: разметка шаблона строки отличается от поэлементной сборки", file=sys.stderr)
+        return 1
+
+    cases = [
+        ("поэлементно (было)", lambda: legacy_build_code_table_xml(lines)),
+        ("шаблон -> str", lambda: ls.render_code_table_xml(safe_lines)),
+        ("шаблон -> lxml", lambda: ls.build_code_table_xml(lines)),
+    ]
+    base = None
+    for name, fn in cases:
+        dt = _best_of(fn, args.repeat)
+        rate = args.rows / dt
+        base = base or rate
+        print(f"{name:<22} {rate:>12,.0f} строк/с  x{rate / base:.1f}")
+    return 0
+
+
+# ===== sanitize: очистка текста для XML =====
+def synthetic_texts(chars: int, seed: int = 1) -> list[tuple[str, str]]:
+    rnd = random.Random(seed)
+    ascii_code = "\n".join(synthetic_lines(chars // 40, seed))[:chars]
+    ascii_code = "".join(ch for ch in ascii_code if ch.isascii())
+    cyr = ("Пример текста с комментариями — ёжик; " * (chars // 38 + 1))[:chars]
+    dirty = list(ascii_code)
+    for _ in range(len(dirty) // 500):
+        dirty[rnd.randrange(len(dirty))] = rnd.choice("\x00\x01\x0b\x1f\ufffe")
+    return [
+        ("ASCII-код", ascii_code),
+        ("кириллица", cyr),
+        ("с мусором", "".join(dirty)),
+    ]
+
+
+def bench_sanitize(args: argparse.Namespace) -> int:
+    for name, text in synthetic_texts(args.chars):
+        if legacy_xml_safe_text(text) != ls.xml_safe_text(text):
+            print(f"ОШИБКА: результат очистки отличается ({name})", file=sys.stderr)
+            return 1
+        data = text.replace("\n", "\r\n").encode("utf-8")
+        if legacy_prepare_lines(data) != ls.prepare_lines(data):
+            print(f"ОШИБКА: результат подготовки строк отличается ({name})", file=sys.stderr)
+            return 1
+
+        old = _best_of(lambda: legacy_xml_safe_text(text), args.repeat)
+        new = _best_of(lambda: ls.xml_safe_text(text), args.repeat)
+        old_p = _best_of(lambda: legacy_prepare_lines(data), args.repeat)
+        new_p = _best_of(lambda: ls.prepare_lines(data), args.repeat)
+        mb = len(text) / 1e6
+        print(
+            f"{name:<10} xml_safe_text: {mb / old:8.1f} -> {mb / new:8.1f} Мсимв/с (x{old / new:.0f});"
+            f"  файл -> строки: {mb / old_p:6.1f} -> {mb / new_p:6.1f} Мсимв/с (x{old_p / new_p:.0f})"
+        )
+    return 0
+
+
+# ===== bigfile: большой файл целиком в памяти против потокового чтения =====
+def _render_big(path: Path, stream: bool) -> str:
+    ls.STREAM_MIN_BYTES = 0 if stream else 1 << 62
+    rf = ls.render_file(path, path.name)
+    h = hashlib.sha256()
+    for table in ls.iter_file_tables(rf):
+        h.update(table.encode("utf-8"))
+    return h.hexdigest()
+
+
+def bench_bigfile(args: argparse.Namespace) -> int:
+    saved = ls.STREAM_MIN_BYTES
+    fd, name = tempfile.mkstemp(suffix=".sql")
+    path = Path(name)
+    try:
+        block = ("\r\n".join(synthetic_lines(20_000)) + "\r\n").encode("utf-8")
+        with os.fdopen(fd, "wb") as fh:
+            for _ in range(max(1, args.mb * 1024 * 1024 // len(block))):
+                fh.write(block)
+        size_mb = path.stat().st_size / 1024 ** 2
+
+        results = {}
+        for name_, stream in (("целиком (было)", False), ("потоково", True)):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            digest = _render_big(path, stream)
+            dt = time.perf_counter() - t0
+            _cur, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name_] = digest
+            print(f"{name_:<16} {size_mb:.0f} МБ за {dt:6.1f} с, пик памяти {peak / 1024 ** 2:8.1f} МБ")
+        if len(set(results.values())) != 1:
+            print("ОШИБКА: таблицы потокового чтения отличаются от чтения целиком", file=sys.stderr)
+            return 1
+        return 0
+    finally:
+        ls.STREAM_MIN_BYTES = saved
+        path.unlink()
+
+
+def bench_readahead(args: argparse.Namespace) -> int:
+    """
+    Рендер файлов проекта по одному и с чтением впереди. Задержка диска (сетевая папка, HDD)
+    имитируется паузой перед каждым чтением: как и настоящий ввод-вывод, пауза отпускает GIL.
+    """
+    real_read = ls.read_source
+
+    def slow_read(path: Path, policy: ls.FilePolicy) -> ls.SourceBytes:
+        time.sleep(args.latency_ms / 1000)
+        return real_read(path, policy)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        args.projects, args.huge = 1, 0
+        generate_tree(root, args)
+        project, files = _project_files(root)[0]
+        ls.read_source = slow_read
+        try:
+            results = {}
+            for name, read_ahead in (("по одному (было)", 0), ("с чтением впереди", ls.READ_AHEAD_BYTES)):
+                t0 = time.perf_counter()
+                h = hashlib.sha256()
+                for rf in ls.iter_rendered_files(files, project, read_ahead=read_ahead):
+                    h.update(rf.rel.encode("utf-8"))
+                    for table in rf.tables:
+                        h.update(table.encode("utf-8"))
+                dt = time.perf_counter() - t0
+                results[name] = h.hexdigest()
+                print(f"{name:<18} {len(files)} файлов за {dt:6.2f} с ({len(files) / dt:7.1f} файлов/с)")
+        finally:
+            ls.read_source = real_read
+    if len(set(results.values())) != 1:
+        print("ОШИБКА: таблицы с чтением впереди отличаются", file=sys.stderr)
+        return 1
+    return 0
+
+
+def bench_deflate(args: argparse.Namespace) -> int:
+    """Сжатие document.xml одним потоком zlib (как zipfile) против блоков ZipPackageWriter."""
+    lines = synthetic_lines(20_000)
+    table = ls.render_code_table_xml(lines).encode("utf-8")
+    data = table * max(1, args.mb * 1024 * 1024 // len(table))
+    size_mb = len(data) / 1024 ** 2
+    threads = args.threads or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmp:
+        for level in (1, 6, 9):
+            t0 = time.perf_counter()
+            c = zlib.compressobj(level, zlib.DEFLATED, -15)
+            one = c.compress(data) + c.flush()
+            t_one = time.perf_counter() - t0
+
+            path = Path(tmp) / f"l{level}.zip"
+            t0 = time.perf_counter()
+            zw = ls.ZipPackageWriter(path, level, threads)
+            zw.writestr("word/document.xml", data)
+            zw.close()
+            t_par = time.perf_counter() - t0
+            with zipfile.ZipFile(path) as zf:
+                if zf.testzip() is not None or zf.read("word/document.xml") != data:
+                    print(f"ОШИБКА: уровень {level}: содержимое zip не совпадает", file=sys.stderr)
+                    return 1
+                packed = zf.getinfo("word/document.xml").compress_size
+            print(
+                f"уровень {level}: {size_mb:.0f} МБ; один поток {t_one:5.2f} с, {len(one) / 1024 ** 2:6.2f} МБ; "
+                f"блоки в {threads} потоках {t_par:5.2f} с, {packed / 1024 ** 2:6.2f} МБ"
+            )
+    return 0
+
+
+# ===== layout: раскладка rows против compact =====
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_ELEMENT_RE = re.compile(r"<w:[A-Za-z]")
+
+
+def table_lines(table_xml: str) -> list[tuple[str, str]]:
+    """(номер, код) по строкам листинга из XML w:tbl любой раскладки: w:br — граница строки в ячейке."""
+    tbl = ls.parse_code_table_xml(table_xml)
+    out = []
+    for tr in tbl.iter(_W_NS + "tr"):
+        cells = []
+        for tc in tr.iter(_W_NS + "tc"):
+            cur = [""]
+            for el in tc.iter(_W_NS + "t", _W_NS + "br"):
+                if el.tag == _W_NS + "br":
+                    cur.append("")
+                else:
+                    cur[-1] += el.text or ""
+            cells.append(cur)
+        out.extend(zip(*cells))
+    return out
+
+
+def _soffice_seconds(soffice: str, path: Path) -> float:
+    """Открытие, раскладка по страницам и вывод в PDF в LibreOffice без интерфейса — замена замеру Word."""
+    t0 = time.perf_counter()
+    subprocess.run(
+        [soffice, "--headless", "--convert-to", "pdf", "--outdir", str(path.parent), str(path)],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - t0
+
+
+def bench_layout(args: argparse.Namespace) -> int:
+    """
+    Один документ на --lines строк кода в раскладках rows и compact: элементы и байты разметки на строку,
+    рендер XML, сборка и сохранение docx (python-docx и потоковая запись), повторное открытие python-docx.
+    Word здесь не запустить; с --soffice — ещё открытие и раскладка в LibreOffice (--convert-to pdf).
+    """
+    lines = [ls.xml_safe_text(line) for line in synthetic_lines(args.lines)]
+    text_bytes = sum(len(line) for line in lines)
+    tables = {layout: ls.render_code_table_xml(lines, layout=layout) for layout in ls.LAYOUTS}
+    rows = table_lines(tables["rows"])
+    # в compact длинные строки разрезаны по ширине ячеек заранее: сверяется с теми же строками rows
+    expected = {"rows": rows, "compact": [p for num, code in rows for p in zip(*ls.wrap_row_cells(num, code))]}
+    for layout, table in tables.items():
+        if table_lines(table) != expected[layout]:
+            print(f"ОШИБКА: раскладка {layout}: номера и строки кода отличаются от rows", file=sys.stderr)
+            return 1
+    soffice = (shutil.which("soffice") or shutil.which("libreoffice")) if args.soffice else None
+    if args.soffice and not soffice:
+        print("LibreOffice (soffice) не найден — замер открытия пропущен", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as tmp:
+        for layout, table in tables.items():
+            render = _best_of(lambda: ls.render_code_table_xml(lines, layout=layout), args.repeat)
+            res = {}
+            for name, writer_cls in (("docx", ls.DocxTreeWriter), ("stream", ls.StreamingDocxWriter)):
+                path = Path(tmp) / f"{layout}-{name}.docx"
+                t0 = time.perf_counter()
+                w = writer_cls(path, "А")
+                w.add_listing(1, "bench.py", table)
+                w.save()
+                res[name] = time.perf_counter() - t0
+            path = Path(tmp) / f"{layout}-stream.docx"
+            t0 = time.perf_counter()
+            docx.Document(str(path))
+            reopen = time.perf_counter() - t0
+            line = (
+                f"{layout:<8} на строку: элементов {len(_ELEMENT_RE.findall(table)) / args.lines:5.1f}, "
+                f"разметки {(len(table) - text_bytes) / args.lines:6.1f} Б; рендер {render:5.2f} с; "
+                f"docx {res['docx']:5.2f} с, stream {res['stream']:5.2f} с, {path.stat().st_size / 1024:7.0f} КБ; "
+                f"открытие python-docx {reopen:5.2f} с"
+            )
+            if soffice:
+                line += f"; LibreOffice {_soffice_seconds(soffice, path):6.2f} с"
+            print(line)
+    return 0
+
+
+# ===== Синтетический targets/: генератор дерева проектов =====
+LINE_PROFILES = {
+    # длина строки: (минимум, максимум) символов
+    "short": (0, 24),
+    "code": (0, 100),
+    "long": (120, 400),
+    "minified": (2_000, 20_000),
+}
+
+BENCH_IGNORE = "node_modules/\nbuild/\n.git/\n*.log\n"
+
+
+def _line_pool(profile: str, rnd: random.Random, size: int = 4000) -> list[str]:
+    lo, hi = LINE_PROFILES[profile]
+    alphabet = "abcdefghijklmnopqrstuvwxyz_ ()[]{}<>&=+-*/.,:;\"'\tАБВжзи"
+    chunk = "".join(rnd.choice(alphabet) for _ in range(hi + 64))
+    pool = []
+    for _ in range(size):
+        n = rnd.randint(lo, hi)
+        start = rnd.randrange(0, len(chunk) - n + 1)
+        indent = " " * (4 * rnd.randint(0, 3)) if hi < 1000 else ""
+        pool.append(indent + chunk[start:start + n])
+    return pool
+
+
+def _file_bytes(rnd: random.Random, pool: list[str], n_lines: int, non_utf8: bool) -> bytes:
+    text = "\r\n".join(rnd.choices(pool, k=n_lines)) + "\r\n"
+    if non_utf8:
+        # cp1251 с мусорными байтами: путь decode(errors="ignore")
+        return text.encode("cp1251", errors="replace") + b"\xff\xfe\x80"
+    return text.encode("utf-8")
+
+
+def generate_tree(root: Path, args: argparse.Namespace) -> dict:
+    """
+    root/targets/<Проект>/... и root/ignore.txt — то же устройство, что у ls.py,
+    так что по дереву можно запустить и саму программу.
+    """
+    rnd = random.Random(args.seed)
+    pool = _line_pool(args.profile, rnd)
+    targets = root / "targets"
+    targets.mkdir(parents=True, exist_ok=True)
+    (root / "ignore.txt").write_text(BENCH_IGNORE, encoding="utf-8")
+
+    stats = {"files": 0, "bytes": 0, "ignored_files": 0, "binary_files": 0, "non_utf8_files": 0}
+    huge_block = _file_bytes(rnd, _line_pool("code", rnd), 20_000, non_utf8=False)
+    for p in range(args.projects):
+        proj = targets / f"Proj{p + 1}"
+        for i in range(args.files):
+            d = proj / "src" / f"pkg{i % 7}" / f"sub{i % 3}"
+            d.mkdir(parents=True, exist_ok=True)
+            bad = rnd.random() < args.non_utf8
+            data = _file_bytes(rnd, pool, rnd.randint(1, 2 * args.lines), bad)
+            (d / f"mod{i}.py").write_bytes(data)
+            stats["files"] += 1
+            stats["bytes"] += len(data)
+            stats["non_utf8_files"] += bad
+        for i in range(args.huge):
+            with open(proj / f"dump{i}.sql", "wb") as fh:
+                for _ in range(max(1, args.huge_mb * 1024 * 1024 // len(huge_block))):
+                    fh.write(huge_block)
+                stats["bytes"] += fh.tell()
+            stats["files"] += 1
+        for i in range(args.binary):
+            (proj / "assets").mkdir(exist_ok=True)
+            (proj / "assets" / f"img{i}.bin").write_bytes(bytes(rnd.randrange(256) for _ in range(16_384)))
+            stats["binary_files"] += 1
+        for i in range(args.ignored):
+            d = proj / ("node_modules" if i % 2 else "build") / f"dep{i % 10}"
+            d.mkdir(parents=True, exist_ok=True)
+            (d / f"index{i}.js").write_bytes(_file_bytes(rnd, pool, 50, False))
+            stats["ignored_files"] += 1
+    return stats
+
+
+def _add_gen_arguments(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--projects", type=int, default=2)
+    p.add_argument("--files", type=int, default=200, help="обычных файлов на проект")
+    p.add_argument("--lines", type=int, default=200, help="средняя длина файла в строках")
+    p.add_argument("--profile", choices=sorted(LINE_PROFILES), default="code", help="распределение длин строк")
+    p.add_argument("--huge", type=int, default=1, help="больших файлов на проект")
+    p.add_argument("--huge-mb", type=int, default=8)
+    p.add_argument("--ignored", type=int, default=200, help="файлов в node_modules/ и build/ на проект")
+    p.add_argument("--binary", type=int, default=5, help="двоичных файлов на проект")
+    p.add_argument("--non-utf8", type=float, default=0.05, help="доля файлов не в UTF-8")
+    p.add_argument("--seed", type=int, default=1)
+
+
+def bench_gen(args: argparse.Namespace) -> int:
+    stats = generate_tree(Path(args.dir), args)
+    print(json.dumps(stats, ensure_ascii=False))
+    return 0
+
+
+# ===== suite: время стадий на синтетическом дереве =====
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024  # macOS — байты, Linux — КБ
+
+
+def _quiet_logger() -> logging.Logger:
+    logger = logging.getLogger("bench.quiet")
+    logger.handlers[:] = [logging.NullHandler()]
+    logger.propagate = False
+    return logger
+
+
+# строк таблиц на документ в стадии docx и в layout — как у сборки с --max-doc-rows 30000
+BENCH_DOC_ROWS = 30_000
+# двоичные файлы дерева gen пропускаются, как в реальных сборках с --sniff
+SUITE_POLICY = ls.FilePolicy(sniff=True)
+
+
+def _project_files(root: Path) -> list[tuple[Path, list[Path]]]:
+    ignore = ls.IgnoreMatcher.from_patterns(ls.load_ignore_patterns_auto(root))
+    out = root / "listing_out"
+    projects = sorted(p for p in (root / "targets").iterdir() if p.is_dir())
+    return [(p, ls.iter_project_files(p, out, ignore)) for p in projects]
+
+
+def _read_all(root: Path) -> list[bytes]:
+    blobs = []
+    for _proj, files in _project_files(root):
+        for f in files:
+            try:
+                blobs.append(ls.read_checked(f, SUITE_POLICY)[1])
+            except ls.SkippedFile:
+                pass
+    return blobs
+
+
+def _part_lines(root: Path) -> list[tuple[int, list[str]]]:
+    parts = []
+    for data in _read_all(root):
+        _n, lines = ls.prepare_lines(data)
+        for a, b in ls.compute_line_blocks_by_char_limit(lines, ls.MAX_DOC_CHARS):
+            parts.append((a + 1, lines[a:b]))
+    return parts
+
+
+def _stage(name: str, seconds: float, items: int, unit: str) -> dict:
+    return {
+        "stage": name,
+        "seconds": round(seconds, 4),
+        "items": items,
+        "unit": unit,
+        "rate": round(items / seconds, 1) if seconds > 0 else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def run_stage(name: str, root_str: str) -> list[dict]:
+    """Одна стадия в отдельном процессе: подготовка не замеряется, peak RSS — этого процесса."""
+    root = Path(root_str)
+    if name == "walk":
+        t0 = time.perf_counter()
+        n = sum(len(files) for _p, files in _project_files(root))
+        return [_stage("walk", time.perf_counter() - t0, n, "files")]
+
+    if name == "read":
+        files = [f for _p, fs in _project_files(root) for f in fs]
+        t0 = time.perf_counter()
+        total = 0
+        for f in files:
+            try:
+                total += len(ls.read_checked(f, SUITE_POLICY)[1])
+            except ls.SkippedFile:
+                pass
+        return [_stage("read", time.perf_counter() - t0, total, "bytes")]
+
+    if name == "sanitize":
+        blobs = _read_all(root)
+        t0 = time.perf_counter()
+        rows = sum(len(ls.prepare_lines(data)[1]) for data in blobs)
+        return [_stage("sanitize", time.perf_counter() - t0, rows, "rows")]
+
+    if name == "build_xml":
+        parts = _part_lines(root)
+        t0 = time.perf_counter()
+        for start, lines in parts:
+            ls.render_code_table_xml(lines, start_line_no=start)
+        return [_stage("build_xml", time.perf_counter() - t0, sum(len(x) for _s, x in parts), "rows")]
+
+    if name == "docx":
+        parts = _part_lines(root)
+        tables = [(ls.render_code_table_xml(lines, start_line_no=start), len(lines)) for start, lines in parts]
+        del parts
+        # документы — во временную папку: --root может быть настоящим деревом с listing_out
+        with tempfile.TemporaryDirectory(prefix="ls-bench-") as tmp:
+            out = Path(tmp)
+            assemble = save = 0.0
+            doc, acc, n_docs = None, 0, 0
+            for i, (table, n) in enumerate(tables):
+                if doc is not None and acc + n > BENCH_DOC_ROWS:
+                    t1 = time.perf_counter()
+                    doc.save()
+                    save += time.perf_counter() - t1
+                    doc = None
+                if doc is None:
+                    n_docs += 1
+                    doc, acc = ls.DocxTreeWriter(out / f"d{n_docs}.docx", "А"), 0
+                t1 = time.perf_counter()
+                doc.add_listing(i + 1, f"file{i}.py", table)
+                assemble += time.perf_counter() - t1
+                acc += n
+            if doc is not None:
+                t1 = time.perf_counter()
+                doc.save()
+                save += time.perf_counter() - t1
+        rows = sum(n for _t, n in tables)
+        return [_stage("assemble", assemble, rows, "rows"), _stage("save", save, rows, "rows")]
+
+    if name == "full":
+        logger = _quiet_logger()
+        options = ls.BuildOptions(incremental=False, policy=SUITE_POLICY)
+        ignore = ls.IgnoreMatcher.from_patterns(ls.load_ignore_patterns_auto(root))
+        projects = sorted(p for p in (root / "targets").iterdir() if p.is_dir())
+        with tempfile.TemporaryDirectory(prefix="ls-bench-") as tmp:
+            out = Path(tmp)
+            t0 = time.perf_counter()
+            for i, proj in enumerate(projects):
+                ls.process_project(proj, out, ignore, chr(ord("А") + i), logger, options, show_progress=False)
+            dt = time.perf_counter() - t0
+        files = sum(len(fs) for _p, fs in _project_files(root))
+        return [_stage("full", dt, files, "files")]
+
+    raise ValueError(name)
+
+
+SUITE_STAGES = ("walk", "read", "sanitize", "build_xml", "docx", "full")
+UNIT_NAMES = {"files": "файлов/с", "bytes": "МБ/с", "rows": "строк/с"}
+
+
+def _format_rate(rec: dict) -> str:
+    if rec["rate"] is None:
+        return "-"
+    if rec["unit"] == "bytes":
+        return f"{rec['rate'] / 1024 ** 2:,.1f} {UNIT_NAMES['bytes']}"
+    return f"{rec['rate']:,.0f} {UNIT_NAMES[rec['unit']]}"
+
+
+def bench_suite(args: argparse.Namespace) -> int:
+    tmp = None
+    if args.root:
+        root = Path(args.root)
+        gen_stats = None
+    else:
+        tmp = tempfile.TemporaryDirectory(prefix="ls-bench-")
+        root = Path(tmp.name)
+        gen_stats = generate_tree(root, args)
+    try:
+        stages = args.stages.split(",") if args.stages else list(SUITE_STAGES)
+        records: list[dict] = []
+        for name in stages:
+            # свежий процесс на стадию: честный peak RSS и никакого прогрева от соседних стадий
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                recs = pool.submit(run_stage, name, str(root)).result()
+            for rec in recs:
+                rss = f"{rec['peak_rss_mb']:.0f} МБ" if rec["peak_rss_mb"] is not None else "-"
+                print(f"{rec['stage']:<10} {rec['seconds']:9.3f} с  {_format_rate(rec):>22}  RSS {rss}")
+            records.extend(recs)
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+
+    report = {
+        "meta": {
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "generator": None if gen_stats is None else {**vars_of_gen(args), **gen_stats},
+        },
+        "stages": {rec["stage"]: rec for rec in records},
+    }
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=1), encoding="utf-8")
+    if args.baseline:
+        return compare_reports(json.loads(Path(args.baseline).read_text(encoding="utf-8")), report, args.threshold)
+    return 0
+
+
+def vars_of_gen(args: argparse.Namespace) -> dict:
+    keys = ("projects", "files", "lines", "profile", "huge", "huge_mb", "ignored", "binary", "non_utf8", "seed")
+    return {k: getattr(args, k) for k in keys}
+
+
+# ===== compare: регрессии относительно сохранённого прогона =====
+def compare_reports(base: dict, cur: dict, threshold: float, min_seconds: float = 0.05) -> int:
+    """Стадия медленнее базы больше чем на threshold (и дольше min_seconds) — регрессия; код возврата 1."""
+    if base.get("meta", {}).get("generator") != cur.get("meta", {}).get("generator"):
+        print("ВНИМАНИЕ: параметры генератора отличаются, сравнение неточное", file=sys.stderr)
+    regressions = 0
+    for name, rec in cur["stages"].items():
+        old = base["stages"].get(name)
+        if old is None:
+            print(f"{name:<10} нет в базе")
+            continue
+        ratio = rec["seconds"] / old["seconds"] if old["seconds"] > 0 else float("inf")
+        slow = ratio > 1 + threshold and rec["seconds"] >= min_seconds
+        regressions += slow
+        mark = "РЕГРЕССИЯ" if slow else ("быстрее" if ratio < 1 - threshold else "")
+        print(f"{name:<10} {old['seconds']:9.3f} -> {rec['seconds']:9.3f} с  x{ratio:5.2f}  {mark}")
+    return 1 if regressions else 0
+
+
+def bench_compare(args: argparse.Namespace) -> int:
+    base = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+    cur = json.loads(Path(args.current).read_text(encoding="utf-8"))
+    return compare_reports(base, cur, args.threshold)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Замеры производительности ls.py")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_rows = sub.add_parser("rows", help="скорость построения строк таблицы")
+    p_rows.add_argument("--rows", type=int, default=20_000)
+    p_rows.add_argument("--repeat", type=int, default=3)
+    p_rows.set_defaults(func=bench_rows)
+
+    p_san = sub.add_parser("sanitize", help="очистка текста для XML и подготовка строк файла")
+    p_san.add_argument("--chars", type=int, default=2_000_000)
+    p_san.add_argument("--repeat", type=int, default=3)
+    p_san.set_defaults(func=bench_sanitize)
+
+    p_big = sub.add_parser("bigfile", help="память и время на большом файле: целиком против mmap-потока")
+    p_big.add_argument("--mb", type=int, default=64)
+    p_big.set_defaults(func=bench_bigfile)
+
+    p_ra = sub.add_parser("readahead", help="рендер с чтением файлов впереди против чтения по одному")
+    p_ra.add_argument("--latency-ms", type=float, default=5.0, help="имитируемая задержка чтения одного файла")
+    _add_gen_arguments(p_ra)
+    p_ra.set_defaults(func=bench_readahead)
+
+    p_def = sub.add_parser("deflate", help="сжатие document.xml: один поток zlib против параллельных блоков")
+    p_def.add_argument("--mb", type=int, default=32)
+    p_def.add_argument("--threads", type=int, default=0, help="0 — по числу ядер")
+    p_def.set_defaults(func=bench_deflate)
+
+    p_lay = sub.add_parser("layout", help="раскладка таблицы rows против compact: элементы XML, сборка, открытие")
+    p_lay.add_argument("--lines", type=int, default=BENCH_DOC_ROWS)
+    p_lay.add_argument("--repeat", type=int, default=3)
+    p_lay.add_argument("--soffice", action="store_true", help="замерить открытие в LibreOffice (--convert-to pdf)")
+    p_lay.set_defaults(func=bench_layout)
+
+    p_gen = sub.add_parser("gen", help="сгенерировать синтетическое дерево targets/ в DIR")
+    p_gen.add_argument("dir")
+    _add_gen_arguments(p_gen)
+    p_gen.set_defaults(func=bench_gen)
+
+    p_suite = sub.add_parser("suite", help="время каждой стадии на синтетическом (или готовом) дереве")
+    p_suite.add_argument("--root", help="готовое дерево (root/targets, root/ignore.txt) вместо генерации")
+    p_suite.add_argument("--stages", help=f"через запятую из: {','.join(SUITE_STAGES)}")
+    p_suite.add_argument("--json", help="куда сохранить отчёт")
+    p_suite.add_argument("--baseline", help="отчёт для сравнения; при регрессии код возврата 1")
+    p_suite.add_argument("--threshold", type=float, default=0.10, help="допустимое замедление стадии (доля)")
+    _add_gen_arguments(p_suite)
+    p_suite.set_defaults(func=bench_suite)
+
+    p_cmp = sub.add_parser("compare", help="сравнить два отчёта suite")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("current")
+    p_cmp.add_argument("--threshold", type=float, default=0.10)
+    p_cmp.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,14 +1,47 @@
 import argparse
+import codecs
+import csv
+import cProfile
+import ctypes
+import ctypes.util
+import hashlib
+import heapq
+import io
+import json
 import logging
+import mmap
+import multiprocessing
+import os
+import re
+import select
+import shutil
+import struct
+import subprocess
 import sys
-from pathlib import Path
-from fnmatch import fnmatch
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+import unicodedata
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import islice
+from pathlib import Path, PurePosixPath
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
 
 import docx
 from docx.shared import Pt
-from docx.oxml import OxmlElement, parse_xml
+import docx.oxml
+from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
+from docx.opc.oxml import serialize_part_xml
+from docx.opc.pkgwriter import PackageWriter
 from docx.enum.style import WD_STYLE_TYPE
+from lxml import etree
 
 try:
     from progress.bar import IncrementalBar
@@ -24,6 +57,10 @@ except Exception:
 
 # ===== Настройки =====
 MAX_DOC_CHARS = 800_000  # лимит символов кода на один docx (по тексту файлов)
+# лимиты ниже по умолчанию выключены (0), чтобы документы делились как раньше, только по символам;
+# включаются --max-doc-rows / --max-doc-xml
+MAX_DOC_ROWS = 0  # лимит строк таблицы: Word открывает и перестраивает длинные таблицы минутами (разумно ~30 000)
+MAX_DOC_XML_BYTES = 0  # лимит оценки объёма word/document.xml (разумно ~64 МБ)
 
 # ГОСТ 19.106-78
 CODE_FONT_NAME = "Courier New"
@@ -32,6 +69,50 @@ CODE_FONT_SIZE_PT = 12
 # Колонки таблицы (мм)
 NUM_COL_WIDTH_MM = 16
 CODE_COL_WIDTH_MM = 170
+CELL_PAD_MM = 1.9  # отступ текста в ячейке Word по умолчанию, слева и справа
+
+# Раскладка таблицы листинга (--layout): rows — строка таблицы на строку кода;
+# compact — строка таблицы на COMPACT_ROW_LINES строк кода, строки внутри ячеек через w:br,
+# длинные строки заранее разрезаны по ширине ячейки (у переноса нет номера)
+LAYOUTS = ("rows", "compact")
+COMPACT_ROW_LINES = 50
+WORD_TAB_COLS = 5  # позиции табуляции Word по умолчанию (720 twips) в знаках Courier New 12
+
+# PDF (--writer pdf): A4; колонка кода сужается до ширины между полями
+PDF_PAGE_MM = (210, 297)
+PDF_MARGINS_MM = (20, 15, 10, 15)  # слева, сверху, справа, снизу
+PDF_CELL_PAD_MM = CELL_PAD_MM  # отступ текста в ячейке, как у ячеек Word по умолчанию
+PDF_TAB_SIZE = 4
+# моноширинный TTF для встраивания: первый найденный (--pdf-font задаёт свой)
+PDF_FONT_CANDIDATES = (
+    "C:/Windows/Fonts/cour.ttf",
+    "/usr/share/fonts/truetype/msttcorefonts/cour.ttf",
+    "/usr/share/fonts/truetype/msttcorefonts/Courier_New.ttf",
+    "/Library/Fonts/Courier New.ttf",
+    "/System/Library/Fonts/Supplemental/Courier New.ttf",
+    "/usr/share/fonts/truetype/liberation2/LiberationMono-Regular.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationMono-Regular.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSansMono.ttf",
+)
+
+# сжатие docx: уровень zlib (0 — без сжатия, для промежуточных сборок) и блоки параллельного deflate
+ZIP_LEVEL = 6
+DEFLATE_BLOCK = 256 * 1024
+DEFLATE_THREADS = 1  # 1 — обычный zipfile в одном потоке; 0 — по числу ядер
+
+# чтение файлов впереди рендера в потоках (без --file-jobs): сколько байт держать прочитанными заранее
+READ_AHEAD_BYTES = 16 * 1024 * 1024
+READ_AHEAD_THREADS = 4
+
+# кэш отрендеренных таблиц (listing_out/.listing-cache): лимит размера, старые записи вытесняются
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# --watch: тишина после последнего изменения перед пересборкой и период опроса без inotify
+WATCH_DEBOUNCE_S = 0.25
+WATCH_POLL_S = 1.0
+
+# статус без терминала (CI): строка JSON в stdout не чаще раза в столько секунд, см. StatusSink
+STATUS_EVERY_S = 10.0
 
 APP_NAME = "GOST Listing Generator"
 
@@ -103,26 +184,23 @@ def app_dir() -> Path:
     return Path(__file__).resolve().parent
 
 
+# допустимые в XML 1.0 символы: \t \n \r, U+0020–U+D7FF, U+E000–U+FFFD, U+10000–U+10FFFF
+_XML_INVALID_RE = re.compile("[^\t\n\r\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+_XML_INVALID_ASCII_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
 def xml_safe_text(s: str) -> str:
-    out = []
-    for ch in s:
-        code = ord(ch)
-        if code in (0x9, 0xA, 0xD):
-            out.append(ch)
-        elif 0x20 <= code <= 0xD7FF:
-            out.append(ch)
-        elif 0xE000 <= code <= 0xFFFD:
-            out.append(ch)
-        elif 0x10000 <= code <= 0x10FFFF:
-            out.append(ch)
-        else:
-            continue
-    return "".join(out)
+    """Убирает символы, недопустимые в XML. Если таких нет — возвращает s без копирования."""
+    rx = _XML_INVALID_ASCII_RE if s.isascii() else _XML_INVALID_RE
+    if rx.search(s) is None:
+        return s
+    return rx.sub("", s)
 
 
 # ===== Первичная инициализация окружения =====
 IGNORE_TEMPLATE = """# ignore.txt — маски исключений (fnmatch)
-# Строки с # — комментарии.
+# Строки с # — комментарии. !маска — вернуть то, что исключено правилами выше.
+# Такой же файл .listingignore можно положить в любую папку проекта.
 # Примеры:
 # __pycache__/
 # .git/
@@ -182,12 +260,16 @@ def normalize_patterns(lines: list[str]) -> list[str]:
         if not s or s.startswith("#"):
             continue
 
+        neg = ""
+        if s.startswith("!"):
+            neg, s = "!", s[1:]
+
         # удобство: ".env" -> "*.env" (если это не путь и без wildcard)
         if s.startswith(".") and ("/" not in s) and ("*" not in s) and ("?" not in s) and ("[" not in s):
             s = f"*{s}"
 
         s = s.replace("\\", "/")
-        patterns.append(s)
+        patterns.append(neg + s)
     return patterns
 
 
@@ -202,49 +284,741 @@ def load_ignore_patterns_auto(base: Path) -> list[str]:
     return []
 
 
-def is_ignored(rel_posix: str, name: str, patterns: list[str]) -> bool:
-    for pat in patterns:
-        # директория: 'build/'
-        if pat.endswith("/"):
-            d = pat[:-1]
-            if rel_posix == d or rel_posix.startswith(d + "/"):
-                return True
-            if f"/{d}/" in f"/{rel_posix}/":
-                return True
-            continue
+# ===== Ignore: правила компилируются один раз в IgnoreMatcher =====
+LOCAL_IGNORE_NAME = ".listingignore"  # ignore.txt для отдельной папки проекта (те же правила)
+GITIGNORE_NAME = ".gitignore"
 
-        anchored = pat.startswith("/")
-        p = pat[1:] if anchored else pat
+# fnmatch сравнивает через os.path.normcase — на Windows без учёта регистра
+_LEGACY_IGNORECASE = os.name == "nt"
 
-        if anchored:
-            if fnmatch(rel_posix, p):
-                return True
+
+class IgnoreRule(NamedTuple):
+    """
+    Одно правило. file_re/dir_re — регулярки по пути от корня проекта (папки — с '/' на конце);
+    name/suffix — быстрый путь для масок вида 'name' и '*.ext' по имени файла.
+    """
+
+    negate: bool
+    file_re: Optional[str]
+    dir_re: Optional[str]
+    name: Optional[str] = None
+    suffix: Optional[str] = None
+
+
+def _glob_to_re(pat: str, star: str, one: str, escapes: bool) -> str:
+    out: list[str] = []
+    i, n = 0, len(pat)
+    while i < n:
+        c = pat[i]
+        if c == "*":
+            if pat.startswith("**", i):
+                j = i + 2
+                # '**/' в начале или после '/' — ноль или больше папок
+                if (i == 0 or pat[i - 1] == "/") and j < n and pat[j] == "/":
+                    out.append("(?:.*/)?")
+                    i = j + 1
+                    continue
+                out.append(".*")
+                i = j
+                continue
+            out.append(star)
+            i += 1
+        elif c == "?":
+            out.append(one)
+            i += 1
+        elif c == "[":
+            j = i + 1
+            if j < n and pat[j] in "!^":
+                j += 1
+            if j < n and pat[j] == "]":
+                j += 1
+            while j < n and pat[j] != "]":
+                j += 1
+            if j >= n:
+                out.append("\\[")
+                i += 1
+                continue
+            stuff = pat[i + 1:j].replace("\\", "\\\\")
+            if stuff[0] in "!^":
+                stuff = "^" + stuff[1:]
+            out.append(f"[{stuff}]")
+            i = j + 1
+        elif c == "\\" and escapes and i + 1 < n:
+            out.append(re.escape(pat[i + 1]))
+            i += 2
         else:
-            if fnmatch(rel_posix, p) or fnmatch(name, p):
-                return True
-    return False
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+def _has_magic(s: str) -> bool:
+    return any(ch in s for ch in "*?[\\")
+
+
+def compile_ignore_patterns(patterns: list[str], base: str = "") -> list[IgnoreRule]:
+    """
+    Маски ignore.txt (после normalize_patterns) — fnmatch-семантика, как раньше:
+    'dir/' — папка с таким именем на любом уровне (или от корня, если начинается с '/');
+    '/mask' — по пути от корня, где '*' захватывает и '/'; 'mask' — по пути или по имени файла.
+    Дополнительно: '!' — исключение из исключений, '**/' — любое число папок.
+    base — папка, где лежит файл с правилами ('' или 'sub/dir/').
+    """
+    prefix = re.escape(base)
+    flags = "(?i)" if _LEGACY_IGNORECASE else ""
+    rules: list[IgnoreRule] = []
+    for s in patterns:
+        negate = s.startswith("!")
+        if negate:
+            s = s[1:]
+        if not s:
+            continue
+
+        if s.endswith("/"):
+            d = s[:-1]
+            anchored = d.startswith("/")
+            d = d.lstrip("/")
+            lead = "" if anchored else "(?:.*/)?"
+            rx = f"{flags}{prefix}{lead}{_glob_to_re(d, '[^/]*', '[^/]', False)}(?:/.*)?"
+            rules.append(IgnoreRule(negate, rx, rx))
+            continue
+
+        anchored = s.startswith("/")
+        p = s[1:] if anchored else s
+        full = _glob_to_re(p, ".*", ".", False)
+        # папка отсекается целиком, только если под маску подходит любой путь внутри неё
+        dir_re = f"{flags}{prefix}{full}" if p.endswith("*") else None
+
+        if not anchored and "/" not in p and not base and not _LEGACY_IGNORECASE:
+            if not _has_magic(p):
+                rules.append(IgnoreRule(negate, None, dir_re, name=p))
+                continue
+            if p.startswith("*") and not _has_magic(p[1:]):
+                rules.append(IgnoreRule(negate, None, dir_re, suffix=p[1:]))
+                continue
+
+        alts = [f"{prefix}{full}"]
+        if not anchored and "/" not in p:
+            alts.append(f"{prefix}(?:.*/)?{_glob_to_re(p, '[^/]*', '[^/]', False)}")
+        rules.append(IgnoreRule(negate, flags + "(?:" + "|".join(alts) + ")", dir_re))
+    return rules
+
+
+def parse_gitignore(text: str, base: str = "") -> list[IgnoreRule]:
+    """Правила .gitignore с семантикой git; base — папка, где лежит файл."""
+    prefix = re.escape(base)
+    rules: list[IgnoreRule] = []
+    for raw in text.splitlines():
+        s = raw
+        # хвостовые пробелы отбрасываются, если не экранированы
+        while s.endswith(" ") and not s.endswith("\\ "):
+            s = s[:-1]
+        if not s or s.startswith("#"):
+            continue
+
+        negate = False
+        if s.startswith("!"):
+            negate = True
+            s = s[1:]
+        elif s.startswith("\\!") or s.startswith("\\#"):
+            s = s[1:]
+
+        dir_only = s.endswith("/")
+        s = s.rstrip("/")
+        if not s:
+            continue
+        anchored = "/" in s
+        s = s.lstrip("/")
+
+        lead = "" if anchored else "(?:.*/)?"
+        body = f"{prefix}{lead}{_glob_to_re(s, '[^/]*', '[^/]', True)}"
+        dir_re = body + "/"
+
+        if not dir_only and not anchored and not base:
+            if not _has_magic(s):
+                rules.append(IgnoreRule(negate, None, dir_re, name=s))
+                continue
+            if s.startswith("*") and not s.startswith("**") and not _has_magic(s[1:]):
+                rules.append(IgnoreRule(negate, None, dir_re, suffix=s[1:]))
+                continue
+
+        rules.append(IgnoreRule(negate, None if dir_only else body, dir_re))
+    return rules
+
+
+class _RuleRun(NamedTuple):
+    negate: bool
+    names: frozenset
+    suffixes: tuple
+    file_rx: Optional[re.Pattern]
+    dir_rx: Optional[re.Pattern]
+
+
+def _combine(alts: list[str]) -> Optional[re.Pattern]:
+    if not alts:
+        return None
+    parts = [f"(?i:{a[4:]})" if a.startswith("(?i)") else f"(?:{a})" for a in alts]
+    return re.compile("(?:" + "|".join(parts) + r")\Z", re.S)
+
+
+def _compile_run(negate: bool, rules: list[IgnoreRule]) -> _RuleRun:
+    names = frozenset(r.name for r in rules if r.name is not None)
+    suffixes = tuple(r.suffix for r in rules if r.suffix is not None)
+    file_alts = [r.file_re for r in rules if r.file_re is not None]
+    dir_alts = [r.dir_re for r in rules if r.dir_re is not None]
+
+    return _RuleRun(negate, names, suffixes, _combine(file_alts), _combine(dir_alts))
+
+
+class IgnoreMatcher:
+    """
+    Все правила проекта, скомпилированные в несколько объединённых регулярок.
+    Правила идут подряд, решает последнее совпавшее (как в git); подряд идущие правила
+    одного знака объединяются в одну проверку, поэтому без '!' это один проход.
+    Если папка исключена, её содержимое не возвращается и через '!' (как в git).
+    """
+
+    def __init__(self, rules: list[IgnoreRule] = (), gitignore: bool = False):
+        self.rules = list(rules)
+        self.gitignore = gitignore
+        runs: list[_RuleRun] = []
+        start = 0
+        for k in range(1, len(self.rules) + 1):
+            if k == len(self.rules) or self.rules[k].negate != self.rules[start].negate:
+                runs.append(_compile_run(self.rules[start].negate, self.rules[start:k]))
+                start = k
+        self._runs = runs[::-1]
+
+    @classmethod
+    def from_patterns(cls, patterns: list[str], gitignore: bool = False) -> "IgnoreMatcher":
+        rules = compile_ignore_patterns(patterns)
+        if gitignore:
+            rules += parse_gitignore(".git/")
+        return cls(rules, gitignore=gitignore)
+
+    def extend(self, rules: list[IgnoreRule]) -> "IgnoreMatcher":
+        if not rules:
+            return self
+        return IgnoreMatcher(self.rules + rules, gitignore=self.gitignore)
+
+    def with_dir_files(self, dir_path: Path, rel_dir: str, names) -> "IgnoreMatcher":
+        """Подключить .gitignore (если включено) и .listingignore, лежащие в папке."""
+        rules: list[IgnoreRule] = []
+        if self.gitignore and GITIGNORE_NAME in names:
+            text = _read_rules_file(dir_path / GITIGNORE_NAME)
+            rules += parse_gitignore(text, base=rel_dir)
+        if LOCAL_IGNORE_NAME in names:
+            text = _read_rules_file(dir_path / LOCAL_IGNORE_NAME)
+            rules += compile_ignore_patterns(normalize_patterns(text.splitlines()), base=rel_dir)
+        return self.extend(rules)
+
+    def match_file(self, rel_posix: str, name: str) -> bool:
+        for run in self._runs:
+            if (
+                name in run.names
+                or (run.suffixes and name.endswith(run.suffixes))
+                or (run.file_rx is not None and run.file_rx.match(rel_posix))
+            ):
+                return not run.negate
+        return False
+
+    def match_dir(self, rel_posix: str) -> bool:
+        rel_dir = rel_posix + "/"
+        for run in self._runs:
+            if run.dir_rx is not None and run.dir_rx.match(rel_dir):
+                return not run.negate
+        return False
+
+
+def _read_rules_file(path: Path) -> str:
+    try:
+        return path.read_text(encoding="utf-8", errors="ignore")
+    except OSError:
+        return ""
+
+
+def _dir_identity(path: Path) -> Optional[tuple[int, int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
 
 
-def iter_project_files(project_dir: Path, out_root: Path, patterns: list[str]) -> list[Path]:
+def iter_project_files(project_dir: Path, out_root: Path, ignore: IgnoreMatcher) -> list[Path]:
+    """
+    Обход через os.scandir: игнорируемые папки и listing_out отсекаются до спуска в них,
+    тип записи берётся из scandir без лишнего stat. По пути подключаются .listingignore
+    (и .gitignore, если включено) из папок проекта. Символьные ссылки на папки не обходятся
+    (как у rglob), ссылки на файлы попадают в список.
+    """
+    out_id = _dir_identity(out_root)
     files: list[Path] = []
-    for p in project_dir.rglob("*"):
-        if not p.is_file():
+
+    stack = [(str(project_dir), "", ignore)]
+    while stack:
+        dir_path, rel_dir, matcher = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
             continue
 
-        # если вдруг listing_out внутри проекта
+        names = {e.name for e in entries}
+        if LOCAL_IGNORE_NAME in names or (matcher.gitignore and GITIGNORE_NAME in names):
+            matcher = matcher.with_dir_files(Path(dir_path), rel_dir, names)
+
+        for e in entries:
+            rel = rel_dir + e.name
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    # если вдруг listing_out внутри проекта
+                    if out_id is not None and e.inode() == out_id[1] and e.stat(follow_symlinks=False).st_dev == out_id[0]:
+                        continue
+                    if matcher.match_dir(rel):
+                        continue
+                    stack.append((e.path, rel + "/", matcher))
+                    continue
+                if not e.is_file():
+                    continue
+            except OSError:
+                continue
+
+            if matcher.match_file(rel, e.name):
+                continue
+
+            files.append(Path(e.path))
+
+    return sorted(files, key=lambda x: x.as_posix().lower())
+
+
+# ===== Исходники из git без рабочей копии (--git-rev) =====
+# Проект — репозиторий (можно голый: git clone --bare URL targets/имя), файлы — дерево ревизии.
+# GitFile ведёт себя для конвейера как Path: name, relative_to, stat, open, read_text;
+# содержимое блобов идёт через один долгоживущий `git cat-file --batch` на репозиторий.
+class GitStat(NamedTuple):
+    st_size: int
+    st_mtime_ns: int
+
+
+class GitFile(NamedTuple):
+    """Блоб из дерева ревизии. Вместо mtime — начало id блоба: меняется вместе с содержимым."""
+
+    repo: str
+    rel: str
+    oid: str
+    size: int
+
+    @property
+    def name(self) -> str:
+        return self.rel.rsplit("/", 1)[-1]
+
+    def relative_to(self, _project_dir) -> PurePosixPath:
+        return PurePosixPath(self.rel)
+
+    def as_posix(self) -> str:
+        return f"{Path(self.repo).as_posix()}/{self.rel}"
+
+    def stat(self) -> GitStat:
+        return GitStat(self.size, int(self.oid[:15], 16))
+
+    def open(self, mode: str = "rb"):
+        """Большой блоб (STREAM_MIN_BYTES) — во временный файл, чтобы читать его кусками, как с диска."""
+        if self.size >= STREAM_MIN_BYTES:
+            fh = tempfile.TemporaryFile()
+            cat_file(self.repo).read(self.oid, fh)
+            fh.seek(0)
+            return fh
+        return io.BytesIO(cat_file(self.repo).read(self.oid))
+
+    def read_text(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        return cat_file(self.repo).read(self.oid).decode(encoding, errors)
+
+
+class _TreeDir(NamedTuple):
+    """Папка дерева (walk_tree) для IgnoreMatcher.with_dir_files: dir / имя -> GitFile или ArchiveFile."""
+
+    entries: dict
+
+    def __truediv__(self, name: str):
+        return self.entries[name]
+
+
+class CatFile:
+    """`git cat-file --batch` одного репозитория: запрос — id блоба, ответ — заголовок и байты."""
+
+    def __init__(self, repo: str):
         try:
-            p.relative_to(out_root)
+            self.proc = subprocess.Popen(
+                ["git", "-C", repo, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise OSError("git не найден в PATH") from None
+        self.lock = threading.Lock()  # чтение впереди ходит сюда из нескольких потоков
+
+    def read(self, oid: str, sink=None) -> Optional[bytes]:
+        """Байты блоба; с sink — записываются в sink кусками по STREAM_CHUNK, в памяти не держатся."""
+        with self.lock:
+            self.proc.stdin.write(oid.encode("ascii") + b"\n")
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3 or header[1] != b"blob":
+                raise OSError(f"git cat-file: нет блоба {oid}")
+            left = int(header[2])
+            if sink is None:
+                data = self.proc.stdout.read(left)
+            else:
+                data = None
+                while left:
+                    chunk = self.proc.stdout.read(min(left, STREAM_CHUNK))
+                    sink.write(chunk)
+                    left -= len(chunk)
+            self.proc.stdout.read(1)  # перевод строки после содержимого
+            return data
+
+
+_CAT_FILES: dict[str, tuple[int, CatFile]] = {}
+_CAT_FILES_LOCK = threading.Lock()
+
+
+def cat_file(repo: str) -> CatFile:
+    """CatFile репозитория в этом процессе: после fork (--file-jobs) процесс заводит свой."""
+    with _CAT_FILES_LOCK:
+        pid, cf = _CAT_FILES.get(repo, (0, None))
+        if cf is None or pid != os.getpid():
+            cf = CatFile(repo)
+            _CAT_FILES[repo] = (os.getpid(), cf)
+        return cf
+
+
+def git_output(repo: Path, *args: str) -> bytes:
+    try:
+        res = subprocess.run(["git", "-C", str(repo), *args], capture_output=True)
+    except FileNotFoundError:
+        raise OSError("git не найден в PATH") from None
+    if res.returncode != 0:
+        raise RuntimeError(f"git {args[0]} в {repo}: {res.stderr.decode('utf-8', 'replace').strip()}")
+    return res.stdout
+
+
+def git_commit(repo: Path, rev: str) -> str:
+    """id коммита ревизии rev (тег, ветка, сокращённый id); нет такой — RuntimeError."""
+    return git_output(repo, "rev-parse", "--verify", "--end-of-options", f"{rev}^{{commit}}").decode().strip()
+
+
+def ls_tree(repo: Path, rev: str) -> list[GitFile]:
+    """Все файлы дерева ревизии rev, без правил ignore. Подмодули и символьные ссылки пропускаются."""
+    listing = git_output(repo, "ls-tree", "-r", "-z", "--long", "--full-tree", git_commit(repo, rev))
+    files: list[GitFile] = []
+    for rec in listing.split(b"\0"):
+        if not rec:
             continue
-        except ValueError:
-            pass
+        meta, raw = rec.split(b"\t", 1)
+        mode, kind, oid, size = meta.split()
+        if kind != b"blob" or mode == b"120000":
+            continue
+        files.append(GitFile(str(repo), raw.decode("utf-8", "surrogateescape"), oid.decode(), int(size)))
+    return files
+
+
+def iter_git_files(repo: Path, rev: str, ignore: IgnoreMatcher) -> list[GitFile]:
+    """
+    Как iter_project_files, но по дереву ревизии rev: те же ignore.txt, .listingignore и .gitignore
+    (из самого дерева) и тот же порядок.
+    """
+    return walk_tree(ls_tree(repo, rev), ignore)
+
+
+def walk_tree(files: list, ignore: IgnoreMatcher) -> list:
+    """
+    Отбор и порядок iter_project_files для файлов не с диска (GitFile, ArchiveFile — у них есть rel):
+    папки по правилам match_dir отсекаются целиком, .listingignore и .gitignore берутся из самого дерева.
+    """
+    dirs: dict[str, dict] = {"": {}}  # папка -> имя -> файл (None — подпапка)
+    for f in files:
+        parent = ""
+        for part in f.rel.split("/")[:-1]:
+            dirs[parent].setdefault(part, None)
+            parent += part + "/"
+            dirs.setdefault(parent, {})
+        dirs[parent][f.rel[len(parent):]] = f
+
+    out = []
+    stack = [("", ignore)]
+    while stack:
+        rel_dir, matcher = stack.pop()
+        entries = dirs[rel_dir]
+        names = set(entries)
+        if LOCAL_IGNORE_NAME in names or (matcher.gitignore and GITIGNORE_NAME in names):
+            matcher = matcher.with_dir_files(_TreeDir(entries), rel_dir, names)
+        for name, f in entries.items():
+            rel = rel_dir + name
+            if f is None:
+                if not matcher.match_dir(rel):
+                    stack.append((rel + "/", matcher))
+            elif not matcher.match_file(rel, name):
+                out.append(f)
+
+    return sorted(out, key=lambda f: f.rel.lower())
 
-        rel = p.relative_to(project_dir).as_posix()
-        if is_ignored(rel, p.name, patterns):
+
+# ===== Архивы как проекты (targets/*.zip, *.tar, *.tar.gz, ...) =====
+# Архив читается так, будто его распаковали в targets/<имя без расширения>/, но без распаковки:
+# zip — члены по центральному каталогу, tar — с известных смещений данных; сжатый tar нельзя
+# читать вразбивку, поэтому он один раз последовательно распаковывается в один файл-копию
+# (SPOOL_DIR_NAME в listing_out, удаляется после сборки) — без тысяч мелких файлов и без памяти.
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+SPOOL_DIR_NAME = ".listing-spool"
+
+
+def archive_project_name(name: str) -> Optional[str]:
+    """Имя проекта по имени файла архива ("app-1.2.tar.gz" -> "app-1.2"); не архив — None."""
+    low = name.lower()
+    for suffix in ARCHIVE_SUFFIXES:
+        if low.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+class ArchiveProject(NamedTuple):
+    """Архив в targets/ на месте папки проекта: для конвейера нужны только name и list_project_files."""
+
+    path: Path
+
+    @property
+    def name(self) -> str:
+        return archive_project_name(self.path.name)
+
+
+def find_projects(targets: Path) -> list:
+    """
+    Проекты targets/: папки и архивы, по имени без учёта регистра. Архив, имя которого без учёта
+    регистра совпадает с папкой или другим архивом (Foo/ и foo.zip, X.zip и X.tar.gz), — ValueError:
+    оба писали бы в одну папку listing_out (на Windows и macOS регистр имён не различается).
+    """
+    projects = []
+    for p in targets.iterdir():
+        if p.is_dir():
+            projects.append(p)
+        elif archive_project_name(p.name) and p.is_file():
+            projects.append(ArchiveProject(p))
+    projects.sort(key=lambda p: p.name.lower())
+    for a, b in zip(projects, projects[1:]):
+        if a.name.lower() == b.name.lower() and (isinstance(a, ArchiveProject) or isinstance(b, ArchiveProject)):
+            a_path = a.path if isinstance(a, ArchiveProject) else a
+            b_path = b.path if isinstance(b, ArchiveProject) else b
+            raise ValueError(f"проекты с одним именем: {a_path} и {b_path}")
+    return projects
+
+
+class _Slice(io.RawIOBase):
+    """size байт файла path с offset — большой член tar читается кусками, не целиком."""
+
+    def __init__(self, path: str, offset: int, size: int):
+        super().__init__()
+        self._fh = open(path, "rb")
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self._size - self._pos)
+        if n <= 0:
+            return 0
+        self._fh.seek(self._offset + self._pos)
+        data = self._fh.read(n)
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, pos: int, whence: int = 0) -> int:
+        base = {0: 0, 1: self._pos, 2: self._size}[whence]
+        self._pos = max(0, base + pos)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        self._fh.close()
+        super().close()
+
+
+class ArchiveFile(NamedTuple):
+    """
+    Член архива. zip — по имени member; tar (member пустой) — size байт с offset в файле data:
+    в самом .tar или в распакованной копии сжатого. Вместо mtime — время из архива
+    (у zip ещё и CRC: время там с точностью до 2 с).
+    """
+
+    archive: str
+    rel: str
+    member: str
+    size: int
+    mtime_ns: int
+    data: str = ""
+    offset: int = 0
+
+    @property
+    def name(self) -> str:
+        return self.rel.rsplit("/", 1)[-1]
+
+    def relative_to(self, _project_dir) -> PurePosixPath:
+        return PurePosixPath(self.rel)
+
+    def as_posix(self) -> str:
+        return f"{Path(self.archive).as_posix()}/{self.rel}"
+
+    def stat(self) -> GitStat:
+        return GitStat(self.size, self.mtime_ns)
+
+    def open(self, mode: str = "rb"):
+        big = self.size >= STREAM_MIN_BYTES
+        if self.member:
+            zf = _open_zip(self.archive)
+            return zf.open(self.member) if big else io.BytesIO(zf.read(self.member))
+        if big:
+            return _Slice(self.data, self.offset, self.size)
+        with open(self.data, "rb") as fh:
+            fh.seek(self.offset)
+            return io.BytesIO(fh.read(self.size))
+
+    def read_text(self, encoding: str = "utf-8", errors: str = "strict") -> str:
+        with self.open() as fh:
+            return fh.read().decode(encoding, errors)
+
+
+_ZIPS: dict[str, tuple[int, zipfile.ZipFile]] = {}
+_ZIPS_LOCK = threading.Lock()
+
+
+def _open_zip(archive: str) -> zipfile.ZipFile:
+    """Открытый zip в этом процессе (чтение членов из нескольких потоков zipfile допускает)."""
+    with _ZIPS_LOCK:
+        pid, zf = _ZIPS.get(archive, (0, None))
+        if zf is None or pid != os.getpid():
+            zf = zipfile.ZipFile(archive)
+            _ZIPS[archive] = (os.getpid(), zf)
+        return zf
+
+
+def _member_rel(name: str) -> Optional[str]:
+    """Путь члена архива относительно корня: без "./" и ведущего "/"; с ".." — None (не берём)."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts:
+        return None
+    return "/".join(parts)
+
+
+def _zip_members(archive: Path) -> list[ArchiveFile]:
+    files = []
+    for i in _open_zip(str(archive)).infolist():
+        rel = _member_rel(i.filename)
+        if rel is None or i.is_dir() or (i.external_attr >> 16) & 0o170000 == 0o120000:
             continue
+        secs = int(time.mktime(i.date_time + (0, 0, -1)))
+        files.append(ArchiveFile(str(archive), rel, i.filename, i.file_size, (secs << 32) | i.CRC))
+    return files
+
+
+def _tar_members(archive: Path, spool_dir: Path) -> list[ArchiveFile]:
+    """Обычный tar — заголовки со смещениями данных; сжатый — через копию в spool_dir (spool_tar)."""
+    try:
+        tf = tarfile.open(archive, "r:")
+    except tarfile.ReadError:
+        return spool_tar(archive, spool_dir)
+    files = []
+    with tf:
+        for m in tf:
+            rel = _member_rel(m.name)
+            if rel is not None and m.isreg():
+                files.append(ArchiveFile(str(archive), rel, "", m.size, int(m.mtime) * 10**9, str(archive), m.offset_data))
+    return files
+
+
+def spool_tar(archive: Path, spool_dir: Path) -> list[ArchiveFile]:
+    """
+    Сжатый tar: один проход распаковки, данные всех обычных файлов подряд в один файл
+    spool_dir/<ключ>.data и оглавление рядом. Ключ — путь, размер и mtime архива, поэтому
+    повторные обходы (вес для --jobs, сама сборка, процессы --jobs) распаковывают архив один раз.
+    """
+    st = archive.stat()
+    key = hashlib.sha256(f"{archive.resolve()}\0{st.st_size}\0{st.st_mtime_ns}".encode("utf-8", "surrogateescape"))
+    data = spool_dir / f"{key.hexdigest()[:32]}.data"
+    index = data.with_suffix(".json")
+    try:
+        members = json.loads(index.read_text(encoding="utf-8"))["members"]
+    except (OSError, ValueError):
+        spool_dir.mkdir(parents=True, exist_ok=True)
+        tmp = data.with_name(f"{data.name}.{os.getpid()}.tmp")
+        members = []
+        with tarfile.open(archive, "r|*") as tf, open(tmp, "wb") as out:
+            for m in tf:
+                rel = _member_rel(m.name)
+                if rel is None or not m.isreg():
+                    continue
+                members.append([rel, m.size, int(m.mtime) * 10**9, out.tell()])
+                shutil.copyfileobj(tf.extractfile(m), out, STREAM_CHUNK)
+        os.replace(tmp, data)
+        write_manifest_data(index, {"archive": str(archive), "members": members})
+    return [ArchiveFile(str(archive), rel, "", size, mtime_ns, str(data), offset) for rel, size, mtime_ns, offset in members]
+
+
+def iter_archive_files(archive: Path, out_root: Path, ignore: IgnoreMatcher) -> list[ArchiveFile]:
+    """
+    Как iter_project_files, но по членам архива: те же правила ignore и тот же порядок.
+    Если всё лежит в одной папке с именем проекта (app.zip -> app/...), как у выгрузок
+    с GitHub и `tar -czf app.tar.gz app`, пути считаются от неё.
+    """
+    if archive.name.lower().endswith(".zip"):
+        files = _zip_members(archive)
+    else:
+        files = _tar_members(archive, out_root / SPOOL_DIR_NAME)
+    top = archive_project_name(archive.name) + "/"
+    if files and all(f.rel.startswith(top) for f in files):
+        files = [f._replace(rel=f.rel[len(top):]) for f in files]
+    return walk_tree(files, ignore)
 
-        files.append(p)
 
-    return sorted(files, key=lambda x: x.as_posix().lower())
+def archive_weight(archive: Path) -> int:
+    """
+    Объём файлов архива без обхода членов: zip — по центральному каталогу, .tar.gz — несжатый
+    размер из хвоста gzip (по модулю 4 ГБ, поэтому не меньше размера архива), прочие — размер файла.
+    """
+    low = archive.name.lower()
+    try:
+        if low.endswith(".zip"):
+            with zipfile.ZipFile(archive) as zf:
+                return sum(i.file_size for i in zf.infolist())
+        size = archive.stat().st_size
+        if low.endswith((".tar.gz", ".tgz")):
+            with open(archive, "rb") as fh:
+                fh.seek(-4, os.SEEK_END)
+                (isize,) = struct.unpack("<I", fh.read(4))
+            return max(size, isize)
+        return size
+    except (OSError, zipfile.BadZipFile, struct.error):
+        return 0
+
+
+def drop_spools(listing_out: Path) -> None:
+    """Копии сжатых tar после сборки не нужны — место на диске как у распакованного архива."""
+    shutil.rmtree(listing_out / SPOOL_DIR_NAME, ignore_errors=True)
+
+
+def list_project_files(project_dir: Path, out_root: Path, ignore: IgnoreMatcher, git_rev: str = "") -> list:
+    """Файлы проекта: из архива, из папки или, если задана ревизия (--git-rev), из дерева репозитория."""
+    if isinstance(project_dir, ArchiveProject):
+        return iter_archive_files(project_dir.path, out_root, ignore)
+    if git_rev:
+        return iter_git_files(project_dir, git_rev, ignore)
+    return iter_project_files(project_dir, out_root, ignore)
 
 
 # ===== DOCX: стили и заголовки =====
@@ -278,10 +1052,15 @@ def add_header(doc: docx.Document, appendix_label: str) -> None:
     pf.line_spacing = 1.0
 
 
-def add_listing_heading(doc: docx.Document, listing_no: int, rel_name: str, part_suffix: str = ""):
+def listing_title(listing_no: int, rel_name: str, part_suffix: str = "") -> str:
     title = f"Листинг {listing_no} — {rel_name}"
     if part_suffix:
         title += f" ({part_suffix})"
+    return title
+
+
+def add_listing_heading(doc: docx.Document, listing_no: int, rel_name: str, part_suffix: str = ""):
+    title = listing_title(listing_no, rel_name, part_suffix)
 
     p = doc.add_paragraph()
     r = p.add_run(title)
@@ -319,8 +1098,50 @@ def split_keep_all_lines(text: str) -> list[str]:
     return text.split("\n")
 
 
+def decode_text(data: bytes) -> str:
+    # то же, что read_text в текстовом режиме: utf-8 с пропуском ошибок и универсальные переводы строк
+    text = data.decode("utf-8", errors="ignore")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def prepare_lines(data: bytes) -> tuple[int, list[str]]:
+    """
+    Байты файла -> (число символов, строки) за один проход каждого шага:
+    декодирование, переводы строк, очистка для XML. Строки дальше не чистятся повторно.
+    """
+    content = xml_safe_text(decode_text(data))
+    return len(content), content.split("\n")
+
+
+# байты, которых нет в тексте после prepare_lines: управляющие, недопустимые в XML, и продолжения
+# символов UTF-8 (0x80–0xBF) — после их удаления остаётся ровно по байту на символ
+_XML_INVALID_ASCII_BYTES = bytes(set(range(0x20)) - {9, 10, 13})
+_NOT_A_CHAR_BYTES = _XML_INVALID_ASCII_BYTES + bytes(range(0x80, 0xC0))
+
+
+def count_line_lengths(data: bytes) -> Optional[tuple[int, list[int]]]:
+    """
+    То же число символов и длины строк, что у prepare_lines, но по байтам: без строк str и очистки
+    регулярным выражением. Только для корректного UTF-8 без U+FFFE/U+FFFF (у них длины
+    зависят от декодирования с пропуском ошибок и очистки); иначе None.
+    """
+    if not data.isascii():
+        if b"\xef\xbf\xbe" in data or b"\xef\xbf\xbf" in data:
+            return None
+        try:
+            data.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    data = data.translate(None, _NOT_A_CHAR_BYTES)
+    return len(data), [len(line) for line in data.split(b"\n")]
+
+
 def read_text(path: Path) -> str:
-    return path.read_text(encoding="utf-8", errors="ignore")
+    return decode_text(path.read_bytes())
 
 
 def make_project_out_dir(listing_out: Path, project_name: str) -> Path:
@@ -329,8 +1150,8 @@ def make_project_out_dir(listing_out: Path, project_name: str) -> Path:
     return p
 
 
-def doc_name(project_out: Path, project_name: str, doc_idx: int) -> Path:
-    return project_out / f"{project_name}_listing_{doc_idx}.docx"
+def doc_name(project_out: Path, project_name: str, doc_idx: int, fmt: str = "docx") -> Path:
+    return project_out / f"{project_name}_listing_{doc_idx}.{fmt}"
 
 
 def new_doc(appendix_label: str) -> docx.Document:
@@ -412,47 +1233,6 @@ def _make_rPr_gost() -> OxmlElement:
     return rPr
 
 
-_PPR_XML = None
-_RPR_XML = None
-
-
-def _ppr_xml() -> str:
-    global _PPR_XML
-    if _PPR_XML is None:
-        _PPR_XML = _make_pPr_gost().xml
-    return _PPR_XML
-
-
-def _rpr_xml() -> str:
-    global _RPR_XML
-    if _RPR_XML is None:
-        _RPR_XML = _make_rPr_gost().xml
-    return _RPR_XML
-
-
-def _clone(xml: str) -> OxmlElement:
-    return parse_xml(xml)
-
-
-def _make_cell_paragraph(text: str) -> OxmlElement:
-    text = xml_safe_text(text)
-
-    p = OxmlElement("w:p")
-    p.append(_clone(_ppr_xml()))
-
-    r = OxmlElement("w:r")
-    r.append(_clone(_rpr_xml()))
-
-    t = OxmlElement("w:t")
-    if text.startswith(" ") or "  " in text:
-        t.set(qn("xml:space"), "preserve")
-    t.text = text
-    r.append(t)
-
-    p.append(r)
-    return p
-
-
 def _set_outer_borders_only(tblPr: OxmlElement) -> None:
     tblBorders = OxmlElement("w:tblBorders")
 
@@ -475,7 +1255,7 @@ def _set_outer_borders_only(tblPr: OxmlElement) -> None:
     tblPr.append(tblBorders)
 
 
-def build_code_table_xml(lines: list[str], start_line_no: int = 1) -> OxmlElement:
+def _make_table_head() -> OxmlElement:
     tbl = OxmlElement("w:tbl")
 
     tblPr = OxmlElement("w:tblPr")
@@ -497,228 +1277,3850 @@ def build_code_table_xml(lines: list[str], start_line_no: int = 1) -> OxmlElemen
     tblGrid.append(gridCol2)
     tbl.append(tblGrid)
 
-    for i, line in enumerate(lines):
-        safe_line = xml_safe_text(line)
+    return tbl
 
-        tr = OxmlElement("w:tr")
 
-        tc1 = OxmlElement("w:tc")
-        tcPr1 = OxmlElement("w:tcPr")
-        tcPr1.append(_make_tcW(NUM_COL_WIDTH_MM))
-        _set_tc_nowrap(tcPr1)
-        tc1.append(tcPr1)
-        tc1.append(_make_cell_paragraph(str(start_line_no + i)))
+def _make_tcPr(mm: int) -> OxmlElement:
+    tcPr = OxmlElement("w:tcPr")
+    tcPr.append(_make_tcW(mm))
+    _set_tc_nowrap(tcPr)
+    return tcPr
 
-        tc2 = OxmlElement("w:tc")
-        tcPr2 = OxmlElement("w:tcPr")
-        tcPr2.append(_make_tcW(CODE_COL_WIDTH_MM))
-        _set_tc_nowrap(tcPr2)
-        tc2.append(tcPr2)
-        tc2.append(_make_cell_paragraph(safe_line))
 
-        tr.append(tc1)
-        tr.append(tc2)
-        tbl.append(tr)
+_NSDECL_RE = re.compile(r'\sxmlns(?::\w+)?="[^"]*"')
 
-    return tbl
 
+def _fragment_xml(el) -> str:
+    """
+    Сериализация элемента так, как он выглядит внутри document.xml:
+    объявления пространств имён уже есть у w:document, с корня фрагмента их убираем.
+    """
+    s = etree.tostring(el, encoding="unicode")
+    end = s.index(">")
+    return _NSDECL_RE.sub("", s[:end]) + s[end:]
 
-def add_code_table_for_lines_fast_after(heading_p, lines: list[str], start_line_no: int = 1) -> None:
-    tbl = build_code_table_xml(lines, start_line_no=start_line_no)
-    heading_p.addnext(tbl)
 
+# ===== Таблица: шаблон строки =====
+class _RowTemplate:
+    """
+    Неизменная разметка таблицы (tblPr/tblGrid, tcPr, pPr, rPr) сериализуется один раз
+    из тех же построителей элементов; на строку подставляются только номер и текст.
+    """
 
-# ===== Разбиение больших файлов по строкам под лимит docx =====
-def compute_line_blocks_by_char_limit(lines: list[str], max_chars: int) -> list[tuple[int, int]]:
-    blocks: list[tuple[int, int]] = []
-    n = len(lines)
-    i = 0
-    while i < n:
-        j = i
-        acc = 0
-        while j < n:
-            add_len = len(lines[j]) + 1
-            if acc > 0 and (acc + add_len > max_chars):
-                break
-            if acc == 0 and add_len > max_chars:
-                j += 1
-                break
-            acc += add_len
-            j += 1
-        blocks.append((i, j))
-        i = j
-    return blocks
+    def __init__(self):
+        tbl = _fragment_xml(_make_table_head())
+        self.table_open = tbl[: -len("</w:tbl>")]
+        self.table_close = "</w:tbl>"
 
+        ppr = _fragment_xml(_make_pPr_gost())
+        rpr = _fragment_xml(_make_rPr_gost())
+        cell = "<w:p>" + ppr + "<w:r>" + rpr
 
-# ===== Основная обработка проекта =====
-def process_project(project_dir: Path, listing_out: Path, patterns: list[str], appendix_label: str, logger: logging.Logger) -> None:
-    project_name = project_dir.name
-    project_out = make_project_out_dir(listing_out, project_name)
+        self.row_open = "<w:tr><w:tc>" + _fragment_xml(_make_tcPr(NUM_COL_WIDTH_MM)) + cell + "<w:t>"
+        self.row_mid = "</w:t></w:r></w:p></w:tc><w:tc>" + _fragment_xml(_make_tcPr(CODE_COL_WIDTH_MM)) + cell
+        self.t_plain = "<w:t>"
+        self.t_preserve = '<w:t xml:space="preserve">'
+        self.row_close = "</w:t></w:r></w:p></w:tc></w:tr>"
+        # разметка строки без номера и текста — для оценки объёма XML
+        self.row_xml_bytes = len(self.row_open) + len(self.row_mid) + len(self.t_plain) + len(self.row_close)
 
-    files = iter_project_files(project_dir, listing_out, patterns)
-    if not files:
-        logger.warning(c_warn(f"[{project_name}] Нет файлов для обработки (пусто или всё отфильтровано)."))
-        return
+        # раскладка compact: в ячейке номеров и в ячейке кода один w:r, строки через w:br
+        self.compact_row_open = self.row_open[: -len(self.t_plain)]  # до w:r ячейки номеров включительно
+        self.compact_row_mid = self.row_mid[len("</w:t>"):]  # от конца w:r номеров до w:r ячейки кода
+        self.compact_row_close = self.row_close[len("</w:t>"):]
+        self.compact_row_xml_bytes = len(self.compact_row_open) + len(self.compact_row_mid) + len(self.compact_row_close)
+        self.compact_line_xml_bytes = 2 * len("<w:t></w:t><w:br/>")  # номер и код одной строки
 
-    logger.info(c_info(f"[{project_name}] Файлов к обработке: {len(files)}"))
 
-    bar = None
-    if IncrementalBar is not None and sys.stdout.isatty():
-        try:
-            bar = IncrementalBar(
-                f"{project_name} ({appendix_label})",
-                max=len(files),
-                suffix=" %(index).d/%(max).d - %(percent).1f%% - %(elapsed).ds",
-                file=sys.stdout,  # важно: бар в stdout
-            )
-        except TypeError:
-            # если версия progress не поддерживает file=
-            bar = IncrementalBar(
-                f"{project_name} ({appendix_label})",
-                max=len(files),
-                suffix=" %(index).d/%(max).d - %(percent).1f%% - %(elapsed).ds",
-            )
+_ROW_TEMPLATE = None
 
-    doc_idx = 1
-    listing_no = 1
-    doc = new_doc(appendix_label)
-    doc_chars = 0
 
-    for f in files:
-        rel = f.relative_to(project_dir).as_posix()
-        try:
-            content = read_text(f)
-        except (OSError, PermissionError):
-            logger.warning(c_warn(f"[{project_name}] Пропуск (нет доступа): {rel}"))
-            if bar:
-                bar.next()
-            continue
+def _row_template() -> _RowTemplate:
+    global _ROW_TEMPLATE
+    if _ROW_TEMPLATE is None:
+        _ROW_TEMPLATE = _RowTemplate()
+    return _ROW_TEMPLATE
+
+
+def _xml_escape(s: str) -> str:
+    if "&" in s:
+        s = s.replace("&", "&amp;")
+    if "<" in s:
+        s = s.replace("<", "&lt;")
+    if ">" in s:
+        s = s.replace(">", "&gt;")
+    return s
 
-        content = xml_safe_text(content)
-        content_len = len(content)
 
-        if content_len <= MAX_DOC_CHARS:
-            if doc_chars > 0 and (doc_chars + content_len > MAX_DOC_CHARS):
-                out_path = doc_name(project_out, project_name, doc_idx)
-                doc.save(str(out_path))
+def render_code_table_xml(lines: list[str], start_line_no: int = 1, layout: str = "rows") -> str:
+    """
+    w:tbl фрагментом document.xml (без объявлений пространств имён).
+    Строки должны быть уже очищены xml_safe_text.
+    """
+    if layout == "compact":
+        return render_compact_table_xml(lines, start_line_no)
+    tpl = _row_template()
+    row_open = tpl.row_open
+    row_mid = tpl.row_mid
+    t_plain = tpl.t_plain
+    t_preserve = tpl.t_preserve
+    row_close = tpl.row_close
+
+    out = [tpl.table_open]
+    n = start_line_no
+    for line in lines:
+        t_open = t_preserve if (line.startswith(" ") or "  " in line) else t_plain
+        out.append(f"{row_open}{n}{row_mid}{t_open}{_xml_escape(line)}{row_close}")
+        n += 1
+    out.append(tpl.table_close)
+    return "".join(out)
+
 
-                doc_idx += 1
-                doc = new_doc(appendix_label)
-                doc_chars = 0
+def cell_columns(col_mm: float) -> int:
+    """Сколько знаков Courier New (ширина 0,6 кегля) помещается в строку ячейки шириной col_mm."""
+    return int((col_mm - 2 * CELL_PAD_MM) * 72 / 25.4 / (0.6 * CODE_FONT_SIZE_PT))
 
-            heading_p = add_listing_heading(doc, listing_no, rel)
-            lines = split_keep_all_lines(content)
-            add_code_table_for_lines_fast_after(heading_p, lines, start_line_no=1)
-            add_separator_paragraph(doc)
 
-            listing_no += 1
-            doc_chars += content_len
+def _wrap_columns(text: str, cols: int) -> list[str]:
+    return [text[i:i + cols] for i in range(0, len(text), cols)] or [""]
 
+
+def wrap_cell_text(text: str, cols: int) -> list[str]:
+    """
+    Строка, разрезанная на куски не шире cols знаков — так, чтобы ячейка Word не переносила её сама.
+    Табуляция доходит до следующей позиции, кратной WORD_TAB_COLS; широкие знаки (CJK) — в две позиции.
+    """
+    if max(text, default="") < "\u1100":  # широких знаков нет
+        if "\t" not in text:
+            return _wrap_columns(text, cols)
+        if len(text.expandtabs(WORD_TAB_COLS)) <= cols:
+            return [text]
+    pieces = []
+    start = col = 0
+    for i, ch in enumerate(text):
+        if ch == "\t":
+            w = WORD_TAB_COLS - col % WORD_TAB_COLS
         else:
-            if doc_chars > 0:
-                out_path = doc_name(project_out, project_name, doc_idx)
-                doc.save(str(out_path))
-                doc_idx += 1
-                doc = new_doc(appendix_label)
-                doc_chars = 0
-
-            all_lines = split_keep_all_lines(content)
-            blocks = compute_line_blocks_by_char_limit(all_lines, MAX_DOC_CHARS)
-            total_parts = len(blocks)
-
-            logger.info(c_info(f"[{project_name}] Большой файл: {rel} -> частей: {total_parts}"))
-
-            for part_idx, (a, b) in enumerate(blocks, start=1):
-                heading_p = add_listing_heading(
-                    doc, listing_no, rel, part_suffix=f"часть {part_idx}/{total_parts}"
-                )
-                add_code_table_for_lines_fast_after(heading_p, all_lines[a:b], start_line_no=a + 1)
-                add_separator_paragraph(doc)
+            w = 2 if ch >= "\u1100" and unicodedata.east_asian_width(ch) in "WF" else 1
+        if col and col + w > cols:
+            pieces.append(text[start:i])
+            start = i
+            col = 0
+            if ch == "\t":
+                w = WORD_TAB_COLS
+        col += w
+    pieces.append(text[start:])
+    return pieces
+
+
+def wrap_row_cells(num: str, line: str) -> tuple[list[str], list[str]]:
+    """Номер и строка кода, разрезанные по ширине своих ячеек и дополненные пустыми кусками до одной высоты."""
+    nums = wrap_cell_text(num, cell_columns(NUM_COL_WIDTH_MM))
+    code = wrap_cell_text(line, cell_columns(CODE_COL_WIDTH_MM))
+    height = max(len(nums), len(code))
+    return nums + [""] * (height - len(nums)), code + [""] * (height - len(code))
+
+
+def render_compact_table_xml(lines: list[str], start_line_no: int = 1) -> str:
+    """
+    Тот же w:tbl (рамка, колонки 16/170 мм, Courier New 12, отступы и интервал абзаца), но строка
+    таблицы — на COMPACT_ROW_LINES строк кода: в каждой ячейке один абзац и один w:r, строки
+    разделены w:br. Ширина ячейки Word сама строку не переносит: иначе ячейка кода стала бы выше
+    ячейки номеров и номера разошлись бы со строками. Поэтому строки длиннее ячейки (wrap_row_cells)
+    режутся заранее, перенос идёт отдельной строкой без номера — как в PDF.
+    Строка таблицы может переходить на следующую страницу.
+    """
+    tpl = _row_template()
+
+    def cell(pieces: list[str]) -> str:
+        return "<w:br/>".join(
+            f"{tpl.t_preserve if (p.startswith(' ') or '  ' in p) else tpl.t_plain}{_xml_escape(p)}</w:t>" if p else ""
+            for p in pieces
+        )
+
+    out = [tpl.table_open]
+    for a in range(0, len(lines), COMPACT_ROW_LINES):
+        nums: list[str] = []
+        code: list[str] = []
+        for n, line in enumerate(lines[a:a + COMPACT_ROW_LINES], start_line_no + a):
+            num_pieces, code_pieces = wrap_row_cells(str(n), line)
+            nums += num_pieces
+            code += code_pieces
+        out.append(f"{tpl.compact_row_open}{cell(nums)}{tpl.compact_row_mid}{cell(code)}{tpl.compact_row_close}")
+    out.append(tpl.table_close)
+    return "".join(out)
 
-                out_path = doc_name(project_out, project_name, doc_idx)
-                doc.save(str(out_path))
-                doc_idx += 1
 
-                if part_idx != total_parts:
-                    doc = new_doc(appendix_label)
-                doc_chars = 0
+# свой парсер: у docx.oxml.parse_xml включён remove_blank_text,
+# он выбросил бы строки кода из одних табуляций
+_table_parser = etree.XMLParser(remove_blank_text=False, resolve_entities=False, huge_tree=True)
+_table_parser.set_element_class_lookup(docx.oxml.element_class_lookup)
+_W_NSDECL = f' xmlns:w="{docx.oxml.ns.nsmap["w"]}"'
 
-            listing_no += 1
-            doc = new_doc(appendix_label)
-            doc_chars = 0
 
-        if bar:
-            bar.next()
+def parse_code_table_xml(table_xml: str) -> OxmlElement:
+    tbl = etree.fromstring(table_xml.replace("<w:tbl>", f"<w:tbl{_W_NSDECL}>", 1), _table_parser)
+    # после разбора пустой <w:t></w:t> становится <w:t/>; возвращаем как при поэлементной сборке
+    if "<w:t></w:t>" in table_xml:
+        for t in tbl.xpath(".//w:t[not(text())]"):
+            t.text = ""
+    return tbl
 
-    if bar:
-        bar.finish()
 
-    if doc_chars > 0:
-        out_path = doc_name(project_out, project_name, doc_idx)
-        doc.save(str(out_path))
+def build_code_table_xml(lines: list[str], start_line_no: int = 1, layout: str = "rows") -> OxmlElement:
+    safe_lines = [xml_safe_text(line) for line in lines]
+    return parse_code_table_xml(render_code_table_xml(safe_lines, start_line_no=start_line_no, layout=layout))
 
-    logger.info(c_ok(f"[{project_name}] Готово."))
 
-def pause_if_double_click():
+def add_code_table_for_lines_fast_after(heading_p, lines: list[str], start_line_no: int = 1) -> None:
+    tbl = parse_code_table_xml(render_code_table_xml(lines, start_line_no=start_line_no))
+    heading_p.addnext(tbl)
+
+
+# ===== Бюджет документа: символы, строки таблицы, байты XML =====
+class DocCost(NamedTuple):
+    """Стоимость части или документа; xml_bytes — оценка: разметка строк + номера + текст."""
+
+    chars: int = 0
+    rows: int = 0
+    xml_bytes: int = 0
+
+    def plus(self, other: "DocCost") -> "DocCost":
+        return DocCost(self.chars + other.chars, self.rows + other.rows, self.xml_bytes + other.xml_bytes)
+
+
+class DocBudget(NamedTuple):
+    """Лимиты на один docx, поля по порядку DocCost; 0 — без лимита."""
+
+    max_chars: int = MAX_DOC_CHARS
+    max_rows: int = MAX_DOC_ROWS
+    max_xml_bytes: int = MAX_DOC_XML_BYTES
+
+    def limits(self) -> tuple:
+        return tuple(x if x > 0 else float("inf") for x in self)
+
+    def fits(self, cost: DocCost) -> bool:
+        return all(value <= limit for value, limit in zip(cost, self.limits()))
+
+
+def layout_markup(layout: str = "rows") -> tuple[int, int, int]:
     """
-    Пауза только при запуске .exe двойным кликом.
-    В консоли (cmd / powershell) паузы не будет.
+    Для оценки стоимости в раскладке layout: байт разметки на строку кода, байт разметки
+    на строку таблицы и строк кода в строке таблицы. rows — строка таблицы на строку кода.
     """
-    if getattr(sys, "frozen", False) and sys.stdout is not None:
-        try:
-            if not sys.stdin.isatty():
-                input("\nНажмите Enter для выхода...")
-        except Exception:
-            pass
-# ===== main =====
-def main() -> int:
-    logger = setup_logging()
+    tpl = _row_template()
+    if layout == "compact":
+        return tpl.compact_line_xml_bytes, tpl.compact_row_xml_bytes, COMPACT_ROW_LINES
+    return tpl.row_xml_bytes, 0, 1
 
-    parser = argparse.ArgumentParser(
-        description="ГОСТ-листинги из targets/* в listing_out/* (первый запуск создаёт структуру)."
-    )
-    parser.parse_args()
 
-    base = app_dir()
+def text_cost(content_len: int, n_lines: int, layout: str = "rows") -> DocCost:
+    """Стоимость текста целиком по числу символов и строк — без прохода по строкам."""
+    digits = 0
+    width, lo = 1, 1
+    while lo <= n_lines:
+        digits += (min(n_lines, lo * 10 - 1) - lo + 1) * width
+        width, lo = width + 1, lo * 10
+    text = content_len - max(n_lines - 1, 0)  # без '\n' между строками
+    line_xml, row_xml, row_lines = layout_markup(layout)
+    rows = -(-n_lines // row_lines)
+    return DocCost(content_len, rows, n_lines * line_xml + rows * row_xml + digits + text)
 
-    # первый запуск — создать структуру и выйти
-    if ensure_first_run_layout(base, logger):
-        return 0
 
-    targets = base / "targets"
-    listing_out = base / "listing_out"
-    listing_out.mkdir(parents=True, exist_ok=True)
+def format_cost(cost: DocCost) -> str:
+    return f"символов: {cost.chars}, строк: {cost.rows}, XML ~{format_size(cost.xml_bytes)}"
 
-    patterns = load_ignore_patterns_auto(base)
 
-    logger.info(c_info(f"База: {base}"))
-    logger.info(c_info(f"Папка проектов: {targets}"))
-    logger.info(c_info(f"Вывод: {listing_out}"))
-    logger.info(c_info(f"Правил ignore: {len(patterns)}"))
+# ===== Разбиение больших файлов по строкам под лимит docx =====
+def iter_line_blocks(
+    lengths: Iterable[int], budget: DocBudget, layout: str = "rows"
+) -> Iterator[tuple[int, int, DocCost]]:
+    """
+    Жадное разбиение на части по длинам строк, по одной строке за раз: часть [a, b) набирается,
+    пока её стоимость укладывается в budget; строка, которая не влезает и одна, — отдельная часть.
+    Строки таблицы и разметка считаются по раскладке layout (см. layout_markup).
+    """
+    max_chars, max_rows, max_xml = budget.limits()
+    line_markup, row_markup, row_lines = layout_markup(layout)
+    start = n = 0
+    chars = count = xml = 0
+    for length in lengths:
+        line_xml = line_markup + len(str(n + 1)) + length
+        new_row = row_markup if count % row_lines == 0 else 0  # строка открывает новую строку таблицы
+        if count and (
+            chars + length + 1 > max_chars
+            or count // row_lines + 1 > max_rows
+            or xml + line_xml + new_row > max_xml
+        ):
+            yield start, n, DocCost(chars, -(-count // row_lines), xml)
+            start, chars, count, xml = n, 0, 0, 0
+            new_row = row_markup
+        line_xml += new_row
+        if not count and (length + 1 > max_chars or line_xml > max_xml):
+            yield n, n + 1, DocCost(length + 1, 1, line_xml)
+            start = n + 1
+        else:
+            chars += length + 1
+            count += 1
+            xml += line_xml
+        n += 1
+    if start < n:
+        yield start, n, DocCost(chars, -(-count // row_lines), xml)
 
-    if not targets.exists() or not targets.is_dir():
-        logger.error(c_err(f"Нет папки targets: {targets}"))
-        return 2
 
-    projects = sorted([p for p in targets.iterdir() if p.is_dir()], key=lambda p: p.name.lower())
-    if not projects:
-        logger.warning(c_warn("В targets нет проектов (подпапок). Добавь папки проектов и запусти снова."))
-        pause_if_double_click()
-        return 0
+def plan_line_blocks(
+    lengths: Iterable[int], budget: DocBudget, layout: str = "rows"
+) -> tuple[list[tuple[int, int]], list[DocCost], DocCost]:
+    """
+    Части файла, их стоимость и стоимость файла целиком (символы — по тексту, без '\n'
+    после последней строки). Файл, который целиком укладывается в budget, — одна часть.
+    """
+    blocks: list[tuple[int, int]] = []
+    costs: list[DocCost] = []
+    for a, b, cost in iter_line_blocks(lengths, budget, layout):
+        blocks.append((a, b))
+        costs.append(cost)
+    total = DocCost()
+    for cost in costs:
+        total = total.plus(cost)
+    total = total._replace(chars=max(total.chars - 1, 0))
+    if len(blocks) > 1 and budget.fits(total):
+        return [(0, blocks[-1][1])], [total], total
+    if len(blocks) == 1:
+        costs = [total]
+    return blocks, costs, total
 
-    alphabet = list("АБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ")
 
-    logger.info(c_info(f"Проектов найдено: {len(projects)}"))
-    for idx, project in enumerate(projects):
-        appendix_label = index_to_label(idx, alphabet)
-        logger.info(c_info(f"=== Старт проекта: {project.name} | Приложение: {appendix_label} ==="))
-        process_project(project, listing_out, patterns, appendix_label, logger)
+def compute_line_blocks_by_char_limit(lines: list[str], max_chars: int) -> list[tuple[int, int]]:
+    return [(a, b) for a, b, _cost in iter_line_blocks(map(len, lines), DocBudget(max_chars, 0, 0))]
 
-    logger.info(c_ok(f"Готово. Результаты: {listing_out}"))
 
-    pause_if_double_click()
-    return 0
+# ===== Отбор файлов до чтения: двоичные и слишком большие =====
+SNIFF_BLOCK = 8192  # сколько байт с начала файла смотрим
+BINARY_RATIO = 0.30  # доля управляющих байт в первом блоке, с которой файл считается двоичным
+
+SKIP_DENIED = "нет доступа"
+
+# байты, которые встречаются в тексте: \a \b \t \n \f \r ESC, печатные ASCII и всё >= 0x80 (UTF-8)
+_TEXT_BYTES = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x7F)) | set(range(0x80, 0x100)))
+
+
+class FilePolicy(NamedTuple):
+    """
+    sniff — проверять первый блок на двоичность (--sniff; по умолчанию нет, как раньше);
+    max_bytes — общий лимит размера файла (0 — без лимита);
+    ext_limits — лимиты по окончанию имени ('.sql', '.min.js'), приоритетнее общего;
+    0 — пропускать все непустые файлы с таким окончанием.
+    """
+
+    sniff: bool = False
+    max_bytes: int = 0
+    ext_limits: tuple[tuple[str, int], ...] = ()
+
+    def limit_for(self, name: str) -> Optional[int]:
+        lname = name.lower()
+        best = None
+        for ext, limit in self.ext_limits:
+            if lname.endswith(ext) and (best is None or len(ext) > len(best[0])):
+                best = (ext, limit)
+        if best is not None:
+            return best[1]
+        return self.max_bytes or None
+
+
+class SkippedFile(Exception):
+    pass
+
+
+def parse_size(s: str) -> int:
+    """'800', '512k', '20M', '1G' -> байты."""
+    s = s.strip().upper().rstrip("B")
+    mult = 1
+    for suffix, m in (("K", 1024), ("M", 1024 ** 2), ("G", 1024 ** 3)):
+        if s.endswith(suffix):
+            s, mult = s[:-1], m
+            break
+    return int(float(s) * mult)
+
+
+def format_size(n: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "Б" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} ГБ"
+
+
+def is_binary_block(head: bytes) -> bool:
+    if not head:
+        return False
+    if b"\0" in head:
+        return True
+    return len(head.translate(None, _TEXT_BYTES)) / len(head) > BINARY_RATIO
+
+
+def _fstat(fh, path: Path):
+    """stat открытого файла; у блоба из git (GitFile) и члена архива (ArchiveFile) — из оглавления."""
+    if isinstance(path, (GitFile, ArchiveFile)):
+        return path.stat()
+    return os.fstat(fh.fileno())
+
+
+def _check_opened(fh, path: Path, policy: FilePolicy) -> tuple[os.stat_result, bytes]:
+    """Проверки открытого файла до полного чтения: лимит размера по stat, двоичность по первому блоку."""
+    st = _fstat(fh, path)
+    limit = policy.limit_for(path.name)
+    if limit is not None and st.st_size > limit:
+        raise SkippedFile(f"размер {format_size(st.st_size)} > {format_size(limit)}")
+    head = fh.read(SNIFF_BLOCK)
+    if policy.sniff and is_binary_block(head):
+        raise SkippedFile("двоичный")
+    return st, head
+
+
+def read_checked(path: Path, policy: FilePolicy) -> tuple[os.stat_result, bytes]:
+    """
+    Чтение файла с проверками до полного чтения: лимит размера по stat,
+    двоичность по первому блоку. Не прошёл — SkippedFile с причиной.
+    """
+    with path.open("rb") as fh:
+        st, head = _check_opened(fh, path, policy)
+        return st, head + fh.read()
+
+
+def log_skip_report(project_name: str, skipped: list[tuple[str, str]], logger: logging.Logger) -> None:
+    """Сводка по причинам и каждый пропущенный файл: отбор не должен терять файлы молча."""
+    if not skipped:
+        return
+    by_reason: dict[str, int] = {}
+    for _rel, reason in skipped:
+        key = "по размеру" if reason.startswith("размер") else reason
+        by_reason[key] = by_reason.get(key, 0) + 1
+    summary = ", ".join(f"{k}: {v}" for k, v in sorted(by_reason.items()))
+    logger.info(c_warn(f"[{project_name}] Пропущено файлов: {len(skipped)} ({summary})"))
+    for rel, reason in skipped:
+        logger.info(c_warn(f"[{project_name}]   {rel} — {reason}"))
+
+
+# ===== Потоковое чтение больших файлов =====
+STREAM_MIN_BYTES = 4 * 1024 * 1024  # файлы от этого размера не читаются целиком, а идут кусками через mmap
+STREAM_CHUNK = 1024 * 1024
+
+
+def iter_file_chunks(fh) -> Iterator[bytes]:
+    """Байты открытого файла кусками по STREAM_CHUNK: через mmap, а где он недоступен — read()."""
+    try:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # пустой файл, каналы, ФС без mmap
+        fh.seek(0)
+        while True:
+            chunk = fh.read(STREAM_CHUNK)
+            if not chunk:
+                return
+            yield chunk
+    with mm:
+        for off in range(0, len(mm), STREAM_CHUNK):
+            yield mm[off:off + STREAM_CHUNK]
+
+
+def iter_text_chunks(chunks: Iterable[bytes]) -> Iterator[str]:
+    """
+    Куски байт -> куски текста, как prepare_lines по всему файлу: utf-8 с пропуском ошибок,
+    переводы строк, очистка для XML. Разрезанный символ UTF-8 дожидается следующего куска
+    в декодере, '\r' в конце куска — тоже (вдруг дальше '\n').
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    carry = ""
+    for chunk in chunks:
+        text = carry + decoder.decode(chunk)
+        carry = ""
+        if text.endswith("\r"):
+            text, carry = text[:-1], "\r"
+        if "\r" in text:
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        yield xml_safe_text(text)
+    text = carry + decoder.decode(b"", final=True)
+    yield xml_safe_text(text.replace("\r", "\n"))
+
+
+def iter_lines(texts: Iterable[str]) -> Iterator[str]:
+    """Куски текста -> строки, ровно как str.split('\n') по склеенному тексту."""
+    tail: list[str] = []
+    for text in texts:
+        parts = text.split("\n")
+        if len(parts) == 1:
+            tail.append(text)
+            continue
+        tail.append(parts[0])
+        yield "".join(tail)
+        yield from islice(parts, 1, len(parts) - 1)
+        tail = [parts[-1]]
+    yield "".join(tail)
+
+
+def scan_stream(fh, rel: str, st: os.stat_result, budget: DocBudget, layout: str = "rows") -> "FileInfo":
+    """
+    Первый проход по большому файлу: sha256 байт, стоимость и разбиение на части.
+    В памяти только текущий кусок и текущая строка.
+    """
+    h = hashlib.sha256()
+
+    def hashed() -> Iterator[bytes]:
+        for chunk in iter_file_chunks(fh):
+            h.update(chunk)
+            yield chunk
+
+    blocks, costs, total = plan_line_blocks(map(len, iter_lines(iter_text_chunks(hashed()))), budget, layout)
+    return FileInfo(rel, st.st_size, st.st_mtime_ns, h.hexdigest(), total.chars, blocks, costs)
+
+
+def iter_block_lines(path: Path, info: "FileInfo") -> Iterator[list[str]]:
+    """Второй проход: строки частей info.blocks по очереди; в памяти одна часть."""
+    with path.open("rb") as fh:
+        st = _fstat(fh, path)
+        if (st.st_size, st.st_mtime_ns) != (info.size, info.mtime_ns):
+            raise RuntimeError(f"Файл изменился во время сборки: {info.rel}")
+        lines = iter_lines(iter_text_chunks(iter_file_chunks(fh)))
+        for a, b in info.blocks:
+            yield list(islice(lines, b - a))
+
+
+# ===== Подготовка файла: чтение, очистка, XML таблиц =====
+class FileInfo(NamedTuple):
+    """
+    Что известно о файле без рендера: отпечаток и разбиение на части (строки [a, b))
+    со стоимостью каждой части; у файла из одной части costs[0] — стоимость файла целиком.
+    """
+
+    rel: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    content_len: int
+    blocks: list[tuple[int, int]]
+    costs: list[DocCost]
+
+
+class RenderedFile(NamedTuple):
+    """
+    Готовый к сборке файл: info и по одной таблице на каждую часть info.blocks (см. render_part).
+    Файл целиком — одна часть; не укладывается в DocBudget — части по plan_line_blocks.
+    tables None — файл большой (STREAM_MIN_BYTES), части рендерятся из path по мере сборки,
+    см. iter_file_tables.
+    skip — причина, по которой файл не попал в листинги (info тогда None).
+    """
+
+    rel: str
+    info: Optional[FileInfo]
+    tables: Optional[list[str]]
+    skip: str = ""
+    path: Optional[Path] = None
+    times: tuple[float, float, float] = (0.0, 0.0, 0.0)  # чтение, декодирование и разбиение, рендер (с)
+    cached: bool = False  # разбиение и таблицы взяты из FragmentCache
+
+    @property
+    def denied(self) -> bool:
+        return self.skip == SKIP_DENIED
+
+
+class SourceBytes(NamedTuple):
+    """Прочитанный файл до декодирования. data None — файл большой (STREAM_MIN_BYTES) и читается потоком."""
+
+    st: os.stat_result
+    data: Optional[bytes]
+    sha256: str
+    read_s: float
+
+
+def read_source(path: Path, policy: FilePolicy) -> SourceBytes:
+    """Байты файла и их sha256 после проверок FilePolicy (не прошёл — SkippedFile)."""
+    t0 = time.perf_counter()
+    with path.open("rb") as fh:
+        st, head = _check_opened(fh, path, policy)
+        if st.st_size >= STREAM_MIN_BYTES:
+            return SourceBytes(st, None, "", 0.0)
+        data = head + fh.read()
+    read_s = time.perf_counter() - t0
+    return SourceBytes(st, data, hashlib.sha256(data).hexdigest(), read_s)
+
+
+def _load_lines(
+    path: Path,
+    rel: str,
+    policy: FilePolicy,
+    budget: DocBudget,
+    cache: Optional["FragmentCache"] = None,
+    source=None,
+    measure: bool = False,
+    layout: str = "rows",
+) -> tuple[FileInfo, Optional[list[str]], float, Optional[list[str]]]:
+    """
+    FileInfo, очищенные строки файла, время чтения байт (с) и таблицы частей из кэша.
+    Большой файл не читается целиком: строки None, а чтение и декодирование идут вместе в scan_stream.
+    Если файл есть в кэше, он не декодируется: строки None, таблицы — из кэша.
+    source — результат read_source (или его исключение), если файл уже прочитан заранее (ReadAhead).
+    measure — нужны только длины строк: считаются по байтам (count_line_lengths), строки None.
+    layout — раскладка таблицы, по которой считается стоимость частей.
+    """
+    if source is None:
+        source = read_source(path, policy)
+    elif isinstance(source, BaseException):
+        raise source
+    st, data, digest, read_s = source
+    if data is None:
+        with path.open("rb") as fh:
+            return scan_stream(fh, rel, _fstat(fh, path), budget, layout), None, 0.0, None
+
+    hit = cache.get(digest) if cache is not None else None
+    if hit is not None:
+        info = FileInfo(
+            rel, st.st_size, st.st_mtime_ns, digest, hit["content_len"],
+            [tuple(b) for b in hit["blocks"]], [DocCost(*c) for c in hit["costs"]],
+        )
+        return info, None, read_s, hit["tables"]
+
+    counted = count_line_lengths(data) if measure else None
+    if counted is not None:
+        lines = None
+        content_len, lengths = counted
+    else:
+        content_len, lines = prepare_lines(data)
+        lengths = list(map(len, lines))
+    del data
+
+    cost = text_cost(content_len, len(lengths), layout)
+    if budget.fits(cost):
+        blocks, costs = [(0, len(lengths))], [cost]
+    else:
+        blocks, costs, _total = plan_line_blocks(lengths, budget, layout)
+
+    return FileInfo(rel, st.st_size, st.st_mtime_ns, digest, content_len, blocks, costs), lines, read_s, None
+
+
+def measure_file(
+    path: Path,
+    rel: str,
+    policy: FilePolicy = FilePolicy(),
+    budget: DocBudget = DocBudget(),
+    layout: str = "rows",
+    cache: Optional["FragmentCache"] = None,
+    source=None,
+) -> RenderedFile:
+    """Как render_file, но без таблиц: только FileInfo для раскладки; длины строк — по байтам."""
+    t0 = time.perf_counter()
+    try:
+        info, _lines, read_s, cached = _load_lines(path, rel, policy, budget, cache, source, measure=True, layout=layout)
+    except SkippedFile as e:
+        return RenderedFile(rel, None, [], skip=str(e))
+    except (OSError, PermissionError):
+        return RenderedFile(rel, None, [], skip=SKIP_DENIED)
+    # прочитанный заранее файл читался в другом потоке: в своё время здесь не входит
+    times = (read_s, time.perf_counter() - t0 - (0.0 if source is not None else read_s), 0.0)
+    return RenderedFile(rel, info, [], times=times, cached=cached is not None)
+
+
+def render_part(lines: list[str], start_line_no: int, fmt: str = "docx", layout: str = "rows"):
+    """
+    Часть файла в виде, который принимает писатель: XML w:tbl для docx (в раскладке layout),
+    (номер первой строки, строки) для pdf.
+    """
+    if fmt == "pdf":
+        return (start_line_no, lines)
+    return render_code_table_xml(lines, start_line_no=start_line_no, layout=layout)
+
+
+def render_file(
+    path: Path,
+    rel: str,
+    policy: FilePolicy = FilePolicy(),
+    budget: DocBudget = DocBudget(),
+    fmt: str = "docx",
+    layout: str = "rows",
+    cache: Optional["FragmentCache"] = None,
+    source=None,
+) -> RenderedFile:
+    t0 = time.perf_counter()
+    try:
+        info, lines, read_s, cached = _load_lines(path, rel, policy, budget, cache, source, layout=layout)
+    except SkippedFile as e:
+        return RenderedFile(rel, None, [], skip=str(e))
+    except (OSError, PermissionError):
+        return RenderedFile(rel, None, [], skip=SKIP_DENIED)
+    t1 = time.perf_counter()
+    decode_s = t1 - t0 - (0.0 if source is not None else read_s)
+
+    if cached is not None:
+        return RenderedFile(rel, info, cached, times=(read_s, decode_s, 0.0), cached=True)
+    if lines is None:
+        return RenderedFile(rel, info, None, path=path, times=(read_s, decode_s, 0.0))
+    tables = [render_part(lines[a:b], a + 1, fmt, layout) for a, b in info.blocks]
+    if cache is not None:
+        cache.put(info, tables)
+    return RenderedFile(rel, info, tables, times=(read_s, decode_s, time.perf_counter() - t1))
+
+
+def iter_file_tables(
+    rf: RenderedFile, parts: Optional[set[int]] = None, fmt: str = "docx", layout: str = "rows",
+) -> Iterator:
+    """
+    Таблицы частей файла по порядку (только номера из parts, если заданы; с 1).
+    Большой файл читается второй раз и рендерится по одной части за раз.
+    """
+    if rf.tables is not None:
+        for part, table in enumerate(rf.tables, 1):
+            if parts is None or part in parts:
+                yield table
+        return
+    blocks = iter_block_lines(rf.path, rf.info)
+    for part, (a, _b) in enumerate(rf.info.blocks, 1):
+        lines = next(blocks)
+        if parts is None or part in parts:
+            yield render_part(lines, a + 1, fmt, layout)
+        del lines
+
+
+def _iter_ordered(fn, items: list[tuple], jobs: int = 1) -> Iterator:
+    """
+    fn(*item) по всем items в исходном порядке. При jobs > 1 — в пуле процессов;
+    вперёд запускается не больше 2 * jobs задач, чтобы не копить память.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield fn(*item)
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        window: deque = deque()
+        it = iter(items)
+        for item in it:
+            window.append(pool.submit(fn, *item))
+            if len(window) >= 2 * jobs:
+                break
+        while window:
+            fut = window.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                window.append(pool.submit(fn, *nxt))
+            yield fut.result()
+
+
+def iter_read_ahead(
+    paths: list[Path], policy: FilePolicy, max_bytes: int = READ_AHEAD_BYTES, threads: int = READ_AHEAD_THREADS
+) -> Iterator:
+    """
+    read_source по всем paths в исходном порядке; потоки читают следующие файлы, пока текущий
+    рендерится (сетевые папки, HDD). Прочитанного заранее — не больше max_bytes, плюс по файлу
+    на поток в полёте (большие файлы целиком не читаются). Ошибка чтения отдаётся объектом
+    исключения на месте файла: потребитель сообщает о ней в порядке списка, как без чтения впереди.
+    """
+    def job(path: Path):
+        try:
+            return read_source(path, policy)
+        except (SkippedFile, OSError) as e:
+            return e
+
+    def done(fut) -> None:
+        src = fut.result()
+        with lock:
+            state[0] -= 1
+            if isinstance(src, SourceBytes) and src.data is not None:
+                state[1] += len(src.data)
+
+    lock = threading.Lock()
+    state = [0, 0]  # чтений в полёте, байт прочитано и ещё не отдано
+    window: deque = deque()
+    it = iter(paths)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            while state[0] < threads and state[1] < max_bytes:
+                path = next(it, None)
+                if path is None:
+                    break
+                with lock:
+                    state[0] += 1
+                fut = pool.submit(job, path)
+                fut.add_done_callback(done)
+                window.append(fut)
+            if not window:
+                return
+            src = window.popleft().result()
+            if isinstance(src, SourceBytes) and src.data is not None:
+                with lock:
+                    state[1] -= len(src.data)
+            yield src
+
+
+def _iter_files(fn, items: list[tuple], jobs: int, policy: FilePolicy, read_ahead: int) -> Iterator:
+    """
+    _iter_ordered по items (item[0] — путь файла). В одном процессе при read_ahead > 0
+    байты файлов читает iter_read_ahead, а fn получает их в source.
+    """
+    if jobs > 1 or read_ahead <= 0:
+        return _iter_ordered(fn, items, jobs)
+    sources = iter_read_ahead([item[0] for item in items], policy, read_ahead)
+    return (fn(*item, source=source) for item, source in zip(items, sources))
+
+
+def iter_rendered_files(
+    files: list[Path],
+    project_dir: Path,
+    file_jobs: int = 1,
+    policy: FilePolicy = FilePolicy(),
+    budget: DocBudget = DocBudget(),
+    fmt: str = "docx",
+    cache: Optional["FragmentCache"] = None,
+    read_ahead: int = 0,
+    layout: str = "rows",
+) -> Iterator[RenderedFile]:
+    items = [(f, f.relative_to(project_dir).as_posix(), policy, budget, fmt, layout, cache) for f in files]
+    return _iter_files(render_file, items, file_jobs, policy, read_ahead)
+
+
+# ===== Кэш отрендеренных таблиц =====
+# Кэш включается явно (--cache-size, --cache-dir) и по умолчанию лежит в кэше пользователя,
+# а не в listing_out рядом с результатами
+CACHE_DIR_NAME = "gost-listing"
+CACHE_VERSION = 1  # поднять при любом изменении разметки таблиц или очистки текста
+
+
+def default_cache_dir() -> Path:
+    """Папка кэша вне listing_out: %LOCALAPPDATA% на Windows, иначе $XDG_CACHE_HOME или ~/.cache."""
+    base = os.environ.get("LOCALAPPDATA") if os.name == "nt" else os.environ.get("XDG_CACHE_HOME")
+    return Path(base or Path.home() / ".cache") / CACHE_DIR_NAME
+
+
+class FragmentCache(NamedTuple):
+    """
+    Отрендеренные таблицы (XML w:tbl) на диске, общие для проектов и запусков.
+    Ключ — sha256 содержимого файла и соль настроек рендера (шрифт, колонки, бюджет: от него зависят
+    границы частей и номера их первых строк). Запись (сжата zlib) — строка JSON с разбиением файла
+    и длинами таблиц, за ней таблицы всех частей подряд: без JSON-экранирования XML чтение в разы быстрее.
+    Запись атомарна (tmp + os.replace), поэтому кэш делят процессы --jobs и --file-jobs.
+    Чтение обновляет mtime записи; trim_cache вытесняет самые давние (LRU).
+    """
+
+    root: str
+    salt: str
+
+    def entry_path(self, digest: str) -> Path:
+        key = hashlib.sha256(f"{self.salt}:{digest}".encode("ascii")).hexdigest()
+        return Path(self.root) / key[:2] / key
+
+    def get(self, digest: str) -> Optional[dict]:
+        path = self.entry_path(digest)
+        try:
+            data = zlib.decompress(path.read_bytes())
+            head_end = data.index(b"\n")
+            entry = json.loads(data[:head_end])
+            pos = head_end + 1
+            tables = []
+            for size in entry.pop("sizes"):
+                tables.append(data[pos:pos + size].decode("utf-8"))
+                pos += size
+            os.utime(path)
+        except (OSError, ValueError, KeyError, zlib.error):
+            return None
+        entry["tables"] = tables
+        return entry
+
+    def put(self, info: FileInfo, tables: list[str]) -> None:
+        body = [t.encode("utf-8") for t in tables]
+        head = {
+            "content_len": info.content_len,
+            "blocks": [list(b) for b in info.blocks],
+            "costs": [list(c) for c in info.costs],
+            "sizes": [len(b) for b in body],
+        }
+        data = zlib.compress(json.dumps(head).encode("ascii") + b"\n" + b"".join(body), 1)
+        path = self.entry_path(info.sha256)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except OSError:
+            pass  # кэш — только ускорение: полный диск или нет прав не должны ломать сборку
+
+
+def fragment_cache(root: str, budget: DocBudget, fmt: str = "docx", layout: str = "rows") -> Optional[FragmentCache]:
+    """Кэш для сборки в формате fmt; у pdf части — сами строки, кэшировать нечего."""
+    if not root or fmt != "docx":
+        return None
+    key = [CACHE_VERSION, CODE_FONT_NAME, CODE_FONT_SIZE_PT, NUM_COL_WIDTH_MM, CODE_COL_WIDTH_MM, list(budget)]
+    if layout != "rows":  # у раскладки rows соль прежняя — кэш прошлых версий остаётся в силе
+        key += [layout, COMPACT_ROW_LINES, CELL_PAD_MM, WORD_TAB_COLS]
+    salt = json.dumps(key, ensure_ascii=False)
+    return FragmentCache(root, hashlib.sha256(salt.encode("utf-8")).hexdigest()[:16])
+
+
+def trim_cache(root: Path, max_bytes: int) -> tuple[int, int]:
+    """Удалять записи от давно не читанных, пока кэш больше max_bytes. Возвращает (записей, байт) удалено."""
+    entries: list[tuple[int, int, str]] = []
+    total = 0
+    try:
+        subdirs = [e.path for e in os.scandir(root) if e.is_dir(follow_symlinks=False)]
+    except OSError:
+        return 0, 0
+    for sub in subdirs:
+        try:
+            with os.scandir(sub) as it:
+                for e in it:
+                    st = e.stat(follow_symlinks=False)
+                    entries.append((st.st_mtime_ns, st.st_size, e.path))
+                    total += st.st_size
+        except OSError:
+            continue
+    removed = freed = 0
+    entries.sort()
+    for _mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
+
+
+def trim_fragment_cache(options, logger: logging.Logger) -> None:
+    if not options.cache_dir:
+        return
+    removed, freed = trim_cache(Path(options.cache_dir), options.cache_max_bytes)
+    if removed:
+        logger.info(c_info(f"Кэш таблиц: вытеснено записей {removed} ({format_size(freed)})"))
+
+
+# ===== Раскладка листингов по документам =====
+class ListingEntry(NamedTuple):
+    listing_no: int
+    rel: str
+    a: int
+    b: int
+    part: int  # 0 — файл целиком, иначе номер части
+    total_parts: int
+
+    @property
+    def part_suffix(self) -> str:
+        return f"часть {self.part}/{self.total_parts}" if self.part else ""
+
+
+class DocPlan:
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.listings: list[ListingEntry] = []
+        self.cost = DocCost()
+
+
+class LayoutPlanner:
+    """
+    Нумерация листингов и разбиение на документы по бюджету DocBudget.
+    add_file() возвращает события в порядке исполнения:
+    ("add", ListingEntry) — листинг в текущий документ;
+    ("close", DocPlan) — документ готов к сохранению, дальше пишется следующий.
+    finish() — ("close", DocPlan) или ("drop", DocPlan), если в последнем документе нет текста.
+    У каждого DocPlan в cost — его стоимость.
+    """
+
+    def __init__(self, budget: DocBudget = DocBudget()):
+        self.budget = budget
+        self.docs: list[DocPlan] = []
+        self.cur = DocPlan(1)
+        self.listing_no = 1
+
+    def _add(self, entry: ListingEntry, cost: DocCost) -> tuple[str, ListingEntry]:
+        self.cur.listings.append(entry)
+        self.cur.cost = self.cur.cost.plus(cost)
+        return ("add", entry)
+
+    def _close(self) -> tuple[str, DocPlan]:
+        doc = self.cur
+        self.docs.append(doc)
+        self.cur = DocPlan(doc.idx + 1)
+        return ("close", doc)
+
+    def add_file(self, info: FileInfo) -> list[tuple]:
+        events = []
+        # пустые файлы документ не открывают и не закрывают
+        has_text = self.cur.cost.chars > 0
+        if len(info.blocks) == 1 and self.budget.fits(info.costs[0]):
+            if has_text and not self.budget.fits(self.cur.cost.plus(info.costs[0])):
+                events.append(self._close())
+
+            a, b = info.blocks[0]
+            events.append(self._add(ListingEntry(self.listing_no, info.rel, a, b, 0, 1), info.costs[0]))
+            self.listing_no += 1
+        else:
+            if has_text:
+                events.append(self._close())
+
+            total_parts = len(info.blocks)
+            for part_idx, ((a, b), cost) in enumerate(zip(info.blocks, info.costs), start=1):
+                events.append(self._add(ListingEntry(self.listing_no, info.rel, a, b, part_idx, total_parts), cost))
+                events.append(self._close())
+            self.listing_no += 1
+        return events
+
+    def finish(self) -> tuple[str, DocPlan]:
+        if self.cur.cost.chars > 0:
+            return self._close()
+        return ("drop", self.cur)
+
+
+# ===== Манифест проекта: инкрементальная пересборка =====
+MANIFEST_NAME = ".listing-manifest.json"
+MANIFEST_VERSION = 2
+
+
+def manifest_name(fmt: str = "docx") -> str:
+    """У docx и pdf свои манифесты: сборки в разных форматах лежат рядом и не мешают друг другу."""
+    return MANIFEST_NAME if fmt == "docx" else f".listing-manifest.{fmt}.json"
+
+
+def render_settings(appendix_label: str, options) -> dict:
+    """Всё, от чего зависят состав и содержимое документов, кроме самих файлов."""
+    policy = options.policy
+    settings = {
+        "version": MANIFEST_VERSION,
+        "format": DOC_WRITERS[options.writer].fmt,
+        "appendix_label": appendix_label,
+        "budget": options.budget._asdict(),
+        "font": CODE_FONT_NAME,
+        "font_size_pt": CODE_FONT_SIZE_PT,
+        "num_col_mm": NUM_COL_WIDTH_MM,
+        "code_col_mm": CODE_COL_WIDTH_MM,
+        "policy": {
+            "sniff": policy.sniff,
+            "binary_ratio": BINARY_RATIO,
+            "max_bytes": policy.max_bytes,
+            "ext_limits": [list(x) for x in policy.ext_limits],
+        },
+    }
+    if settings["format"] == "docx":
+        # сборка без сжатия (--zip-level 0) — промежуточная: окончательная пересоберёт документы
+        settings["zip_level"] = options.zip_level
+        if options.layout != "rows":  # у rows настройки прежние — старые манифесты не пересобираются
+            settings["layout"] = {
+                "name": options.layout,
+                "row_lines": COMPACT_ROW_LINES,
+                "wrap_cols": [cell_columns(NUM_COL_WIDTH_MM), cell_columns(CODE_COL_WIDTH_MM), WORD_TAB_COLS],
+            }
+    if settings["format"] == "pdf":
+        settings["pdf"] = {
+            "font_file": Path(options.pdf_font).name,
+            "page_mm": list(PDF_PAGE_MM),
+            "margins_mm": list(PDF_MARGINS_MM),
+            "cell_pad_mm": PDF_CELL_PAD_MM,
+            "tab_size": PDF_TAB_SIZE,
+        }
+    return settings
+
+
+def doc_signature(settings: dict, doc: DocPlan, infos: dict[str, FileInfo]) -> str:
+    payload = [settings, [list(e) + [infos[e.rel].sha256] for e in doc.listings]]
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_manifest(path: Path) -> Optional[dict]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("settings", {}).get("version") != MANIFEST_VERSION:
+        return None
+    return data
+
+
+def save_manifest(
+    path: Path,
+    settings: dict,
+    infos: dict[str, FileInfo],
+    docs: list[dict],
+    documents_total: Optional[int] = None,
+    piece: Optional[tuple[int, int]] = None,
+    inputs: str = "",
+) -> None:
+    """
+    documents_total — сколько документов в раскладке проекта; меньше len(docs) не бывает,
+    больше — если собрана только часть piece (j, m) документов (--shard), см. merge_shards.
+    inputs — inputs_digest файлов проекта на момент сборки (--resume).
+    """
+    data = {
+        "settings": settings,
+        "files": {rel: file_record(i) for rel, i in infos.items()},
+        "documents": docs,
+        "documents_total": len(docs) if documents_total is None else documents_total,
+    }
+    if piece is not None:
+        data["piece"] = list(piece)
+    if inputs:
+        data["inputs"] = inputs
+    write_manifest_data(path, data)
+
+
+def file_record(info: FileInfo) -> dict:
+    return {
+        "size": info.size,
+        "mtime_ns": info.mtime_ns,
+        "sha256": info.sha256,
+        "chars": info.content_len,
+        "blocks": [list(b) for b in info.blocks],
+        "costs": [list(c) for c in info.costs],
+    }
+
+
+def write_manifest_data(path: Path, data: dict) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def cached_file_info(manifest: Optional[dict], path: Path, rel: str) -> Optional[FileInfo]:
+    """FileInfo из манифеста, если размер и mtime файла не изменились."""
+    if manifest is None:
+        return None
+    rec = manifest.get("files", {}).get(rel)
+    if rec is None:
+        return None
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    if st.st_size != rec["size"] or st.st_mtime_ns != rec["mtime_ns"]:
+        return None
+    return FileInfo(
+        rel, rec["size"], rec["mtime_ns"], rec["sha256"], rec["chars"],
+        [tuple(b) for b in rec["blocks"]], [DocCost(*c) for c in rec["costs"]],
+    )
+
+
+# ===== Журналы: продолжение прерванной сборки (--resume) =====
+# Журнал проекта лежит рядом с манифестом и дописывается по строке на каждый документ:
+# {"settings", "piece"} — начало сборки, {"writing": N} — документ N начат,
+# {"saved": запись манифеста, "files": FileInfo его файлов} — документ N записан до конца.
+# После записи манифеста журнал удаляется; остался — сборка проекта прервалась.
+# Журнал запуска (listing_out) — по строке на каждый собранный до конца проект; удаляется,
+# когда запуск завершился без ошибок.
+JOURNAL_NAME = ".listing-journal.jsonl"
+RUN_JOURNAL_NAME = ".listing-run.jsonl"
+
+
+def journal_name(fmt: str = "docx") -> str:
+    return JOURNAL_NAME if fmt == "docx" else f".listing-journal.{fmt}.jsonl"
+
+
+def run_journal_name(fmt: str = "docx") -> str:
+    return RUN_JOURNAL_NAME if fmt == "docx" else f".listing-run.{fmt}.jsonl"
+
+
+def read_journal(path: Path) -> Optional[list[dict]]:
+    """Строки журнала; оборванная последняя строка (сбой посреди записи) пропускается."""
+    try:
+        text = path.read_text(encoding="utf-8")
+    except OSError:
+        return None
+    entries = []
+    for line in text.splitlines():
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(entry, dict):
+            entries.append(entry)
+    return entries
+
+
+def append_journal(path: Path, entry: dict) -> None:
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def file_stamps(project_dir: Path, files: list[Path]) -> dict[str, Optional[tuple[int, int]]]:
+    """(размер, mtime_ns) файлов проекта по относительному пути; None — файл недоступен."""
+    stamps: dict[str, Optional[tuple[int, int]]] = {}
+    for f in files:
+        try:
+            st = f.stat()
+            stamps[f.relative_to(project_dir).as_posix()] = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stamps[f.relative_to(project_dir).as_posix()] = None
+    return stamps
+
+
+def inputs_digest(stamps: dict[str, Optional[tuple[int, int]]]) -> str:
+    """Отпечаток входа проекта (file_stamps): состав файлов после ignore, их размеры и mtime."""
+    h = hashlib.sha256()
+    for rel, stamp in stamps.items():
+        mark = f"{stamp[0]}:{stamp[1]}" if stamp is not None else "-"
+        h.update(f"{rel}\0{mark}\n".encode("utf-8", "surrogateescape"))
+    return h.hexdigest()
+
+
+class LeftJournal(NamedTuple):
+    """Что осталось от прерванной сборки проекта."""
+
+    settings: Optional[dict]
+    piece: Optional[list]
+    touched: set[int]  # документы, которые начинали переписывать (во всех прерванных попытках)
+    docs: dict[int, dict]  # записанные до конца в последней попытке
+    files: dict[str, dict]
+
+
+def load_left_journal(path: Path) -> Optional[LeftJournal]:
+    entries = read_journal(path)
+    if entries is None:
+        return None
+    left = LeftJournal(None, None, set(), {}, {})
+    for entry in entries:
+        if "settings" in entry:
+            left = LeftJournal(entry["settings"], entry.get("piece"), left.touched, {}, {})
+        elif "writing" in entry:
+            left.touched.add(entry["writing"])
+        elif "saved" in entry:
+            left.docs[entry["saved"]["index"]] = entry["saved"]
+            left.files.update(entry.get("files", {}))
+    return left
+
+
+def resume_manifest(base: Optional[dict], left: LeftJournal, settings: dict) -> dict:
+    """Манифест для продолжения: прошлая сборка, поверх неё — документы прерванной."""
+    docs = {d["index"]: d for d in (base or {}).get("documents", [])}
+    docs.update(left.docs)
+    files = dict((base or {}).get("files", {}))
+    files.update(left.files)
+    return {"settings": settings, "files": files, "documents": [docs[i] for i in sorted(docs)]}
+
+
+class DocJournal:
+    """Журнал проекта во время сборки, см. выше."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fh = None
+        self._files: set[str] = set()
+
+    def open(self, settings: dict, piece: Optional[tuple[int, int]], resume: bool) -> None:
+        """resume — дописывать к попытке, которую продолжаем; иначе начать новую."""
+        self._fh = open(self.path, "a", encoding="utf-8")
+        if not resume:
+            self._write({"settings": settings, "piece": list(piece) if piece is not None else None})
+
+    def _write(self, entry: dict) -> None:
+        # flush на каждой строке: после kill/OOM в журнале всё, что успели записать
+        self._fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._fh.flush()
+
+    def writing(self, idx: int) -> None:
+        self._write({"writing": idx})
+
+    def saved(self, record: dict, doc: DocPlan, infos: dict[str, FileInfo]) -> None:
+        files = {}
+        for e in doc.listings:
+            if e.rel not in self._files:
+                self._files.add(e.rel)
+                files[e.rel] = file_record(infos[e.rel])
+        self._write({"saved": record, "files": files})
+
+    def close(self, done: bool) -> None:
+        """done — манифест записан, журнал больше не нужен."""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if done:
+            self.path.unlink(missing_ok=True)
+
+
+def finished_projects(path: Path) -> set[tuple[str, Optional[tuple[int, int]]]]:
+    """(проект, доля) из журнала запуска, собранные до конца."""
+    done = set()
+    for entry in read_journal(path) or []:
+        if entry.get("done"):
+            piece = entry.get("piece")
+            done.add((entry["project"], tuple(piece) if piece else None))
+    return done
+
+
+def project_unchanged(
+    project_dir: Path,
+    listing_out: Path,
+    ignore: IgnoreMatcher,
+    appendix_label: str,
+    options,
+    piece: Optional[tuple[int, int]] = None,
+) -> bool:
+    """Собранный проект можно не трогать: настройки и вход те же, документы на месте."""
+    fmt = DOC_WRITERS[options.writer].fmt
+    project_out = listing_out / project_dir.name
+    manifest = load_manifest(project_out / manifest_name(fmt))
+    if manifest is None or manifest["settings"] != render_settings(appendix_label, options):
+        return False
+    if manifest.get("piece") != (list(piece) if piece is not None else None):
+        return False
+    if (project_out / journal_name(fmt)).exists():
+        return False
+    files = list_project_files(project_dir, listing_out, ignore, options.git_rev)
+    if manifest.get("inputs") != inputs_digest(file_stamps(project_dir, files)):
+        return False
+    for d in manifest["documents"]:
+        path = project_out / d["file"]
+        if not path.is_file() or path.stat().st_size != d["size"]:
+            return False
+    return True
+
+
+# ===== Zip: пакет docx с параллельным сжатием document.xml =====
+_DEFLATE_WINDOW = 32 * 1024
+_DEFLATE_POOL: Optional[tuple[int, int, ThreadPoolExecutor]] = None  # (pid, потоков, пул)
+_DEFLATE_POOL_LOCK = threading.Lock()
+
+
+def _deflate_pool(threads: int) -> ThreadPoolExecutor:
+    """
+    Пул потоков сжатия на threads потоков (0 — по числу ядер). Пересоздаётся, если число потоков
+    другое и в дочернем процессе после fork: потоков унаследованного пула там нет.
+    """
+    global _DEFLATE_POOL
+    threads = threads or os.cpu_count() or 1
+    with _DEFLATE_POOL_LOCK:
+        if _DEFLATE_POOL is not None and _DEFLATE_POOL[:2] == (os.getpid(), threads):
+            return _DEFLATE_POOL[2]
+        if _DEFLATE_POOL is not None and _DEFLATE_POOL[0] == os.getpid():
+            _DEFLATE_POOL[2].shutdown(wait=False)
+        pool = ThreadPoolExecutor(max_workers=threads)
+        _DEFLATE_POOL = (os.getpid(), threads, pool)
+        return pool
+
+
+def deflate_block(data: bytes, zdict: bytes, level: int, last: bool) -> bytes:
+    """
+    Один блок «сырого» deflate. Словарь — 32 КБ перед блоком, поэтому ссылки назад работают
+    через границу и сжатие почти как у сплошного потока. Блок кончается sync flush (выравнивание
+    на байт, без признака конца), последний — finish: склеенные блоки — один корректный поток.
+    zlib отпускает GIL, поэтому блоки сжимаются в потоках параллельно.
+    """
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class BlockDeflater:
+    """
+    Сжиматель с интерфейсом zlib.compressobj (compress/flush) для записи zipfile: данные режутся
+    на блоки DEFLATE_BLOCK, блоки сжимаются в пуле потоков (не больше 2 * потоков в работе)
+    и отдаются по порядку. Заголовки, CRC и размеры пишет сам zipfile.
+    """
+
+    def __init__(self, level: int, threads: int):
+        self.level = level
+        self.threads = threads
+        self._buf = bytearray()
+        self._tail = b""  # словарь для следующего блока
+        self._pending: deque = deque()
+
+    def compress(self, data) -> bytes:
+        data = bytes(data)
+        out = []
+        pos = 0
+        if self._buf:
+            pos = DEFLATE_BLOCK - len(self._buf)
+            self._buf += data[:pos]
+            if len(self._buf) < DEFLATE_BLOCK:
+                return b""
+            self._submit(bytes(self._buf), out)
+            self._buf = bytearray()
+        # целые блоки берутся прямо из data, без перекладывания через буфер
+        while len(data) - pos >= DEFLATE_BLOCK:
+            self._submit(data[pos:pos + DEFLATE_BLOCK], out)
+            pos += DEFLATE_BLOCK
+        self._buf += data[pos:]
+        return b"".join(out)
+
+    def _submit(self, block: bytes, out: list, last: bool = False) -> None:
+        pool = _deflate_pool(self.threads)
+        self._pending.append(pool.submit(deflate_block, block, self._tail, self.level, last))
+        self._tail = block[-_DEFLATE_WINDOW:]
+        while len(self._pending) > 2 * self.threads:
+            out.append(self._pending.popleft().result())
+
+    def flush(self) -> bytes:
+        if not self._pending:  # данных меньше блока: пул не нужен
+            out = [deflate_block(bytes(self._buf), self._tail, self.level, last=True)]
+        else:
+            out = []
+            self._submit(bytes(self._buf), out, last=True)
+            while self._pending:
+                out.append(self._pending.popleft().result())
+        self._buf = bytearray()
+        return b"".join(out)
+
+
+def parallel_deflate(threads: int) -> bool:
+    """Сжимать ли document.xml блоками в потоках: только при --zip-threads > 1 (0 — по числу ядер)."""
+    return (threads or os.cpu_count() or 1) > 1
+
+
+class ZipPackageWriter:
+    """
+    Запись пакета docx через zipfile.ZipFile с заданным уровнем сжатия (0 — stored).
+    При threads > 1 крупные части (document.xml) сжимаются параллельно: zipfile получает
+    готовые блоки deflate от BlockDeflater, а заголовки zip пишет как обычно.
+    Умеет быть phys_writer для PackageWriter из python-docx (write(pack_uri, blob), close()).
+    """
+
+    def __init__(self, path: Path, level: int = ZIP_LEVEL, threads: int = DEFLATE_THREADS):
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        if level == 0:
+            self.zf = zipfile.ZipFile(str(path), "w", compression=zipfile.ZIP_STORED)
+        else:
+            self.zf = zipfile.ZipFile(str(path), "w", compression=zipfile.ZIP_DEFLATED, compresslevel=level)
+
+    def open_member(self, name: str):
+        """Запись части кусками (файловый объект zipfile); закрыть — close()."""
+        w = self.zf.open(name, "w")
+        if self.level != 0 and self.threads > 1:
+            w._compressor = BlockDeflater(self.level, self.threads)
+        return w
+
+    def writestr(self, name: str, data: bytes) -> None:
+        if len(data) <= DEFLATE_BLOCK:
+            self.zf.writestr(name, data)
+            return
+        with self.open_member(name) as w:
+            w.write(data)
+
+    def write(self, pack_uri, blob: bytes) -> None:
+        self.writestr(pack_uri.membername, blob)
+
+    def close(self) -> None:
+        self.zf.close()
+
+
+def save_docx(doc: docx.Document, path: Path, level: int = ZIP_LEVEL, threads: int = DEFLATE_THREADS) -> None:
+    """
+    Сохранение документа. По умолчанию — обычный doc.save(); свой уровень сжатия или
+    --zip-threads > 1 — те же части python-docx, но через ZipPackageWriter.
+    """
+    if level == ZIP_LEVEL and not parallel_deflate(threads):
+        doc.save(str(path))
+        return
+    package = doc.part.package
+    parts = package.parts
+    for part in parts:
+        part.before_marshal()
+    zw = ZipPackageWriter(path, level, threads)
+    try:
+        PackageWriter._write_content_types_stream(zw, parts)
+        PackageWriter._write_pkg_rels(zw, package.rels)
+        PackageWriter._write_parts(zw, parts)
+    finally:
+        zw.close()
+
+
+# ===== Запись docx: дерево python-docx или поток прямо в zip =====
+class DocxTreeWriter:
+    """
+    Исходный путь: весь документ собирается деревом python-docx и пишется doc.save().
+    Как и у потоковой записи, файл пишется в *.tmp и переименовывается: прерванная
+    сборка не оставляет недописанных docx.
+    """
+
+    fmt = "docx"
+
+    def __init__(self, out_path: Path, appendix_label: str, zip_level: int = ZIP_LEVEL, zip_threads: int = DEFLATE_THREADS):
+        self.out_path = out_path
+        self.doc = new_doc(appendix_label)
+        self.zip_level = zip_level
+        self.zip_threads = zip_threads
+
+    def add_listing(self, listing_no: int, rel_name: str, table_xml: str, part_suffix: str = "") -> None:
+        heading_p = add_listing_heading(self.doc, listing_no, rel_name, part_suffix=part_suffix)
+        heading_p.addnext(parse_code_table_xml(table_xml))
+        add_separator_paragraph(self.doc)
+
+    def save(self) -> None:
+        tmp_path = self.out_path.with_name(self.out_path.name + ".tmp")
+        try:
+            save_docx(self.doc, tmp_path, self.zip_level, self.zip_threads)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        os.replace(tmp_path, self.out_path)
+
+    def discard(self) -> None:
+        self.doc = None
+
+
+_DOCUMENT_PART = "word/document.xml"
+_STREAM_MARK = "LISTING-STREAM"
+_TITLE_MARK = "LISTING-TITLE"
+
+
+class _StreamTemplate:
+    """
+    Заготовка документа для потоковой записи: все части пакета, кроме document.xml,
+    и куски document.xml (начало с шапкой, заголовок, разделитель, хвост с sectPr),
+    полученные из того же python-docx — поэтому разметка совпадает байт в байт.
+    """
+
+    def __init__(self, appendix_label: str):
+        d = new_doc(appendix_label)
+
+        buf = io.BytesIO()
+        d.save(buf)
+        with zipfile.ZipFile(buf) as zf:
+            self.parts = [(i.filename, zf.read(i.filename)) for i in zf.infolist()]
+
+        body = d.element.body
+        mark = etree.Comment(_STREAM_MARK)
+        body.find(qn("w:sectPr")).addprevious(mark)
+        head, tail = serialize_part_xml(d.element).split(f"<!--{_STREAM_MARK}-->".encode("utf-8"))
+        body.remove(mark)
+        self.head = head
+        self.tail = tail
+
+        # python-docx ставит xml:space="preserve", если у текста есть крайние пробелы
+        self.heading = {}
+        for preserve in (False, True):
+            heading_p = add_listing_heading(d, 0, _TITLE_MARK + (" " if preserve else ""))
+            heading_p.find(f"{qn('w:r')}/{qn('w:t')}").text = _TITLE_MARK
+            self.heading[preserve] = _fragment_xml(heading_p).split(_TITLE_MARK)
+
+        add_separator_paragraph(d)
+        self.separator = _fragment_xml(d.paragraphs[-1]._p)
+
+    def heading_xml(self, title: str) -> str:
+        pre, post = self.heading[len(title.strip()) < len(title)]
+        esc = title.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        return pre + esc + post
+
+
+_STREAM_TEMPLATES: dict[str, _StreamTemplate] = {}
+
+
+def _stream_template(appendix_label: str) -> _StreamTemplate:
+    t = _STREAM_TEMPLATES.get(appendix_label)
+    if t is None:
+        t = _StreamTemplate(appendix_label)
+        _STREAM_TEMPLATES[appendix_label] = t
+    return t
+
+
+class StreamingDocxWriter:
+    """
+    Пишет word/document.xml прямо в zip по мере поступления листингов.
+    В памяти держится только таблица текущего файла, а не весь документ.
+    Файл пишется во временный *.tmp и переименовывается в save().
+    """
+
+    fmt = "docx"
+
+    def __init__(self, out_path: Path, appendix_label: str, zip_level: int = ZIP_LEVEL, zip_threads: int = DEFLATE_THREADS):
+        self.out_path = out_path
+        self.tmp_path = out_path.with_name(out_path.name + ".tmp")
+        self.tpl = _stream_template(appendix_label)
+        self.zip_level = zip_level
+        self.zip_threads = zip_threads
+        self._zf = None
+        self._xml = None
+        self._tail_parts: list[tuple[str, bytes]] = []
+
+    def _open(self) -> None:
+        self._zf = ZipPackageWriter(self.tmp_path, self.zip_level, self.zip_threads)
+        parts = self.tpl.parts
+        names = [name for name, _ in parts]
+        pos = names.index(_DOCUMENT_PART)
+        for name, blob in parts[:pos]:
+            self._zf.writestr(name, blob)
+        self._tail_parts = parts[pos + 1:]
+        self._xml = self._zf.open_member(_DOCUMENT_PART)
+        self._xml.write(self.tpl.head)
+
+    def add_listing(self, listing_no: int, rel_name: str, table_xml: str, part_suffix: str = "") -> None:
+        if self._zf is None:
+            self._open()
+        chunk = (
+            self.tpl.heading_xml(listing_title(listing_no, rel_name, part_suffix))
+            + table_xml
+            + self.tpl.separator
+        )
+        self._xml.write(chunk.encode("utf-8"))
+
+    def save(self) -> None:
+        if self._zf is None:
+            self._open()
+        self._xml.write(self.tpl.tail)
+        self._xml.close()
+        for name, blob in self._tail_parts:
+            self._zf.writestr(name, blob)
+        self._zf.close()
+        self._zf = None
+        os.replace(self.tmp_path, self.out_path)
+
+    def discard(self) -> None:
+        if self._zf is not None:
+            self._xml.close()
+            self._zf.close()
+            self._zf = None
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
+
+# ===== PDF: моноширинный TrueType-шрифт для встраивания =====
+class TrueTypeFont:
+    """
+    Минимальный разбор TTF: метрики, ширины глифов и cmap (Unicode -> glyph id).
+    В PDF шрифт встраивается целиком (FontFile2), без выделения подмножества.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.data = data = path.read_bytes()
+        if data[:4] == b"ttcf":
+            raise ValueError(f"коллекции шрифтов (.ttc) не поддерживаются: {path}")
+        (num_tables,) = struct.unpack_from(">H", data, 4)
+        self.tables: dict[str, tuple[int, int]] = {}
+        for i in range(num_tables):
+            tag, _checksum, offset, length = struct.unpack_from(">4sIII", data, 12 + 16 * i)
+            self.tables[tag.decode("latin-1")] = (offset, length)
+        for tag in ("head", "hhea", "hmtx", "cmap"):
+            if tag not in self.tables:
+                raise ValueError(f"в шрифте нет таблицы {tag}: {path}")
+
+        head = self.tables["head"][0]
+        (self.units_per_em,) = struct.unpack_from(">H", data, head + 18)
+        self.bbox = struct.unpack_from(">4h", data, head + 36)
+
+        hhea = self.tables["hhea"][0]
+        self.ascent, self.descent, self.line_gap = struct.unpack_from(">3h", data, hhea + 4)
+        (n_metrics,) = struct.unpack_from(">H", data, hhea + 34)
+        self.advances = struct.unpack_from(f">{2 * n_metrics}H", data, self.tables["hmtx"][0])[::2]
+
+        self.italic_angle = 0.0
+        if "post" in self.tables:
+            (angle,) = struct.unpack_from(">i", data, self.tables["post"][0] + 4)
+            self.italic_angle = angle / 65536
+
+        self.cap_height = self.ascent
+        if "OS/2" in self.tables:
+            os2, length = self.tables["OS/2"]
+            version, fs_type = struct.unpack_from(">H6xH", data, os2)
+            if fs_type & 0x000F == 0x0002:
+                raise ValueError(f"лицензия шрифта запрещает встраивание: {path}")
+            if version >= 2 and length >= 90:
+                (self.cap_height,) = struct.unpack_from(">h", data, os2 + 88)
+
+        self.cmap = self._read_cmap()
+        self.name = self._read_ps_name() or re.sub(r"[^A-Za-z0-9-]", "", path.stem) or "Mono"
+        self.mono_advance = self.advance(self.cmap.get(0x20, 0))
+        self._flate: Optional[bytes] = None
+
+    def advance(self, gid: int) -> int:
+        return self.advances[min(gid, len(self.advances) - 1)]
+
+    @property
+    def flate(self) -> bytes:
+        """Сжатый файл шрифта для FontFile2; один раз на процесс."""
+        if self._flate is None:
+            self._flate = zlib.compress(self.data, 6)
+        return self._flate
+
+    def _read_cmap(self) -> dict[int, int]:
+        data = self.data
+        base = self.tables["cmap"][0]
+        (n,) = struct.unpack_from(">H", data, base + 2)
+        best = None  # (приоритет, смещение подтаблицы): формат 12 лучше формата 4
+        for i in range(n):
+            platform, encoding, offset = struct.unpack_from(">HHI", data, base + 4 + 8 * i)
+            if not (platform == 0 or (platform == 3 and encoding in (1, 10))):
+                continue
+            (fmt,) = struct.unpack_from(">H", data, base + offset)
+            rank = {12: 0, 4: 1}.get(fmt)
+            if rank is not None and (best is None or rank < best[0]):
+                best = (rank, base + offset)
+        if best is None:
+            raise ValueError(f"в шрифте нет Unicode-таблицы cmap формата 4 или 12: {self.path}")
+        return self._cmap_format12(best[1]) if best[0] == 0 else self._cmap_format4(best[1])
+
+    def _cmap_format4(self, off: int) -> dict[int, int]:
+        data = self.data
+        (seg_x2,) = struct.unpack_from(">H", data, off + 6)
+        n = seg_x2 // 2
+        ends = struct.unpack_from(f">{n}H", data, off + 14)
+        starts = struct.unpack_from(f">{n}H", data, off + 16 + seg_x2)
+        deltas = struct.unpack_from(f">{n}H", data, off + 16 + 2 * seg_x2)
+        ro_pos = off + 16 + 3 * seg_x2
+        range_offsets = struct.unpack_from(f">{n}H", data, ro_pos)
+        cmap: dict[int, int] = {}
+        for i in range(n):
+            start, end, delta, ro = starts[i], ends[i], deltas[i], range_offsets[i]
+            for c in range(start, min(end, 0xFFFE) + 1):
+                if ro == 0:
+                    gid = (c + delta) & 0xFFFF
+                else:
+                    (gid,) = struct.unpack_from(">H", data, ro_pos + 2 * i + ro + 2 * (c - start))
+                    if gid:
+                        gid = (gid + delta) & 0xFFFF
+                if gid:
+                    cmap[c] = gid
+        return cmap
+
+    def _cmap_format12(self, off: int) -> dict[int, int]:
+        data = self.data
+        (n_groups,) = struct.unpack_from(">I", data, off + 12)
+        cmap: dict[int, int] = {}
+        for i in range(n_groups):
+            start, end, gid = struct.unpack_from(">3I", data, off + 16 + 12 * i)
+            for c in range(start, end + 1):
+                cmap[c] = gid + c - start
+        return cmap
+
+    def _read_ps_name(self) -> str:
+        if "name" not in self.tables:
+            return ""
+        data = self.data
+        base = self.tables["name"][0]
+        count, str_off = struct.unpack_from(">2xHH", data, base)
+        for i in range(count):
+            platform, _enc, _lang, name_id, length, offset = struct.unpack_from(">6H", data, base + 6 + 12 * i)
+            if name_id != 6:
+                continue
+            raw = data[base + str_off + offset: base + str_off + offset + length]
+            name = raw.decode("utf-16-be" if platform in (0, 3) else "latin-1", errors="ignore")
+            name = re.sub(r"[^A-Za-z0-9-]", "", name)
+            if name:
+                return name
+        return ""
+
+
+def find_pdf_font(explicit: str = "") -> Path:
+    if explicit:
+        path = Path(explicit)
+        if not path.is_file():
+            raise FileNotFoundError(f"Нет файла шрифта: {path}")
+        return path
+    for candidate in PDF_FONT_CANDIDATES:
+        path = Path(candidate)
+        if path.is_file():
+            return path
+    raise FileNotFoundError("Не найден моноширинный TTF-шрифт для PDF; укажите его через --pdf-font")
+
+
+_PDF_FONTS: dict[str, TrueTypeFont] = {}
+
+
+def load_pdf_font(path: str) -> TrueTypeFont:
+    font = _PDF_FONTS.get(path)
+    if font is None:
+        font = _PDF_FONTS[path] = TrueTypeFont(Path(path))
+    return font
+
+
+# ===== Запись PDF: страницы уходят на диск по мере раскладки =====
+_PT_PER_MM = 72 / 25.4
+
+
+class _GlyphHex(dict):
+    """Код символа -> 4 hex-цифры glyph id (кодировка Identity-H) для str.translate; помнит использованные глифы."""
+
+    def __init__(self, font: TrueTypeFont):
+        super().__init__()
+        self.font = font
+        self.used: dict[int, int] = {}
+
+    def __missing__(self, cp: int) -> str:
+        gid = self.font.cmap.get(cp, 0)
+        if gid:
+            self.used.setdefault(gid, cp)
+        hx = self[cp] = f"{gid:04X}"
+        return hx
+
+
+def _pdf_text_string(s: str) -> str:
+    return "<FEFF" + s.encode("utf-16-be").hex().upper() + ">"
+
+
+class PdfListingWriter:
+    """
+    Листинги сразу в PDF, без docx и Word: заголовок приложения, «Листинг N — путь»,
+    нумерованные строки моноширинным шрифтом в рамке по внешнему контуру, те же части.
+    Строка длиннее колонки кода переносится, у переноса нет номера.
+    Заполненная страница сразу пишется в *.tmp; в памяти только текущая страница.
+    """
+
+    fmt = "pdf"
+
+    # постоянные объекты; страницы нумеруются после них
+    _CATALOG, _PAGES, _FONT, _CIDFONT, _DESCRIPTOR, _FONT_FILE, _TO_UNICODE, _INFO = range(1, 9)
+
+    def __init__(self, out_path: Path, appendix_label: str, font: TrueTypeFont):
+        self.out_path = out_path
+        self.tmp_path = out_path.with_name(out_path.name + ".tmp")
+        self.font = font
+        self.glyphs = _GlyphHex(font)
+
+        scale = CODE_FONT_SIZE_PT / font.units_per_em
+        self.line_h = (font.ascent - font.descent + font.line_gap) * scale
+        self.ascent = font.ascent * scale
+        self.char_w = font.mono_advance * scale
+
+        self.page_w, self.page_h = (x * _PT_PER_MM for x in PDF_PAGE_MM)
+        left, top, right, bottom = (x * _PT_PER_MM for x in PDF_MARGINS_MM)
+        self.left, self.top, self.bottom = left, self.page_h - top, bottom
+        self.width = self.page_w - left - right
+        self.num_w = NUM_COL_WIDTH_MM * _PT_PER_MM
+        self.table_w = min(self.num_w + CODE_COL_WIDTH_MM * _PT_PER_MM, self.width)
+        self.pad = PDF_CELL_PAD_MM * _PT_PER_MM
+        self.code_cols = max(1, int((self.table_w - self.num_w - 2 * self.pad) / self.char_w))
+        self.title_cols = max(1, int(self.width / self.char_w))
+
+        self._fh = None
+        self._offsets: dict[int, int] = {}
+        self._next_obj = self._INFO + 1
+        self._pages: list[int] = []
+        self._text: list[str] = []
+        self._gfx: list[str] = []
+        self.y = self.top
+
+        header = f"Приложение {appendix_label}"
+        self._show(self.left + max(0.0, (self.width - len(header) * self.char_w) / 2), header)
+        self.y -= self.line_h
+
+    # --- низкий уровень: объекты PDF ---
+    def _open(self) -> None:
+        self._fh = open(self.tmp_path, "wb")
+        self._fh.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write_obj(self, num: int, body: bytes, stream: Optional[bytes] = None) -> None:
+        fh = self._fh
+        self._offsets[num] = fh.tell()
+        fh.write(b"%d 0 obj\n" % num)
+        fh.write(body)
+        if stream is not None:
+            fh.write(b"\nstream\n")
+            fh.write(stream)
+            fh.write(b"\nendstream")
+        fh.write(b"\nendobj\n")
+
+    def _alloc(self) -> int:
+        num = self._next_obj
+        self._next_obj += 1
+        return num
+
+    # --- раскладка ---
+    def _show(self, x: float, text: str) -> None:
+        y = self.y - self.ascent
+        self._text.append(f"1 0 0 1 {x:.2f} {y:.2f} Tm <{text.translate(self.glyphs)}> Tj")
+
+    def _frame(self, top: float) -> None:
+        if top - self.y > 0:
+            self._gfx.append(f"{self.left:.2f} {self.y:.2f} {self.table_w:.2f} {top - self.y:.2f} re S")
+
+    def _flush_page(self) -> None:
+        if self._fh is None:
+            self._open()
+        ops = "0.5 w\n" + "\n".join(self._gfx) + f"\nBT /F1 {CODE_FONT_SIZE_PT} Tf\n" + "\n".join(self._text) + "\nET"
+        content = zlib.compress(ops.encode("ascii"), 6)
+        content_no = self._alloc()
+        self._write_obj(content_no, b"<< /Length %d /Filter /FlateDecode >>" % len(content), content)
+        page_no = self._alloc()
+        self._write_obj(page_no, b"<< /Type /Page /Parent %d 0 R /Contents %d 0 R >>" % (self._PAGES, content_no))
+        self._pages.append(page_no)
+        self._text = []
+        self._gfx = []
+        self.y = self.top
+
+    def _room(self, h: float) -> bool:
+        return self.y - h >= self.bottom - 0.01
+
+    def add_listing(self, listing_no: int, rel_name: str, part: tuple[int, list[str]], part_suffix: str = "") -> None:
+        start_line_no, lines = part
+        title_rows = _wrap_columns(listing_title(listing_no, rel_name, part_suffix), self.title_cols)
+        # заголовок не отрывается от первой строки таблицы
+        if self.y < self.top and not self._room(self.line_h * (len(title_rows) + 1)):
+            self._flush_page()
+        for row in title_rows:
+            if not self._room(self.line_h):
+                self._flush_page()
+            self._show(self.left, row)
+            self.y -= self.line_h
+
+        num_x = self.left + self.pad
+        code_x = self.left + self.num_w + self.pad
+        frame_top = self.y
+        for i, line in enumerate(lines):
+            if "\t" in line:
+                line = line.expandtabs(PDF_TAB_SIZE)
+            for k, piece in enumerate(_wrap_columns(line, self.code_cols)):
+                if not self._room(self.line_h):
+                    self._frame(frame_top)
+                    self._flush_page()
+                    frame_top = self.y
+                if k == 0:
+                    self._show(num_x, str(start_line_no + i))
+                if piece:
+                    self._show(code_x, piece)
+                self.y -= self.line_h
+        self._frame(frame_top)
+        self.y -= self.line_h  # пустой абзац после таблицы, как в docx
+
+    # --- завершение: шрифт, дерево страниц, xref ---
+    def _write_font(self) -> None:
+        font = self.font
+        k = 1000 / font.units_per_em
+        dw = round(font.mono_advance * k)
+        widths = []
+        for gid in sorted(self.glyphs.used):
+            w = round(font.advance(gid) * k)
+            if w != dw:
+                widths.append(f"{gid} [{w}]")
+        name = font.name.encode("ascii")
+
+        self._write_obj(self._FONT, b"<< /Type /Font /Subtype /Type0 /BaseFont /%s /Encoding /Identity-H "
+                        b"/DescendantFonts [%d 0 R] /ToUnicode %d 0 R >>" % (name, self._CIDFONT, self._TO_UNICODE))
+        self._write_obj(self._CIDFONT, (
+            b"<< /Type /Font /Subtype /CIDFontType2 /BaseFont /%s "
+            b"/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) /Supplement 0 >> "
+            b"/FontDescriptor %d 0 R /DW %d /W [%s] /CIDToGIDMap /Identity >>"
+        ) % (name, self._DESCRIPTOR, dw, " ".join(widths).encode("ascii")))
+        bbox = " ".join(str(round(v * k)) for v in font.bbox).encode("ascii")
+        self._write_obj(self._DESCRIPTOR, (
+            b"<< /Type /FontDescriptor /FontName /%s /Flags 33 /FontBBox [%s] /ItalicAngle %d "
+            b"/Ascent %d /Descent %d /CapHeight %d /StemV 80 /FontFile2 %d 0 R >>"
+        ) % (name, bbox, round(font.italic_angle), round(font.ascent * k), round(font.descent * k),
+             round(font.cap_height * k), self._FONT_FILE))
+        flate = font.flate
+        self._write_obj(self._FONT_FILE, b"<< /Length %d /Length1 %d /Filter /FlateDecode >>"
+                        % (len(flate), len(font.data)), flate)
+
+        entries = [f"<{gid:04X}> <{chr(cp).encode('utf-16-be').hex().upper()}>" for gid, cp in sorted(self.glyphs.used.items())]
+        chunks = []
+        for i in range(0, len(entries), 100):
+            part = entries[i:i + 100]
+            chunks.append(f"{len(part)} beginbfchar\n" + "\n".join(part) + "\nendbfchar")
+        cmap = (
+            "/CIDInit /ProcSet findresource begin\n12 dict begin\nbegincmap\n"
+            "/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) /Supplement 0 >> def\n"
+            "/CMapName /Adobe-Identity-UCS def\n/CMapType 2 def\n"
+            "1 begincodespacerange\n<0000> <FFFF>\nendcodespacerange\n"
+            + "\n".join(chunks)
+            + "\nendcmap\nCMapName currentdict /CMap defineresource pop\nend\nend"
+        ).encode("ascii")
+        self._write_obj(self._TO_UNICODE, b"<< /Length %d >>" % len(cmap), cmap)
+
+    def save(self) -> None:
+        self._flush_page()
+        self._write_font()
+        kids = " ".join(f"{n} 0 R" for n in self._pages).encode("ascii")
+        self._write_obj(self._PAGES, (
+            b"<< /Type /Pages /Kids [%s] /Count %d /MediaBox [0 0 %.2f %.2f] "
+            b"/Resources << /Font << /F1 %d 0 R >> /ProcSet [/PDF /Text] >> >>"
+        ) % (kids, len(self._pages), self.page_w, self.page_h, self._FONT))
+        self._write_obj(self._CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self._PAGES)
+        self._write_obj(self._INFO, (
+            f"<< /Title {_pdf_text_string(self.out_path.stem)} /Producer {_pdf_text_string(APP_NAME)} >>"
+        ).encode("ascii"))
+
+        fh = self._fh
+        xref = fh.tell()
+        count = self._next_obj
+        fh.write(b"xref\n0 %d\n0000000000 65535 f \n" % count)
+        fh.write(b"".join(b"%010d 00000 n \n" % self._offsets[n] for n in range(1, count)))
+        fh.write(b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                 % (count, self._CATALOG, self._INFO, xref))
+        fh.close()
+        self._fh = None
+        os.replace(self.tmp_path, self.out_path)
+
+    def discard(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self.tmp_path.exists():
+            self.tmp_path.unlink()
+
+
+DOC_WRITERS = {
+    "docx": DocxTreeWriter,
+    "stream": StreamingDocxWriter,
+    "pdf": PdfListingWriter,
+}
+
+
+def make_bar(title: str, total: int, suffix: str = " %(index).d/%(max).d - %(percent).1f%% - %(elapsed).ds"):
+    if IncrementalBar is None or not sys.stdout.isatty():
+        return None
+    try:
+        return IncrementalBar(
+            title,
+            max=total,
+            suffix=suffix,
+            file=sys.stdout,  # важно: бар в stdout
+        )
+    except TypeError:
+        # если версия progress не поддерживает file=
+        return IncrementalBar(
+            title,
+            max=total,
+            suffix=suffix,
+        )
+
+
+# ===== Ход сборки: шкала по байтам, скорость, статус без терминала =====
+STATUS_PREFIX = "listing-status "
+_PROGRESS_SUFFIX = " %(percent).1f%% - %(speed)s - %(elapsed_td)s, ещё ~%(eta_td)s"
+
+
+class StatusSink(NamedTuple):
+    """
+    Статус для запусков без терминала (CI), где бара нет: не чаще раза в every секунд JSON в файл path
+    (перезаписывается целиком) и, если stdout, строка STATUS_PREFIX + JSON в stdout.
+    every 0 — периодического статуса нет, в файл пишется только итог запуска.
+    По умолчанию выключен: вывод в stdout не меняется, пока статус не запрошен (--status-every, --status-file).
+    """
+
+    every: float = 0.0
+    path: str = ""
+    stdout: bool = False
+
+    def emit(self, state: dict) -> None:
+        if self.stdout and not sys.stdout.isatty():
+            sys.stdout.write(STATUS_PREFIX + json.dumps(state, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+        self.write_file(state)
+
+    def write_file(self, state: dict) -> None:
+        if self.path:
+            path = Path(self.path)
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_text(json.dumps(state, ensure_ascii=False, indent=1), encoding="utf-8")
+            os.replace(tmp, path)
+
+
+def _rate(n: float, seconds: float) -> float:
+    return n / seconds if seconds > 0 else 0.0
+
+
+class Progress:
+    """
+    Ход сборки, взвешенный по байтам входа: файл в 50 МБ двигает шкалу, как тысяча файлов
+    по 50 КБ, и оставшееся время считается по байтам. Счётчики — прочитанные байты и файлы,
+    строки кода, строки таблиц, записанные документы; идут в бар (на терминале), в статус
+    status (без терминала) и в итоговую сводку summary().
+    """
+
+    COUNTS = ("bytes", "files", "lines", "rows", "docs")
+
+    def __init__(self, name: str, show: bool = True, status: Optional[StatusSink] = None, context: Optional[dict] = None):
+        self.name = name
+        self.show = show
+        self.status = status if status is not None and status.every > 0 else None
+        self.context = context or {}
+        self.counts = dict.fromkeys(self.COUNTS, 0)
+        self.total = 0
+        self.done = 0  # пройдено по шкале; у шкалы проектов это вес проекта, а не прочитанные байты
+        self.sizes: dict[str, int] = {}
+        self.bar = None
+        self.t0 = time.perf_counter()
+        self._last_status = self.t0
+
+    def start(self, sizes: dict[str, int], title: str) -> None:
+        """sizes — байты файлов, которые предстоит прочитать (относительный путь -> размер)."""
+        self.sizes = sizes
+        self.total = sum(sizes.values())
+        if self.show:
+            self.bar = make_bar(title, max(self.total, 1), _PROGRESS_SUFFIX)
+            if self.bar is not None:
+                self.bar.speed = ""
+
+    def file(self, rf: RenderedFile) -> None:
+        size = self.sizes.get(rf.rel, 0)
+        self.counts["bytes"] += size
+        self.counts["files"] += 1
+        if rf.info is not None and rf.info.blocks:
+            self.counts["lines"] += rf.info.blocks[-1][1]
+        self._tick(size)
+
+    def rows(self, n: int) -> None:
+        self.counts["rows"] += n
+
+    def doc(self) -> None:
+        self.counts["docs"] += 1
+
+    def add(self, counts: dict, size: int) -> None:
+        """Проект, собранный в другом процессе: его счётчики и вес size на шкале запуска."""
+        for k in self.COUNTS:
+            self.counts[k] += counts.get(k, 0)
+        self._tick(size)
+
+    def _tick(self, n: int) -> None:
+        self.done += n
+        now = time.perf_counter()
+        if self.bar is not None:
+            self.bar.speed = self._speed(now)
+            self.bar.next(n)
+        if self.status is not None and now - self._last_status >= self.status.every:
+            self._last_status = now
+            self.status.emit(self.state(now))
+
+    def _speed(self, now: float) -> str:
+        sec = now - self.t0
+        return (
+            f"{_rate(self.counts['bytes'], sec) / 1e6:.1f} МБ/с, {_rate(self.counts['lines'], sec):.0f} строк/с, "
+            f"таблиц {self.counts['rows']} строк, документов {self.counts['docs']}"
+        )
+
+    def state(self, now: Optional[float] = None) -> dict:
+        sec = (now or time.perf_counter()) - self.t0
+        done = self.done
+        eta = sec * (self.total - done) / done if done and self.total > done else 0.0
+        return dict(
+            self.context,
+            project=self.name,
+            elapsed_s=round(sec, 2),
+            bytes_total=self.total,
+            percent=round(100.0 * done / self.total, 1) if self.total else 100.0,
+            eta_s=round(eta, 1),
+            **self.counts,
+            mb_per_s=round(_rate(self.counts["bytes"], sec) / 1e6, 3),
+            lines_per_s=round(_rate(self.counts["lines"], sec), 1),
+        )
+
+    def finish(self) -> dict:
+        if self.bar is not None:
+            self.bar.speed = self._speed(time.perf_counter())  # последний документ сохранён после последнего файла
+            self.bar.update()
+            self.bar.finish()
+            self.bar = None
+        return self.summary()
+
+    def summary(self) -> dict:
+        sec = time.perf_counter() - self.t0
+        return dict(
+            project=self.name,
+            seconds=round(sec, 3),
+            **self.counts,
+            mb_per_s=round(_rate(self.counts["bytes"], sec) / 1e6, 3),
+            lines_per_s=round(_rate(self.counts["lines"], sec), 1),
+        )
+
+
+def log_throughput(summaries: list[dict], wall: float, logger: logging.Logger) -> None:
+    """Итог запуска: скорость по проектам и в целом."""
+    if not summaries:
+        return
+    logger.info(c_info("Скорость по проектам:"))
+    for p in summaries:
+        logger.info(c_info(
+            f"  [{p['project']}] {p['files']} файлов, {format_size(p['bytes'])} за {p['seconds']:.2f} с: "
+            f"{p['mb_per_s']:.2f} МБ/с, {p['lines_per_s']:.0f} строк/с; строк таблиц {p['rows']}, документов {p['docs']}"
+        ))
+    total = {k: sum(p[k] for p in summaries) for k in Progress.COUNTS}
+    logger.info(c_info(
+        f"  всего: {format_size(total['bytes'])} за {wall:.2f} с: {_rate(total['bytes'], wall) / 1e6:.2f} МБ/с, "
+        f"{_rate(total['lines'], wall):.0f} строк/с; документов {total['docs']}"
+    ))
+
+
+# ===== Профилирование (--profile) =====
+class ProjectProfile:
+    """
+    Время по стадиям и счётчики одного проекта для --profile.
+    Стадии: walk, manifest, read, decode (декодирование, очистка, разбиение на части),
+    render (XML таблиц), assemble (вставка в документ), save (запись docx/pdf), total.
+    При --file-jobs > 1 read/decode/render — сумма по процессам, а не доля стены.
+    """
+
+    enabled = True
+    clock = staticmethod(time.perf_counter)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.file_times: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, key: str, n: int = 1) -> None:
+        self.counts[key] = self.counts.get(key, 0) + n
+
+    def file(self, rel: str, seconds: float) -> None:
+        self.file_times[rel] = self.file_times.get(rel, 0.0) + seconds
+
+    def to_dict(self, slowest: int = 10) -> dict:
+        top = heapq.nlargest(slowest, self.file_times.items(), key=lambda kv: kv[1])
+        return {
+            "project": self.name,
+            "stages": {k: round(v, 4) for k, v in self.stages.items()},
+            "counts": dict(self.counts),
+            "slowest_files": [{"file": rel, "seconds": round(sec, 4)} for rel, sec in top],
+        }
+
+
+class _NullProfile:
+    """Профиль выключен: те же вызовы ничего не делают, часы не читаются."""
+
+    enabled = False
+
+    @staticmethod
+    def clock() -> float:
+        return 0.0
+
+    def add(self, stage: str, seconds: float) -> None:
+        pass
+
+    def count(self, key: str, n: int = 1) -> None:
+        pass
+
+    def file(self, rel: str, seconds: float) -> None:
+        pass
+
+
+NULL_PROFILE = _NullProfile()
+
+
+def profile_report(projects: list[dict], wall: float, slowest: int = 10) -> dict:
+    """Сводка по запуску: суммы стадий и счётчиков по проектам, самые медленные файлы всего запуска."""
+    stages: dict[str, float] = {}
+    counts: dict[str, int] = {}
+    files = []
+    for p in projects:
+        for k, v in p["stages"].items():
+            stages[k] = stages.get(k, 0.0) + v
+        for k, v in p["counts"].items():
+            counts[k] = counts.get(k, 0) + v
+        files.extend({"file": f"{p['project']}/{f['file']}", "seconds": f["seconds"]} for f in p["slowest_files"])
+    files.sort(key=lambda f: f["seconds"], reverse=True)
+    return {
+        "wall_seconds": round(wall, 4),
+        "stages": {k: round(v, 4) for k, v in stages.items()},
+        "counts": counts,
+        "slowest_files": files[:slowest],
+        "projects": projects,
+    }
+
+
+def log_profile_report(report: dict, logger: logging.Logger) -> None:
+    logger.info(c_info(f"Профиль: всего {report['wall_seconds']:.2f} с"))
+    for stage, sec in sorted(report["stages"].items(), key=lambda kv: kv[1], reverse=True):
+        logger.info(c_info(f"  {stage:<10} {sec:9.3f} с"))
+    counts = report["counts"]
+    logger.info(c_info("  " + ", ".join(f"{k}: {v}" for k, v in sorted(counts.items()))))
+    for f in report["slowest_files"][:5]:
+        logger.info(c_info(f"  медленный файл: {f['file']} — {f['seconds']:.3f} с"))
+    if "tracemalloc" in report:
+        logger.info(c_info(f"  пик памяти Python: {format_size(report['tracemalloc']['peak_bytes'])}"))
+
+
+def tracemalloc_summary(top: int = 10) -> dict:
+    """Пик памяти Python и главные места выделений (по строкам кода) на момент вызова."""
+    _, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:top]
+    return {
+        "peak_bytes": peak,
+        "top": [
+            {"where": f"{s.traceback[0].filename}:{s.traceback[0].lineno}", "bytes": s.size, "count": s.count}
+            for s in stats
+        ],
+    }
+
+
+def _account_file(rf: RenderedFile, prof) -> float:
+    """Времена и объёмы прочитанного файла в профиль; возвращает его время до сборки."""
+    read_s, decode_s, render_s = rf.times
+    prof.add("read", read_s)
+    prof.add("decode", decode_s)
+    prof.add("render", render_s)
+    prof.count("files")
+    if rf.cached:
+        prof.count("cache_hits")
+    prof.count("bytes_read", rf.info.size)
+    prof.count("lines", rf.info.blocks[-1][1] if rf.info.blocks else 0)
+    return read_s + decode_s + render_s
+
+
+def _add_to_doc(doc, e: ListingEntry, tables: Iterator, prof) -> float:
+    t0 = prof.clock()
+    table = next(tables)
+    t1 = prof.clock()
+    doc.add_listing(e.listing_no, e.rel, table, part_suffix=e.part_suffix)
+    t2 = prof.clock()
+    prof.add("render", t1 - t0)  # части больших файлов рендерятся здесь, по мере сборки
+    prof.add("assemble", t2 - t1)
+    prof.count("rows", e.b - e.a)
+    return t2 - t0
+
+
+def _save_doc(
+    doc, plan: DocPlan, signature: str, prof, journal: Optional[DocJournal] = None, infos: Optional[dict] = None
+) -> dict:
+    if journal is not None:
+        journal.writing(plan.idx)
+    t0 = prof.clock()
+    doc.save()
+    prof.add("save", prof.clock() - t0)
+    record = _doc_record(plan, signature, doc.out_path)
+    if journal is not None:
+        journal.saved(record, plan, infos)
+    prof.count("docs")
+    prof.count("bytes_written", record["size"])
+    return record
+
+
+def _doc_record(doc: DocPlan, signature: str, path: Path) -> dict:
+    return {
+        "index": doc.idx,
+        "file": path.name,
+        "signature": signature,
+        "listings": [list(e) for e in doc.listings],
+        "cost": doc.cost._asdict(),
+        "size": path.stat().st_size,
+    }
+
+
+def _write_all_docs(
+    files: list[Path],
+    project_dir: Path,
+    open_doc,
+    settings: dict,
+    logger: logging.Logger,
+    progress: Progress,
+    options: "BuildOptions",
+    prof=NULL_PROFILE,
+    journal: Optional[DocJournal] = None,
+) -> tuple[dict[str, FileInfo], list[dict], int]:
+    """Полная сборка за один проход: файл прочитан — сразу в текущий документ."""
+    project_name = project_dir.name
+    planner = LayoutPlanner(options.budget)
+    infos: dict[str, FileInfo] = {}
+    records: list[dict] = []
+    skipped: list[tuple[str, str]] = []
+
+    doc = open_doc(1)
+    fmt = DOC_WRITERS[options.writer].fmt
+    rendered = iter_rendered_files(
+        files, project_dir, file_jobs=options.file_jobs, policy=options.policy, budget=options.budget, fmt=fmt,
+        cache=fragment_cache(options.cache_dir, options.budget, fmt, options.layout), read_ahead=options.read_ahead,
+        layout=options.layout,
+    )
+    for rf in rendered:
+        if rf.denied:
+            logger.warning(c_warn(f"[{project_name}] Пропуск (нет доступа): {rf.rel}"))
+        elif rf.skip:
+            skipped.append((rf.rel, rf.skip))
+        if rf.skip:
+            progress.file(rf)
+            continue
+
+        info = rf.info
+        infos[rf.rel] = info
+        if len(info.blocks) > 1 or not options.budget.fits(info.costs[0]):
+            logger.info(c_info(f"[{project_name}] Большой файл: {rf.rel} -> частей: {len(info.blocks)}"))
+
+        file_s = _account_file(rf, prof)
+        tables = iter_file_tables(rf, fmt=fmt, layout=options.layout)
+        for kind, obj in planner.add_file(info):
+            if kind == "add":
+                file_s += _add_to_doc(doc, obj, tables, prof)
+                progress.rows(obj.b - obj.a)
+            else:
+                records.append(_save_doc(doc, obj, doc_signature(settings, obj, infos), prof, journal, infos))
+                progress.doc()
+                doc = open_doc(obj.idx + 1)
+        prof.file(rf.rel, file_s)
+        progress.file(rf)
+
+    kind, last = planner.finish()
+    if kind == "close":
+        records.append(_save_doc(doc, last, doc_signature(settings, last, infos), prof, journal, infos))
+        progress.doc()
+    else:
+        doc.discard()
+
+    log_skip_report(project_name, skipped, logger)
+    return infos, records, len(records)
+
+
+def _write_changed_docs(
+    files: list[Path],
+    project_dir: Path,
+    open_doc,
+    doc_path,
+    settings: dict,
+    manifest: dict,
+    logger: logging.Logger,
+    progress: Progress,
+    options: "BuildOptions",
+    prof=NULL_PROFILE,
+    piece: Optional[tuple[int, int]] = None,
+    journal: Optional[DocJournal] = None,
+) -> tuple[dict[str, FileInfo], list[dict], int]:
+    """
+    Пересборка по манифесту: файлы с прежними размером и mtime не читаются,
+    раскладка строится заново, пишутся только документы с изменившимся составом листингов
+    (в т.ч. из-за сдвига нумерации после добавления/удаления файлов).
+    """
+    project_name = project_dir.name
+    by_rel = {f.relative_to(project_dir).as_posix(): f for f in files}
+    fmt = DOC_WRITERS[options.writer].fmt
+    cache = fragment_cache(options.cache_dir, options.budget, fmt, options.layout)
+
+    known: dict[str, FileInfo] = {}
+    to_measure: list[tuple[Path, str, FilePolicy, DocBudget, str, Optional[FragmentCache]]] = []
+    for rel, f in by_rel.items():
+        info = cached_file_info(manifest, f, rel)
+        if info is None:
+            to_measure.append((f, rel, options.policy, options.budget, options.layout, cache))
+        else:
+            known[rel] = info
+
+    skipped: list[tuple[str, str]] = []
+    for rf in _iter_files(measure_file, to_measure, options.file_jobs, options.policy, options.read_ahead):
+        if rf.denied:
+            logger.warning(c_warn(f"[{project_name}] Пропуск (нет доступа): {rf.rel}"))
+        elif rf.skip:
+            skipped.append((rf.rel, rf.skip))
+        else:
+            known[rf.rel] = rf.info
+            prof.add("read", rf.times[0])
+            prof.add("decode", rf.times[1])
+            prof.count("measured")
+            if rf.cached:
+                prof.count("cache_hits")
+    log_skip_report(project_name, skipped, logger)
+
+    planner = LayoutPlanner(options.budget)
+    infos: dict[str, FileInfo] = {}
+    for rel in by_rel:
+        info = known.get(rel)
+        if info is None:
+            continue
+        infos[rel] = info
+        planner.add_file(info)
+    planner.finish()
+
+    old_docs = {d["index"]: d for d in manifest.get("documents", [])}
+    records: list[dict] = []
+    to_write: list[tuple[DocPlan, str]] = []
+    mine = select_piece(planner.docs, piece) if piece is not None else None
+    for doc_plan in planner.docs:
+        if mine is not None and doc_plan.idx not in mine:
+            continue
+        sig = doc_signature(settings, doc_plan, infos)
+        old = old_docs.get(doc_plan.idx)
+        path = doc_path(doc_plan.idx)
+        if old is not None and old["signature"] == sig and path.exists() and path.stat().st_size == old["size"]:
+            records.append(old)
+        else:
+            to_write.append((doc_plan, sig))
+
+    logger.info(c_info(
+        f"[{project_name}] Перечитано файлов: {len(to_measure)}; "
+        f"документов к пересборке: {len(to_write)} из {len(planner.docs)}"
+        + (f" (доля {piece[0]}/{piece[1]}: документов {len(mine)})" if piece is not None else "")
+    ))
+    if not to_write:
+        return infos, records, len(planner.docs)
+
+    needed: list[str] = []
+    parts: dict[str, set[int]] = {}
+    for doc_plan, _sig in to_write:
+        for e in doc_plan.listings:
+            if e.rel not in parts:
+                needed.append(e.rel)
+                parts[e.rel] = set()
+            parts[e.rel].add(max(e.part, 1))
+
+    progress.start({rel: infos[rel].size for rel in needed}, f"{project_name} ({settings['appendix_label']})")
+    rendered = iter_rendered_files(
+        [by_rel[rel] for rel in needed],
+        project_dir,
+        file_jobs=options.file_jobs,
+        policy=options.policy,
+        budget=options.budget,
+        fmt=fmt,
+        cache=cache,
+        read_ahead=options.read_ahead,
+        layout=options.layout,
+    )
+    rf = None
+    for doc_plan, sig in to_write:
+        doc = open_doc(doc_plan.idx)
+        for e in doc_plan.listings:
+            if rf is None or rf.rel != e.rel:
+                rf = next(rendered)
+                progress.file(rf)
+                if rf.skip or rf.info.sha256 != infos[e.rel].sha256:
+                    doc.discard()
+                    raise RuntimeError(f"Файл изменился или стал недоступен во время сборки: {e.rel}")
+                tables = iter_file_tables(rf, parts[e.rel], fmt, options.layout)
+                prof.file(rf.rel, _account_file(rf, prof))
+            prof.file(e.rel, _add_to_doc(doc, e, tables, prof))
+            progress.rows(e.b - e.a)
+        records.append(_save_doc(doc, doc_plan, sig, prof, journal, infos))
+        progress.doc()
+
+    records.sort(key=lambda d: d["index"])
+    return infos, records, len(planner.docs)
+
+
+# ===== Основная обработка проекта =====
+class BuildOptions(NamedTuple):
+    """Параметры запуска, общие для всех проектов."""
+
+    writer: str = "docx"
+    file_jobs: int = 1
+    incremental: bool = True
+    policy: FilePolicy = FilePolicy()
+    budget: DocBudget = DocBudget()
+    pdf_font: str = ""  # путь к TTF для --writer pdf, см. find_pdf_font
+    cache_dir: str = ""  # FragmentCache; пусто — без кэша
+    cache_max_bytes: int = CACHE_MAX_BYTES
+    read_ahead: int = READ_AHEAD_BYTES  # байт впереди рендера, см. iter_read_ahead; 0 — читать по одному
+    zip_level: int = ZIP_LEVEL  # сжатие docx, 0 — без сжатия
+    zip_threads: int = DEFLATE_THREADS
+    resume: bool = False  # продолжить прерванную сборку по журналу проекта, см. DocJournal
+    git_rev: str = ""  # проекты — репозитории git, файлы берутся из дерева этой ревизии (iter_git_files)
+    layout: str = "rows"  # раскладка таблицы листинга в docx, см. LAYOUTS
+
+
+def process_project(
+    project_dir: Path,
+    listing_out: Path,
+    ignore: IgnoreMatcher,
+    appendix_label: str,
+    logger: logging.Logger,
+    options: BuildOptions = BuildOptions(),
+    show_progress: bool = True,
+    profile: Optional[ProjectProfile] = None,
+    piece: Optional[tuple[int, int]] = None,
+    status: Optional[StatusSink] = None,
+    files: Optional[list] = None,
+) -> Optional[dict]:
+    """
+    piece (j, m) — собрать только j-ю из m долей документов проекта (--shard): раскладка строится
+    по всем файлам, как при полной сборке, поэтому номера листингов и документов те же.
+    status — куда писать ход сборки без терминала. Возвращает Progress.summary() (None — нет файлов).
+    files — файлы проекта, если папку уже обошли ради веса (estimate_project_weight).
+    """
+    prof = profile or NULL_PROFILE
+    t_start = prof.clock()
+    project_name = project_dir.name
+    project_out = make_project_out_dir(listing_out, project_name)
+
+    if files is None:
+        files = list_project_files(project_dir, listing_out, ignore, options.git_rev)
+    prof.add("walk", prof.clock() - t_start)
+    if not files:
+        logger.warning(c_warn(f"[{project_name}] Нет файлов для обработки (пусто или всё отфильтровано)."))
+        return None
+
+    logger.info(c_info(f"[{project_name}] Файлов к обработке: {len(files)}"))
+    stamps = file_stamps(project_dir, files)
+    inputs = inputs_digest(stamps)
+
+    writer_cls = DOC_WRITERS[options.writer]
+
+    def doc_path(idx: int) -> Path:
+        return doc_name(project_out, project_name, idx, writer_cls.fmt)
+
+    def open_doc(idx: int):
+        if writer_cls is PdfListingWriter:
+            return PdfListingWriter(doc_path(idx), appendix_label, load_pdf_font(options.pdf_font))
+        return writer_cls(doc_path(idx), appendix_label, options.zip_level, options.zip_threads)
+
+    t0 = prof.clock()
+    settings = render_settings(appendix_label, options)
+    manifest_path = project_out / manifest_name(writer_cls.fmt)
+    prev = load_manifest(manifest_path)
+    journal_path = project_out / journal_name(writer_cls.fmt)
+    left = load_left_journal(journal_path)
+    prof.add("manifest", prof.clock() - t0)
+
+    piece_key = list(piece) if piece is not None else None
+    reuse = options.incremental and prev is not None and prev["settings"] == settings and prev.get("piece") == piece_key
+    base = prev if reuse else None
+    resume = options.resume and left is not None and left.settings == settings and left.piece == piece_key
+    if left is not None:
+        # прерванная сборка могла переписать эти документы: прежним записям манифеста о них не верим
+        if base is not None:
+            base = dict(base, documents=[d for d in base["documents"] if d["index"] not in left.touched])
+        if resume:
+            base = resume_manifest(base, left, settings)
+            logger.info(c_info(f"[{project_name}] Продолжение: записанных документов в журнале: {len(left.docs)}"))
+    for tmp in project_out.glob("*.tmp"):
+        tmp.unlink()  # недописанные файлы прерванной сборки
+
+    progress = Progress(project_name, show_progress, status, {"appendix": appendix_label})
+    journal = DocJournal(journal_path)
+    journal.open(settings, piece, resume)
+    try:
+        if base is not None or piece is not None:
+            # доле нужна вся раскладка до записи — её строит только путь по манифесту (пустому, если нет)
+            infos, records, n_docs = _write_changed_docs(
+                files, project_dir, open_doc, doc_path, settings, base or {}, logger, progress,
+                options, prof, piece, journal,
+            )
+        else:
+            progress.start({rel: st[0] for rel, st in stamps.items() if st is not None}, f"{project_name} ({appendix_label})")
+            infos, records, n_docs = _write_all_docs(
+                files, project_dir, open_doc, settings, logger, progress, options, prof, journal,
+            )
+
+        # документы прошлой сборки (и прерванных), которых в новой раскладке нет
+        keep = {d["index"] for d in records}
+        old = (prev or {}).get("documents", []) + (list(left.docs.values()) if left is not None else [])
+        for d in old:
+            stale = project_out / d["file"]
+            if d["index"] not in keep and stale.exists():
+                stale.unlink()
+
+        t0 = prof.clock()
+        save_manifest(manifest_path, settings, infos, records, n_docs, piece, inputs)
+        prof.add("manifest", prof.clock() - t0)
+    except BaseException:
+        journal.close(done=False)
+        raise
+    finally:
+        summary = progress.finish()
+    journal.close(done=True)
+
+    for d in records:
+        logger.info(c_info(f"[{project_name}] {d['file']}: {format_cost(DocCost(**d['cost']))}"))
+    prof.add("total", prof.clock() - t_start)
+    logger.info(c_ok(f"[{project_name}] Готово."))
+    return summary
+
+
+# ===== План без сборки (--plan) =====
+PLAN_CSV_FIELDS = (
+    "project", "appendix", "listing_no", "file", "part", "parts",
+    "document", "document_file", "line_from", "line_to", "chars", "rows",
+)
+
+
+def plan_project(
+    project_dir: Path,
+    listing_out: Path,
+    ignore: IgnoreMatcher,
+    appendix_label: str,
+    logger: logging.Logger,
+    options: BuildOptions = BuildOptions(),
+) -> dict:
+    """
+    Раскладка проекта без рендера и записи: тот же обход, отбор файлов, разбиение и LayoutPlanner.
+    Файлы, не изменившиеся с прошлой сборки с теми же настройками, не читаются (манифест),
+    у остальных длины строк считаются по байтам (count_line_lengths); XML не строится.
+    """
+    project_name = project_dir.name
+    fmt = DOC_WRITERS[options.writer].fmt
+    files = list_project_files(project_dir, listing_out, ignore, options.git_rev)
+    prev = load_manifest(listing_out / project_name / manifest_name(fmt))
+    if prev is not None and prev["settings"] != render_settings(appendix_label, options):
+        prev = None
+    cache = fragment_cache(options.cache_dir, options.budget, fmt, options.layout)
+
+    by_rel = {f.relative_to(project_dir).as_posix(): f for f in files}
+    known: dict[str, FileInfo] = {}
+    to_measure = []
+    for rel, f in by_rel.items():
+        info = cached_file_info(prev, f, rel)
+        if info is None:
+            to_measure.append((f, rel, options.policy, options.budget, options.layout, cache))
+        else:
+            known[rel] = info
+
+    skipped: list[tuple[str, str]] = []
+    for rf in _iter_files(measure_file, to_measure, options.file_jobs, options.policy, options.read_ahead):
+        if rf.denied:
+            logger.warning(c_warn(f"[{project_name}] Пропуск (нет доступа): {rf.rel}"))
+        elif rf.skip:
+            skipped.append((rf.rel, rf.skip))
+        if not rf.skip:
+            known[rf.rel] = rf.info
+
+    planner = LayoutPlanner(options.budget)
+    infos: dict[str, FileInfo] = {}
+    for rel in by_rel:
+        if rel in known:
+            infos[rel] = known[rel]
+            planner.add_file(known[rel])
+    planner.finish()
+
+    documents = []
+    for doc in planner.docs:
+        listings = []
+        for e in doc.listings:
+            cost = infos[e.rel].costs[max(e.part, 1) - 1]
+            listings.append({
+                "listing_no": e.listing_no,
+                "file": e.rel,
+                "part": e.part,
+                "parts": e.total_parts,
+                "lines": [e.a + 1, e.b],
+                "chars": cost.chars,
+                "rows": cost.rows,
+            })
+        documents.append({
+            "index": doc.idx,
+            "file": doc_name(listing_out / project_name, project_name, doc.idx, fmt).name,
+            "cost": doc.cost._asdict(),
+            "over_budget": not options.budget.fits(doc.cost),
+            "listings": listings,
+        })
+    return {
+        "project": project_name,
+        "appendix": appendix_label,
+        "files": len(infos),
+        "read": len(to_measure),
+        "documents": documents,
+        "split_files": [
+            {"file": rel, "parts": len(i.blocks)} for rel, i in infos.items()
+            if len(i.blocks) > 1 or not options.budget.fits(i.costs[0])
+        ],
+        "skipped": [{"file": rel, "reason": reason} for rel, reason in skipped],
+        "totals": {
+            "documents": len(documents),
+            "listings": planner.listing_no - 1,
+            "chars": sum(d["cost"]["chars"] for d in documents),
+            "rows": sum(d["cost"]["rows"] for d in documents),
+        },
+    }
+
+
+def log_plan(plan: dict, logger: logging.Logger) -> None:
+    name, t = plan["project"], plan["totals"]
+    logger.info(c_info(
+        f"[{name}] План: документов {t['documents']}, листингов {t['listings']}, строк {t['rows']}, "
+        f"символов {t['chars']}; файлов {plan['files']} (прочитано {plan['read']}), "
+        f"делится на части {len(plan['split_files'])}, пропущено {len(plan['skipped'])}"
+    ))
+    for d in plan["documents"]:
+        if d["over_budget"]:
+            logger.warning(c_warn(f"[{name}] {d['file']} больше бюджета: {format_cost(DocCost(**d['cost']))}"))
+
+
+def write_plan(plans: list[dict], path: Path) -> None:
+    """План всех проектов: .csv — строка на листинг (часть файла), иначе JSON целиком."""
+    if path.suffix.lower() != ".csv":
+        path.write_text(json.dumps({"projects": plans}, ensure_ascii=False, indent=1), encoding="utf-8")
+        return
+    with open(path, "w", encoding="utf-8-sig", newline="") as fh:  # BOM — чтобы Excel понял UTF-8
+        w = csv.writer(fh)
+        w.writerow(PLAN_CSV_FIELDS)
+        for plan in plans:
+            for d in plan["documents"]:
+                for e in d["listings"]:
+                    w.writerow((
+                        plan["project"], plan["appendix"], e["listing_no"], e["file"], e["part"], e["parts"],
+                        d["index"], d["file"], e["lines"][0], e["lines"][1], e["chars"], e["rows"],
+                    ))
+
+
+# ===== Шарды: сборка на нескольких машинах (--shard i/N, --merge) =====
+SHARD_FILE = ".listing-shard.json"
+
+
+class ShardUnit(NamedTuple):
+    """Работа одного шарда: проект целиком (piece None) или j-я из m долей его документов."""
+
+    project: str
+    label: str
+    piece: Optional[tuple[int, int]]
+    weight: int  # байт исходников (на долю — пропорционально)
+
+
+def parse_shard(s: str) -> tuple[int, int]:
+    i, sep, n = s.partition("/")
+    try:
+        i_, n_ = int(i), int(n)
+    except ValueError:
+        i_ = n_ = 0
+    if not sep or n_ < 1 or not 1 <= i_ <= n_:
+        raise argparse.ArgumentTypeError(f"ожидается i/N, 1 <= i <= N: {s}")
+    return i_, n_
+
+
+def project_weight(files: list[Path]) -> int:
+    total = 0
+    for f in files:
+        try:
+            total += f.stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def estimate_project_weight(
+    project: Path, listing_out: Path, ignore: IgnoreMatcher, git_rev: str = "",
+) -> tuple[int, Optional[list]]:
+    """
+    Вес проекта в байтах до сборки (шкала --jobs, раздача --shard). Архив и ревизия git не обходятся:
+    вес по оглавлению архива (archive_weight) и размерам блобов ls-tree, без правил ignore — сжатый
+    tar не распаковывается, .listingignore не читаются. Папка обходится как при сборке, и вместе
+    с весом возвращается список файлов: его получает process_project, второго обхода нет.
+    """
+    if isinstance(project, ArchiveProject):
+        return archive_weight(project.path), None
+    if git_rev:
+        try:
+            return sum(f.size for f in ls_tree(project, git_rev)), None
+        except (OSError, RuntimeError):
+            return 0, None
+    files = list_project_files(project, listing_out, ignore)
+    return project_weight(files), files
+
+
+def assign_shards(projects: list[tuple[str, str, int]], n: int) -> list[list[ShardUnit]]:
+    """
+    Детерминированное распределение (имя, буква, вес) по n шардам: проект тяжелее средней
+    нагрузки шарда делится на доли документов (не больше n), затем самые тяжёлые единицы по очереди
+    отдаются наименее загруженному шарду (LPT; равные — по имени и номеру шарда). Две доли
+    одного проекта на один шард не попадают: у проекта в выводе шарда один манифест.
+    Все шарды видят одно и то же targets/ и получают одинаковый ответ.
+    """
+    per_shard = max(1, sum(w for _n, _l, w in projects) // n)
+    units: list[ShardUnit] = []
+    for name, label, weight in projects:
+        m = min(n, -(-weight // per_shard)) if weight > per_shard else 1
+        if m == 1:
+            units.append(ShardUnit(name, label, None, weight))
+        else:
+            units.extend(ShardUnit(name, label, (j, m), weight // m) for j in range(1, m + 1))
+    units.sort(key=lambda u: (-u.weight, u.project.lower(), u.piece or (0, 0)))
+    shards: list[list[ShardUnit]] = [[] for _ in range(n)]
+    loads = [0] * n
+    for u in units:
+        free = [i for i in range(n) if all(v.project != u.project for v in shards[i])]
+        k = min(free, key=lambda i: (loads[i], i))
+        shards[k].append(u)
+        loads[k] += u.weight
+    return shards
+
+
+def select_piece(docs: list[DocPlan], piece: tuple[int, int]) -> set[int]:
+    """
+    Номера документов доли (j, m): документы идут подряд, доля — по накопленным символам
+    до начала документа, чтобы доли были примерно равны по объёму.
+    """
+    j, m = piece
+    total = sum(d.cost.chars for d in docs) or 1
+    mine = set()
+    acc = 0
+    for d in docs:
+        if min(m, acc * m // total + 1) == j:
+            mine.add(d.idx)
+        acc += d.cost.chars
+    return mine
+
+
+def write_shard_file(listing_out: Path, shard: tuple[int, int], fmt: str, labels: dict[str, str], units: list[ShardUnit], ok: bool) -> None:
+    data = {
+        "shard": shard[0],
+        "of": shard[1],
+        "format": fmt,
+        "projects": labels,
+        "units": [{"project": u.project, "piece": list(u.piece) if u.piece else None} for u in units],
+        "ok": ok,
+    }
+    (listing_out / SHARD_FILE).write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+
+
+def merge_shards(shard_dirs: list[Path], listing_out: Path, logger: logging.Logger) -> bool:
+    """
+    Собрать listing_out из выводов шардов (их listing_out): проверить, что есть все шарды
+    одного разбиения и все доли каждого проекта, что документы каждого проекта идут 1..N
+    без пропусков и повторов и совпадают по размеру с манифестами; скопировать документы
+    и записать общий манифест проекта (дальше с ним работает обычная инкрементальная сборка).
+    """
+    shards: dict[int, tuple[Path, dict]] = {}
+    for d in shard_dirs:
+        try:
+            data = json.loads((d / SHARD_FILE).read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.error(c_err(f"Нет файла шарда в {d}: {e}"))
+            return False
+        if data["shard"] in shards:
+            logger.error(c_err(f"Шард {data['shard']} указан дважды: {shards[data['shard']][0]} и {d}"))
+            return False
+        shards[data["shard"]] = (d, data)
+
+    first = next(iter(shards.values()))[1]
+    n, fmt, labels = first["of"], first["format"], first["projects"]
+    ok = True
+    for i, (d, data) in sorted(shards.items()):
+        if (data["of"], data["format"], data["projects"]) != (n, fmt, labels):
+            logger.error(c_err(f"{d}: шард {i} из другого разбиения (число шардов, формат или список проектов)"))
+            ok = False
+        if not data["ok"]:
+            logger.error(c_err(f"{d}: шард {i} завершился с ошибками"))
+            ok = False
+    missing = sorted(set(range(1, n + 1)) - set(shards))
+    if missing:
+        logger.error(c_err(f"Нет шардов: {', '.join(map(str, missing))} из {n}"))
+        ok = False
+    if not ok:
+        return False
+
+    sources: dict[str, list[tuple[Path, Optional[list]]]] = {}
+    for _i, (d, data) in sorted(shards.items()):
+        for u in data["units"]:
+            sources.setdefault(u["project"], []).append((d, u["piece"]))
+
+    for name in sorted(labels, key=str.lower):
+        if not _merge_project(name, sources.get(name, []), listing_out, fmt, logger):
+            ok = False
+    return ok
+
+
+def _merge_project(name: str, sources: list[tuple[Path, Optional[list]]], listing_out: Path, fmt: str, logger) -> bool:
+    if not sources:
+        logger.error(c_err(f"[{name}] Проект не собран ни одним шардом"))
+        return False
+    pieces = sorted(tuple(p) if p else (1, 1) for _d, p in sources)
+    m = pieces[0][1]
+    if pieces != [(j, m) for j in range(1, m + 1)]:
+        logger.error(c_err(f"[{name}] Доли документов: {pieces}, ожидались 1..{m}"))
+        return False
+
+    settings = None
+    files: dict = {}
+    docs: dict[int, tuple[Path, dict]] = {}
+    totals = set()
+    for d, _piece in sources:
+        src_dir = d / name
+        man = load_manifest(src_dir / manifest_name(fmt))
+        if man is None:
+            logger.error(c_err(f"[{name}] Нет манифеста в {src_dir}"))
+            return False
+        if settings is not None and man["settings"] != settings:
+            logger.error(c_err(f"[{name}] Доли собраны с разными настройками: {src_dir}"))
+            return False
+        settings = man["settings"]
+        files.update(man["files"])
+        totals.add(man.get("documents_total", len(man["documents"])))
+        for rec in man["documents"]:
+            path = src_dir / rec["file"]
+            if rec["index"] in docs:
+                logger.error(c_err(f"[{name}] Документ {rec['index']} есть в двух долях"))
+                return False
+            if not path.exists() or path.stat().st_size != rec["size"]:
+                logger.error(c_err(f"[{name}] Нет документа или другой размер: {path}"))
+                return False
+            docs[rec["index"]] = (path, rec)
+
+    total = totals.pop() if len(totals) == 1 else None
+    if total is None or sorted(docs) != list(range(1, total + 1)):
+        have = ", ".join(map(str, sorted(docs)))
+        logger.error(c_err(f"[{name}] Неполный набор документов: есть {have or 'ничего'}, всего должно быть {total}"))
+        return False
+
+    project_out = make_project_out_dir(listing_out, name)
+    manifest_path = project_out / manifest_name(fmt)
+    prev = load_manifest(manifest_path)
+    for idx, (src, rec) in sorted(docs.items()):
+        dst = project_out / rec["file"]
+        if not (dst.exists() and os.path.samefile(src, dst)):
+            shutil.copyfile(src, dst)
+    if prev is not None:
+        for rec in prev.get("documents", []):
+            stale = project_out / rec["file"]
+            if rec["index"] not in docs and stale.exists():
+                stale.unlink()
+    write_manifest_data(manifest_path, {
+        "settings": settings,
+        "files": files,
+        "documents": [rec for _idx, (_src, rec) in sorted(docs.items())],
+        "documents_total": total,
+    })
+    logger.info(c_ok(f"[{name}] Собрано документов: {total} (долей: {m})"))
+    return True
+
+
+# ===== Параллельная обработка проектов (--jobs) =====
+class _BufferHandler(logging.Handler):
+    """Копит сообщения проекта в воркере, чтобы вывести их одним блоком."""
+
+    def __init__(self):
+        super().__init__()
+        self.records: list[tuple[int, str]] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def _project_job(
+    project_dir: Path,
+    listing_out: Path,
+    ignore: IgnoreMatcher,
+    appendix_label: str,
+    options: BuildOptions,
+    profile: bool = False,
+    piece: Optional[tuple[int, int]] = None,
+    files: Optional[list] = None,
+):
+    logger = logging.getLogger(f"{APP_NAME}.job")
+    logger.setLevel(logging.INFO)
+    logger.handlers.clear()
+    logger.propagate = False
+    h = _BufferHandler()
+    logger.addHandler(h)
+
+    ok = True
+    summary = None
+    prof = ProjectProfile(project_dir.name) if profile else None
+    logger.info(c_info(f"=== Старт проекта: {project_dir.name} | Приложение: {appendix_label} ==="))
+    try:
+        summary = process_project(
+            project_dir, listing_out, ignore, appendix_label, logger, options, show_progress=False, profile=prof,
+            piece=piece, files=files,
+        )
+    except Exception:
+        logger.error(c_err(f"[{project_dir.name}] Ошибка:\n{traceback.format_exc()}"))
+        ok = False
+    return h.records, ok, prof.to_dict() if prof else None, summary
+
+
+def run_projects_parallel(
+    jobs: list[tuple[Path, str]],
+    listing_out: Path,
+    ignore: IgnoreMatcher,
+    logger: logging.Logger,
+    workers: int,
+    options: BuildOptions = BuildOptions(),
+    profiles: Optional[list[dict]] = None,
+    run_journal: Optional[Path] = None,
+    summaries: Optional[list[dict]] = None,
+    status: Optional[StatusSink] = None,
+    listed: Optional[dict[str, tuple[int, Optional[list]]]] = None,
+) -> bool:
+    """
+    Проекты в отдельных процессах. Буквы приложений назначены заранее (jobs: проект, буква, доля),
+    поэтому результат не зависит от порядка завершения. Логи проекта выводятся целиком по готовности.
+    profiles — список, куда сложить профили проектов (--profile);
+    run_journal — журнал запуска, куда дописываются собранные проекты (--resume);
+    summaries — список, куда сложить Progress.summary() проектов.
+    listed — уже посчитанные estimate_project_weight по именам проектов (раздача --shard).
+    Шкала «Проекты» взвешена по байтам входа проектов и сдвигается, когда проект готов.
+    """
+    listed = dict(listed or {})
+    for project, _label, _piece in jobs:
+        if project.name not in listed:
+            listed[project.name] = estimate_project_weight(project, listing_out, ignore, options.git_rev)
+    weights = [listed[project.name][0] // (piece[1] if piece else 1) for project, _label, piece in jobs]
+    progress = Progress("Проекты", True, status)
+    progress.start({str(i): w for i, w in enumerate(weights)}, "Проекты")
+    all_ok = True
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(
+                _project_job, project, listing_out, ignore, appendix_label, options, profiles is not None, piece,
+                listed[project.name][1],
+            ): (i, project, piece)
+            for i, (project, appendix_label, piece) in enumerate(jobs)
+        }
+        for fut in as_completed(futures):
+            records, ok, prof, summary = fut.result()
+            i, project, piece = futures[fut]
+            all_ok = all_ok and ok
+            if ok and run_journal is not None:
+                append_journal(run_journal, {"project": project.name, "piece": piece, "done": True})
+            if prof is not None:
+                profiles.append(prof)
+            if summary is not None and summaries is not None:
+                summaries.append(summary)
+            if progress.bar:
+                # строка бара в stdout, логи в stderr — перед блоком логов переносим строку
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            for levelno, msg in records:
+                logger.log(levelno, msg)
+            progress.add(summary or {}, weights[i])
+    progress.finish()
+    return all_ok
+
+
+# ===== Режим наблюдения (--watch) =====
+class PollWatcher:
+    """
+    Запасной наблюдатель: раз в interval секунд обходит дерево и сравнивает (mtime, размер)
+    файлов и набор папок с прошлым снимком. skip_dir отсекает игнорируемые папки до спуска.
+    """
+
+    kind = "опрос"
+
+    def __init__(self, roots: list[Path], skip_dir: Callable[[Path], bool], interval: float = WATCH_POLL_S):
+        self.roots = roots
+        self.skip_dir = skip_dir
+        self.interval = interval
+        self._snap = self._snapshot()
+
+    def _snapshot(self) -> dict[str, tuple[int, int]]:
+        snap: dict[str, tuple[int, int]] = {}
+        for root in self.roots:
+            try:
+                st = os.stat(root)
+            except OSError:
+                continue
+            if not os.path.isdir(root):
+                snap[str(root)] = (st.st_mtime_ns, st.st_size)
+                continue
+            stack = [str(root)]
+            while stack:
+                dir_path = stack.pop()
+                snap[dir_path] = (-1, -1)
+                try:
+                    with os.scandir(dir_path) as it:
+                        entries = list(it)
+                except OSError:
+                    continue
+                for e in entries:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if not self.skip_dir(Path(e.path)):
+                                stack.append(e.path)
+                            continue
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    snap[e.path] = (st.st_mtime_ns, st.st_size)
+        return snap
+
+    def poll(self, timeout: float) -> set[Path]:
+        time.sleep(min(timeout, self.interval))
+        snap = self._snapshot()
+        old = self._snap
+        self._snap = snap
+        changed = {p for p, v in snap.items() if old.get(p) != v}
+        changed.update(p for p in old if p not in snap)
+        return {Path(p) for p in changed}
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    Наблюдение через inotify (Linux, libc через ctypes): по watch на каждую папку, новые папки
+    подключаются по событию. При переполнении очереди ядра возвращается сам корень — «изменилось всё».
+    """
+
+    kind = "inotify"
+
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    )
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, roots: list[Path], skip_dir: Callable[[Path], bool], recursive: Iterable[bool] = ()):
+        name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(name or "libc.so.6", use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.skip_dir = skip_dir
+        self.overflow_root = roots[0]
+        self._wds: dict[int, Path] = {}
+        flags = list(recursive) or [True] * len(roots)
+        try:
+            for root, rec in zip(roots, flags):
+                if rec:
+                    self._watch_tree(root)
+                else:
+                    self._watch(root)
+        except OSError:
+            self.close()
+            raise
+
+    def _watch(self, path: Path) -> None:
+        wd = self._add(self._fd, os.fsencode(path), self.MASK | self.IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (2, 20):  # ENOENT, ENOTDIR — папку уже удалили
+                return
+            raise OSError(err, f"inotify_add_watch: {path} ({os.strerror(err)})")
+        self._wds[wd] = path
+
+    def _watch_tree(self, root: Path) -> list[Path]:
+        """Подключить папку и все вложенные; вернуть найденные в них файлы (для новых папок)."""
+        found: list[Path] = []
+        stack = [root]
+        while stack:
+            d = stack.pop()
+            self._watch(d)
+            try:
+                with os.scandir(d) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for e in entries:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        if not self.skip_dir(Path(e.path)):
+                            stack.append(Path(e.path))
+                    else:
+                        found.append(Path(e.path))
+                except OSError:
+                    continue
+        return found
+
+    def poll(self, timeout: float) -> set[Path]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed: set[Path] = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _cookie, size = self._EVENT.unpack_from(buf, pos)
+                pos += self._EVENT.size
+                name = buf[pos:pos + size].rstrip(b"\0")
+                pos += size
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.add(self.overflow_root)
+                    continue
+                if mask & self.IN_IGNORED:
+                    self._wds.pop(wd, None)
+                    continue
+                parent = self._wds.get(wd)
+                if parent is None:
+                    continue
+                path = parent / os.fsdecode(name) if name else parent
+                changed.add(path)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO) and not self.skip_dir(path):
+                    # файлы могли появиться до того, как на папку встал watch
+                    changed.update(self._watch_tree(path))
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def make_watcher(base: Path, targets: Path, skip_dir: Callable[[Path], bool], logger: logging.Logger, poll: bool = False):
+    """inotify на Linux; если недоступен (другая ОС, лимит watch) — опрос дерева."""
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher([targets, base], skip_dir, recursive=(True, False))
+        except (OSError, AttributeError) as e:
+            logger.warning(c_warn(f"inotify недоступен ({e}), перехожу на опрос раз в {WATCH_POLL_S:g} с"))
+    return PollWatcher([targets, base / "ignore.txt"], skip_dir)
+
+
+def wait_for_changes(watcher, debounce: float = WATCH_DEBOUNCE_S) -> set[Path]:
+    """Дождаться изменений и тишины debounce секунд после последнего события (серии сохранений)."""
+    changed: set[Path] = set()
+    while not changed:
+        changed = watcher.poll(3600.0)
+    while True:
+        more = watcher.poll(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+
+def affected_projects(changed: set[Path], base: Path, targets: Path) -> tuple[bool, Optional[set[str]]]:
+    """
+    Разложить изменённые пути по проектам. Возвращает (rescan, names): rescan — перечитать ignore.txt
+    и список проектов; names=None — пересобрать все (изменилась сама папка targets, переполнение очереди).
+    """
+    rescan = False
+    names: set[str] = set()
+    for p in changed:
+        if p.name == "ignore.txt" and p.parent in (base, targets):
+            rescan = True
+            continue
+        try:
+            rel = p.relative_to(targets)
+        except ValueError:
+            continue
+        if not rel.parts:
+            return True, None
+        if len(rel.parts) == 1:
+            rescan = True  # проект появился или исчез
+        names.add(archive_project_name(rel.parts[0]) or rel.parts[0])
+    return rescan, names
+
+
+def watch_projects(
+    base: Path,
+    targets: Path,
+    listing_out: Path,
+    gitignore: bool,
+    logger: logging.Logger,
+    options: BuildOptions,
+    poll: bool = False,
+) -> int:
+    """
+    --watch: после первой сборки держать процесс (импорты, шрифт, правила) и пересобирать
+    только проекты с изменениями; внутри проекта манифест оставляет нетронутыми документы,
+    которых изменения не коснулись. Выход — Ctrl+C.
+    """
+    alphabet = list("АБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ")
+
+    def load_state():
+        matcher = IgnoreMatcher.from_patterns(load_ignore_patterns_auto(base), gitignore=gitignore)
+        projects = find_projects(targets)
+        labels = {p.name: index_to_label(idx, alphabet) for idx, p in enumerate(projects)}
+        return matcher, labels, {p.name: p for p in projects}
+
+    def skip_dir(path: Path) -> bool:
+        try:
+            rel = path.relative_to(targets)
+        except ValueError:
+            return True
+        if len(rel.parts) < 2:
+            return False
+        return path == listing_out or ignore.match_dir(Path(*rel.parts[1:]).as_posix())
+
+    ignore, labels, by_name = load_state()
+    watcher = make_watcher(base, targets, skip_dir, logger, poll)
+    logger.info(c_info(f"Наблюдение за {targets} ({watcher.kind}); Ctrl+C — выход"))
+    try:
+        while True:
+            changed = wait_for_changes(watcher)
+            t0 = time.perf_counter()
+            rescan, names = affected_projects(changed, base, targets)
+            if rescan:
+                try:
+                    new_ignore, new_labels, by_name = load_state()
+                except (OSError, ValueError) as e:
+                    logger.error(c_err(f"Не удалось перечитать targets: {e}"))
+                    continue
+                if names is not None:
+                    # у проектов после добавленного/удалённого сдвигаются буквы приложений
+                    names |= {n for n, label in new_labels.items() if labels.get(n) != label}
+                if new_ignore.rules != ignore.rules:
+                    names = None
+                    ignore = new_ignore
+                    watcher.close()
+                    watcher = make_watcher(base, targets, skip_dir, logger, poll)
+                labels = new_labels
+            names = set(labels) if names is None else names & set(labels)
+            if not names:
+                continue
+            for name in sorted(names, key=str.lower):
+                try:
+                    process_project(by_name[name], listing_out, ignore, labels[name], logger, options, show_progress=False)
+                except Exception:
+                    logger.error(c_err(f"[{name}] Ошибка:\n{traceback.format_exc()}"))
+            logger.info(c_ok(f"Пересобрано за {time.perf_counter() - t0:.2f} с: {', '.join(sorted(names, key=str.lower))}"))
+            trim_fragment_cache(options, logger)
+            drop_spools(listing_out)
+    except KeyboardInterrupt:
+        logger.info(c_info("Наблюдение остановлено."))
+    finally:
+        watcher.close()
+    return 0
+
+
+def pause_if_double_click():
+    """
+    Пауза только при запуске .exe двойным кликом.
+    В консоли (cmd / powershell) паузы не будет.
+    """
+    if getattr(sys, "frozen", False) and sys.stdout is not None:
+        try:
+            if not sys.stdin.isatty():
+                input("\nНажмите Enter для выхода...")
+        except Exception:
+            pass
+
+
+def _parse_ext_limit(s: str) -> tuple[str, int]:
+    ext, sep, size = s.partition("=")
+    if not sep or not ext:
+        raise argparse.ArgumentTypeError(f"ожидается EXT=SIZE: {s}")
+    return (ext.lower(), parse_size(size))
+
+
+# ===== main =====
+def main() -> int:
+    logger = setup_logging()
+
+    parser = argparse.ArgumentParser(
+        description="ГОСТ-листинги из targets/* в listing_out/* (первый запуск создаёт структуру)."
+    )
+    parser.add_argument(
+        "--writer",
+        choices=sorted(DOC_WRITERS),
+        default="docx",
+        help="docx — через python-docx (по умолчанию); stream — потоковая запись document.xml прямо в zip; "
+        "pdf — сразу PDF со встроенным моноширинным шрифтом, без Word",
+    )
+    parser.add_argument(
+        "--pdf-font",
+        default="",
+        metavar="TTF",
+        help="моноширинный TrueType-шрифт для --writer pdf (по умолчанию Courier New, Liberation Mono или DejaVu Sans Mono)",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=LAYOUTS,
+        default="rows",
+        help="раскладка таблицы листинга в docx: rows — строка таблицы на строку кода (по умолчанию); "
+        "compact (экспериментальная) — номера и код в двух ячейках через разрывы строк, длинные строки "
+        "переносятся заранее без номера: в разы меньше элементов XML; открытие в Word не замерялось",
+    )
+    parser.add_argument(
+        "--zip-level",
+        type=int,
+        choices=range(10),
+        default=ZIP_LEVEL,
+        metavar="0-9",
+        help=f"сжатие docx (по умолчанию {ZIP_LEVEL}); 0 — без сжатия, быстро для промежуточных сборок",
+    )
+    parser.add_argument(
+        "--zip-threads",
+        type=int,
+        default=DEFLATE_THREADS,
+        metavar="N",
+        help=f"потоков для сжатия document.xml (по умолчанию {DEFLATE_THREADS} — обычный zipfile); "
+        "больше 1 — блоки deflate сжимаются параллельно; 0 — по числу ядер",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="сколько проектов обрабатывать параллельно (отдельные процессы); 0 — по числу ядер",
+    )
+    parser.add_argument(
+        "--file-jobs",
+        type=int,
+        default=1,
+        help="сколько процессов читают и рендерят файлы внутри одного проекта; 0 — по числу ядер",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="пересобрать все документы, не сверяясь с манифестом прошлого запуска",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="продолжить прерванную сборку: собранные до конца проекты с неизменным входом пропускаются, "
+        "начатый проект продолжается с первого недописанного документа",
+    )
+    parser.add_argument(
+        "--git-rev",
+        default="",
+        metavar="REV",
+        help="проекты в targets/ — репозитории git (можно голые, git clone --bare): брать файлы из дерева "
+        "ревизии REV (тег, ветка, коммит) через git cat-file, без рабочей копии",
+    )
+    parser.add_argument(
+        "--gitignore",
+        action="store_true",
+        help="учитывать .gitignore проектов (семантика git) и не заходить в .git/",
+    )
+    parser.add_argument(
+        "--sniff",
+        action="store_true",
+        help="пропускать двоичные файлы (NUL-байты или много управляющих байт в первых 8 КБ); по умолчанию не проверять",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=parse_size,
+        default=0,
+        metavar="SIZE",
+        help="пропускать файлы больше SIZE (например 5M, 512k); по умолчанию без лимита",
+    )
+    parser.add_argument(
+        "--ext-limit",
+        type=_parse_ext_limit,
+        action="append",
+        default=[],
+        metavar="EXT=SIZE",
+        help="лимит размера по окончанию имени, например .sql=50M или .min.js=0 (0 — пропускать); можно повторять",
+    )
+    parser.add_argument(
+        "--max-doc-chars",
+        type=int,
+        default=MAX_DOC_CHARS,
+        metavar="N",
+        help=f"лимит символов кода на один docx (по умолчанию {MAX_DOC_CHARS}; 0 — без лимита)",
+    )
+    parser.add_argument(
+        "--max-doc-rows",
+        type=int,
+        default=MAX_DOC_ROWS,
+        metavar="N",
+        help="лимит строк таблиц на один docx, например 30000 (по умолчанию 0 — без лимита)",
+    )
+    parser.add_argument(
+        "--max-doc-xml",
+        type=parse_size,
+        default=MAX_DOC_XML_BYTES,
+        metavar="SIZE",
+        help="лимит оценки объёма document.xml на один docx, например 64M (по умолчанию 0 — без лимита)",
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=parse_size,
+        default=READ_AHEAD_BYTES,
+        metavar="SIZE",
+        help=f"без --file-jobs: читать файлы в {READ_AHEAD_THREADS} потоках впереди рендера, держа до SIZE "
+        f"прочитанными (по умолчанию {format_size(READ_AHEAD_BYTES)}; 0 — читать по одному)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=parse_size,
+        default=None,
+        metavar="SIZE",
+        help=f"включить кэш отрендеренных таблиц с лимитом SIZE (с --cache-dir без --cache-size — "
+        f"{format_size(CACHE_MAX_BYTES)}); по умолчанию кэша нет",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default="",
+        metavar="DIR",
+        help="включить кэш таблиц в папке DIR (с --cache-size без --cache-dir — кэш пользователя, "
+        f"~/.cache/{CACHE_DIR_NAME}); можно общую для нескольких копий",
+    )
+    parser.add_argument(
+        "--plan",
+        nargs="?",
+        const="plan.json",
+        default=None,
+        metavar="FILE",
+        help="ничего не собирать: вывести раскладку (документы, листинги, части, строки) и записать её "
+        "в FILE — JSON или .csv (по умолчанию listing_out/plan.json)",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        metavar="i/N",
+        help="собрать только i-ю из N частей работы (для нескольких машин с одинаковым targets/): "
+        "проекты делятся по объёму, крупные — по документам; буквы и номера те же, что при сборке целиком",
+    )
+    parser.add_argument(
+        "--merge",
+        nargs="+",
+        default=None,
+        metavar="DIR",
+        help="собрать listing_out из выводов шардов (их папок listing_out) и проверить, что ничего не пропало",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile.json",
+        default=None,
+        metavar="FILE",
+        help="замерить стадии (обход, чтение, декодирование, рендер, сборка, сохранение) и записать отчёт JSON "
+        "(по умолчанию listing_out/profile.json); сводка выводится в лог",
+    )
+    parser.add_argument(
+        "--cprofile",
+        default="",
+        metavar="FILE",
+        help="записать статистику cProfile основного процесса в FILE (смотреть через pstats/snakeviz)",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="с --profile: отследить пик памяти Python и главные места выделений в основном процессе",
+    )
+    parser.add_argument(
+        "--status-every",
+        type=float,
+        default=None,
+        metavar="SEC",
+        help=f"без терминала (CI), где бара нет: раз в SEC секунд строка «{STATUS_PREFIX.strip()} {{JSON}}» "
+        "в stdout — байты, файлы, строки, документы, МБ/с, оставшееся время (по умолчанию нет)",
+    )
+    parser.add_argument(
+        "--status-file",
+        default="",
+        metavar="FILE",
+        help=f"статус JSON писать в FILE (относительно listing_out) раз в {STATUS_EVERY_S:g} с или --status-every, "
+        "в конце — итог со скоростью по проектам; в stdout без --status-every не выводится",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="после сборки следить за targets/ и ignore.txt и пересобирать изменённые проекты (Ctrl+C — выход)",
+    )
+    parser.add_argument(
+        "--watch-poll",
+        action="store_true",
+        help="с --watch: опрашивать дерево раз в секунду вместо inotify (сетевые диски, не Linux)",
+    )
+    args = parser.parse_args()
+
+    base = app_dir()
+
+    # сборка из шардов: targets/ не нужен
+    if args.merge:
+        listing_out = base / "listing_out"
+        listing_out.mkdir(parents=True, exist_ok=True)
+        ok = merge_shards([Path(d) for d in args.merge], listing_out, logger)
+        if ok:
+            logger.info(c_ok(f"Шарды собраны: {listing_out}"))
+        else:
+            logger.error(c_err("Шарды не собраны: см. ошибки выше"))
+        return 0 if ok else 1
+
+    # первый запуск — создать структуру и выйти
+    if ensure_first_run_layout(base, logger):
+        return 0
+
+    targets = base / "targets"
+    listing_out = base / "listing_out"
+    listing_out.mkdir(parents=True, exist_ok=True)
+
+    patterns = load_ignore_patterns_auto(base)
+    ignore = IgnoreMatcher.from_patterns(patterns, gitignore=args.gitignore)
+
+    logger.info(c_info(f"База: {base}"))
+    logger.info(c_info(f"Папка проектов: {targets}"))
+    logger.info(c_info(f"Вывод: {listing_out}"))
+    logger.info(c_info(f"Правил ignore: {len(patterns)}" + (" (+ .gitignore проектов)" if args.gitignore else "")))
+
+    if not targets.exists() or not targets.is_dir():
+        logger.error(c_err(f"Нет папки targets: {targets}"))
+        return 2
+
+    try:
+        projects = find_projects(targets)
+    except ValueError as e:
+        logger.error(c_err(str(e)))
+        return 2
+    if not projects:
+        logger.warning(c_warn("В targets нет проектов (подпапок или архивов). Добавь проекты и запусти снова."))
+        pause_if_double_click()
+        return 0
+
+    alphabet = list("АБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ")
+    if args.git_rev:
+        if args.watch:
+            logger.error(c_err("--watch не совмещается с --git-rev"))
+            return 2
+        logger.info(c_info(f"Источник: репозитории git, ревизия {args.git_rev}"))
+        bad = 0
+        for project in projects:
+            if isinstance(project, ArchiveProject):
+                continue  # архив читается как есть, ревизии у него нет
+            try:
+                git_commit(project, args.git_rev)
+            except (OSError, RuntimeError) as e:
+                logger.error(c_err(f"[{project.name}] {e}"))
+                bad += 1
+        if bad:
+            return 2
+
+    logger.info(c_info(f"Проектов найдено: {len(projects)}"))
+    labels = {project.name: index_to_label(idx, alphabet) for idx, project in enumerate(projects)}
+    jobs = [(project, labels[project.name], None) for project in projects]
+    units: list[ShardUnit] = []
+    listed: dict[str, tuple[int, Optional[list]]] = {}  # имя -> estimate_project_weight
+    if args.shard:
+        if args.watch:
+            logger.error(c_err("--watch не совмещается с --shard"))
+            return 2
+        (listing_out / SHARD_FILE).unlink(missing_ok=True)
+        listed = {p.name: estimate_project_weight(p, listing_out, ignore, args.git_rev) for p in projects}
+        weights = [(p.name, labels[p.name], listed[p.name][0]) for p in projects]
+        units = assign_shards(weights, args.shard[1])[args.shard[0] - 1]
+        units.sort(key=lambda u: (u.project.lower(), u.piece or (0, 0)))
+        by_name = {p.name: p for p in projects}
+        jobs = [(by_name[u.project], u.label, u.piece) for u in units]
+        logger.info(c_info(
+            f"Шард {args.shard[0]}/{args.shard[1]}: " + (", ".join(
+                u.project + (f" (доля {u.piece[0]}/{u.piece[1]})" if u.piece else "") for u in units
+            ) or "работы нет")
+        ))
+
+    workers = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    workers = min(workers, len(jobs))
+    file_jobs = args.file_jobs if args.file_jobs > 0 else (os.cpu_count() or 1)
+    policy = FilePolicy(
+        sniff=args.sniff,
+        max_bytes=args.max_file_size,
+        ext_limits=tuple(args.ext_limit),
+    )
+    pdf_font = ""
+    if args.writer == "pdf":
+        try:
+            pdf_font = str(find_pdf_font(args.pdf_font))
+            load_pdf_font(pdf_font)
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(c_err(f"Шрифт для PDF: {e}"))
+            return 2
+        logger.info(c_info(f"Шрифт PDF: {pdf_font}"))
+    cache_size = args.cache_size if args.cache_size is not None else (CACHE_MAX_BYTES if args.cache_dir else 0)
+    options = BuildOptions(
+        writer=args.writer,
+        file_jobs=file_jobs,
+        incremental=not args.full,
+        policy=policy,
+        budget=DocBudget(args.max_doc_chars, args.max_doc_rows, args.max_doc_xml),
+        pdf_font=pdf_font,
+        cache_dir=str(Path(args.cache_dir) if args.cache_dir else default_cache_dir()) if cache_size else "",
+        cache_max_bytes=cache_size,
+        read_ahead=args.read_ahead,
+        zip_level=args.zip_level,
+        zip_threads=args.zip_threads,
+        resume=args.resume,
+        git_rev=args.git_rev,
+        layout=args.layout if DOC_WRITERS[args.writer].fmt == "docx" else "rows",  # на pdf раскладка не влияет
+    )
+    if args.plan is not None:
+        t0 = time.perf_counter()
+        plans = []
+        try:
+            for project, appendix_label, _piece in jobs:
+                plans.append(plan_project(project, listing_out, ignore, appendix_label, logger, options))
+                log_plan(plans[-1], logger)
+        finally:
+            drop_spools(listing_out)
+        plan_path = Path(args.plan)
+        if not plan_path.is_absolute():
+            plan_path = listing_out / plan_path
+        write_plan(plans, plan_path)
+        logger.info(c_ok(f"План за {time.perf_counter() - t0:.2f} с: {plan_path}"))
+        pause_if_double_click()
+        return 0
+
+    # копии сжатых tar (SPOOL_DIR_NAME) размером с распакованный архив: удаляются и при ошибке, и по Ctrl+C
+    try:
+        run_journal = listing_out / run_journal_name(DOC_WRITERS[options.writer].fmt)
+        if args.resume and run_journal.exists():
+            done = finished_projects(run_journal)
+            left_jobs = []
+            for project, appendix_label, piece in jobs:
+                if (project.name, piece) in done and project_unchanged(
+                    project, listing_out, ignore, appendix_label, options, piece,
+                ):
+                    logger.info(c_info(f"[{project.name}] Собран в прерванном запуске, вход не менялся — пропуск"))
+                else:
+                    left_jobs.append((project, appendix_label, piece))
+            logger.info(c_info(f"Продолжение: осталось проектов {len(left_jobs)} из {len(jobs)}"))
+            jobs = left_jobs
+            workers = max(1, min(workers, len(jobs)))
+        else:
+            if args.resume:
+                logger.warning(c_warn("Журнал прерванной сборки не найден — обычная сборка"))
+            run_journal.write_text(
+                json.dumps({"started": time.strftime("%Y-%m-%dT%H:%M:%S")}, ensure_ascii=False) + "\n",
+                encoding="utf-8",
+            )
+
+        status_path = ""
+        if args.status_file:
+            status_path = str(Path(args.status_file) if Path(args.status_file).is_absolute() else listing_out / args.status_file)
+        if args.status_every is not None:
+            status = StatusSink(args.status_every, status_path, stdout=True)
+        else:
+            status = StatusSink(STATUS_EVERY_S if status_path else 0.0, status_path)
+        summaries: list[dict] = []
+        profiles: Optional[list[dict]] = [] if args.profile is not None else None
+        if args.tracemalloc:
+            tracemalloc.start(10)
+        cprof = cProfile.Profile() if args.cprofile else None
+        if cprof is not None:
+            cprof.enable()
+        t0 = time.perf_counter()
+
+        ok = True
+        if workers > 1:
+            logger.info(c_info(f"Параллельно: {workers} процесс(ов)"))
+            ok = run_projects_parallel(
+                jobs, listing_out, ignore, logger, workers, options, profiles, run_journal, summaries, status, listed)
+        else:
+            for project, appendix_label, piece in jobs:
+                logger.info(c_info(f"=== Старт проекта: {project.name} | Приложение: {appendix_label} ==="))
+                prof = ProjectProfile(project.name) if profiles is not None else None
+                summary = process_project(
+                    project, listing_out, ignore, appendix_label, logger, options, profile=prof, piece=piece, status=status,
+                    files=listed.get(project.name, (0, None))[1],
+                )
+                if summary is not None:
+                    summaries.append(summary)
+                append_journal(run_journal, {"project": project.name, "piece": piece, "done": True})
+                if prof is not None:
+                    profiles.append(prof.to_dict())
+        if ok:  # журнал нужен только для --resume после сбоя
+            run_journal.unlink(missing_ok=True)
+    finally:
+        drop_spools(listing_out)
+
+    wall = time.perf_counter() - t0
+    if cprof is not None:
+        cprof.disable()
+        cprof.dump_stats(args.cprofile)
+        logger.info(c_info(f"cProfile: {args.cprofile}"))
+    if profiles is not None:
+        profiles.sort(key=lambda p: p["project"].lower())
+        report = profile_report(profiles, wall)
+        if args.tracemalloc:
+            report["tracemalloc"] = tracemalloc_summary()
+        report_path = Path(args.profile)
+        if not report_path.is_absolute():
+            report_path = listing_out / report_path
+        report_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        log_profile_report(report, logger)
+        logger.info(c_info(f"Отчёт профиля: {report_path}"))
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    summaries.sort(key=lambda p: p["project"].lower())
+    log_throughput(summaries, wall, logger)
+    final = {"state": "done" if ok else "failed", "wall_s": round(wall, 3), "projects": summaries}
+    if status.every > 0:
+        status.emit(final)
+    else:
+        status.write_file(final)
+
+    trim_fragment_cache(options, logger)
+    if args.shard:
+        write_shard_file(listing_out, args.shard, DOC_WRITERS[options.writer].fmt, labels, units, ok)
+    if ok:
+        logger.info(c_ok(f"Готово. Результаты: {listing_out}"))
+    else:
+        logger.error(c_err(f"Завершено с ошибками. Результаты: {listing_out}"))
+
+    if args.watch:
+        return watch_projects(
+            base, targets, listing_out, args.gitignore, logger, options._replace(incremental=True), args.watch_poll,
+        )
+
+    pause_if_double_click()
+    return 0 if ok else 1
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     raise SystemExit(main())
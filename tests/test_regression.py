@@ -0,0 +1,204 @@
+"""
+Регрессия сборки: маленькое дерево targets/ собирается ls.py разными путями, и части docx
+сравниваются с обычной сборкой (--writer docx, doc.save() python-docx), а она — с исходными файлами.
+
+    python -m pytest tests
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+from pathlib import Path
+
+from lxml import etree
+
+LS_PY = Path(__file__).resolve().parent.parent / "ls.py"
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# маленький бюджет, чтобы были и несколько документов, и файл на несколько частей
+BUDGET = ["--max-doc-chars", "3000"]
+
+FIXTURE = {
+    "Alpha/main.py": "".join(f"def f{i}(x):\n    return x + {i}\n\n" for i in range(20)),
+    "Alpha/sub/notes.txt": "  два пробела\n\tтабуляция\n<a & b>\n\nпоследняя без перевода",
+    "Alpha/big.sql": "".join(f"INSERT INTO t VALUES ({i}, 'строка {i}');\n" for i in range(300)),
+    "Alpha/empty.txt": "",
+    "Alpha/crlf.bat": "@echo off\r\necho one\r\necho two\r\n",
+    "beta/readme.md": "# beta\n\nтекст\n",
+    "beta/src/app.js": "".join(f"const v{i} = {i};\n" for i in range(120)),
+    "beta/src/lib/util.js": "export const id = (x) => x;\n",
+}
+
+# сбой после стольких записанных документов (для --resume)
+CRASH_DRIVER = """
+import os, sys
+sys.path.insert(0, os.getcwd())
+import ls
+
+after = int(sys.argv.pop(1))
+orig = ls._save_doc
+saved = [0]
+
+
+def crashing(*a, **k):
+    res = orig(*a, **k)
+    saved[0] += 1
+    if saved[0] >= after:
+        os._exit(137)
+    return res
+
+
+ls._save_doc = crashing
+sys.argv[0] = "ls.py"
+raise SystemExit(ls.main())
+"""
+
+
+def docx_parts(root: Path) -> dict[str, dict[str, bytes]]:
+    """Все docx под root: относительный путь -> {имя части: байты}."""
+    out = {}
+    for path in sorted(root.rglob("*.docx")):
+        with zipfile.ZipFile(path) as zf:
+            out[path.relative_to(root).as_posix()] = {name: zf.read(name) for name in zf.namelist()}
+    return out
+
+
+def listing_rows(parts: dict[str, dict[str, bytes]]) -> dict[str, list[tuple[str, str]]]:
+    """По документам по порядку: путь файла из заголовка листинга -> (номер, код) всех его частей."""
+    rows: dict[str, list[tuple[str, str]]] = {}
+    for name in sorted(parts, key=lambda n: (n.split("/")[0], int(n.rsplit("_", 1)[1].split(".")[0]))):
+        body = etree.fromstring(parts[name]["word/document.xml"]).find(W + "body")
+        rel = None
+        for el in body:
+            if el.tag == W + "p":
+                text = "".join(t.text or "" for t in el.iter(W + "t"))
+                if text.startswith("Листинг "):
+                    rel = text.split(" — ", 1)[1].split(" (", 1)[0]
+            elif el.tag == W + "tbl":
+                for tr in el.iter(W + "tr"):
+                    num, code = ("".join(t.text or "" for t in tc.iter(W + "t")) for tc in tr.iter(W + "tc"))
+                    rows.setdefault(name.split("/")[0] + "/" + rel, []).append((num, code))
+    return rows
+
+
+class BuildCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix="ls-test-"))
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.work = self.make_tree(self.tmp / "work")
+        self.run_ls("--full", *BUDGET)
+        self.expected = docx_parts(self.work / "listing_out")
+
+    def make_tree(self, work: Path) -> Path:
+        for rel, text in FIXTURE.items():
+            path = work / "targets" / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(text.encode("utf-8"))
+        (work / "ignore.txt").write_text("", encoding="utf-8")
+        shutil.copy2(LS_PY, work / "ls.py")
+        return work
+
+    def run_ls(self, *args: str, script: str = "ls.py", check: bool = True) -> subprocess.CompletedProcess:
+        res = subprocess.run(
+            [sys.executable, script, *args], cwd=self.work, capture_output=True, text=True, encoding="utf-8",
+            env=dict(os.environ, PYTHONIOENCODING="utf-8"),
+        )
+        if check and res.returncode != 0:
+            self.fail(f"ls.py {' '.join(args)}: код {res.returncode}\n{res.stdout}\n{res.stderr}")
+        return res
+
+    def rebuild(self, *args: str) -> dict[str, dict[str, bytes]]:
+        shutil.rmtree(self.work / "listing_out", ignore_errors=True)
+        self.run_ls("--full", *BUDGET, *args)
+        return docx_parts(self.work / "listing_out")
+
+    def assertSameDocs(self, got: dict[str, dict[str, bytes]]) -> None:
+        self.assertEqual(sorted(got), sorted(self.expected))
+        for name, parts in self.expected.items():
+            self.assertEqual(sorted(got[name]), sorted(parts), name)
+            for part, data in parts.items():
+                self.assertEqual(got[name][part], data, f"{name}: {part}")
+
+
+class DefaultBuildTest(BuildCase):
+    def test_sources_in_listings(self):
+        self.assertGreater(len(self.expected), 2)
+        rows = listing_rows(self.expected)
+        want = {}
+        for rel, text in FIXTURE.items():
+            lines = text.replace("\r\n", "\n").split("\n")
+            want[rel] = [(str(i), line) for i, line in enumerate(lines, 1)]
+        self.assertEqual(rows, want)
+
+    def test_big_file_in_parts(self):
+        parts = [
+            name for name, p in self.expected.items()
+            if b"big.sql (" in p["word/document.xml"]
+        ]
+        self.assertGreater(len(parts), 1)
+
+    def test_unchanged_rerun_keeps_documents(self):
+        stamps = {p: p.stat().st_mtime_ns for p in (self.work / "listing_out").rglob("*.docx")}
+        self.run_ls(*BUDGET)
+        self.assertEqual({p: p.stat().st_mtime_ns for p in (self.work / "listing_out").rglob("*.docx")}, stamps)
+        self.assertSameDocs(docx_parts(self.work / "listing_out"))
+
+    def test_incremental_matches_full(self):
+        with open(self.work / "targets/beta/src/app.js", "a", encoding="utf-8") as fh:
+            fh.write("// изменено\n")
+        (self.work / "targets/Alpha/aaa_first.py").write_text("print(1)\n", encoding="utf-8")
+        self.run_ls(*BUDGET)
+        got = docx_parts(self.work / "listing_out")
+        self.expected = self.rebuild()
+        self.assertSameDocs(got)
+
+
+class WritersTest(BuildCase):
+    def test_stream(self):
+        self.assertSameDocs(self.rebuild("--writer", "stream"))
+
+    def test_parallel_deflate(self):
+        self.assertSameDocs(self.rebuild("--zip-threads", "2"))
+        self.assertSameDocs(self.rebuild("--writer", "stream", "--zip-threads", "2", "--zip-level", "9"))
+
+
+class ParallelTest(BuildCase):
+    def test_jobs(self):
+        self.assertSameDocs(self.rebuild("-j", "2"))
+
+    def test_file_jobs(self):
+        self.assertSameDocs(self.rebuild("--file-jobs", "2"))
+
+    def test_shard_merge(self):
+        shards = []
+        for i in (1, 2):
+            self.rebuild("--shard", f"{i}/2")
+            shard = self.tmp / f"shard{i}"
+            shutil.move(str(self.work / "listing_out"), shard)
+            shards.append(str(shard))
+        self.run_ls("--merge", *shards)
+        self.assertSameDocs(docx_parts(self.work / "listing_out"))
+
+
+class ResumeTest(BuildCase):
+    def test_resume_after_crash(self):
+        (self.work / "crash.py").write_text(CRASH_DRIVER, encoding="utf-8")
+        shutil.rmtree(self.work / "listing_out")
+        res = self.run_ls("2", "--full", *BUDGET, script="crash.py", check=False)
+        self.assertEqual(res.returncode, 137, res.stderr)
+        self.assertTrue((self.work / "listing_out/.listing-run.jsonl").exists())
+        self.run_ls("--resume", *BUDGET)
+        self.assertSameDocs(docx_parts(self.work / "listing_out"))
+        self.assertFalse((self.work / "listing_out/.listing-run.jsonl").exists())
+
+    def test_clean_run_leaves_no_journal(self):
+        self.assertEqual(sorted(p.name for p in (self.work / "listing_out").iterdir()), ["Alpha", "beta"])
+
+
+if __name__ == "__main__":
+    unittest.main()